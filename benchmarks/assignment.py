@@ -0,0 +1,175 @@
+"""
+Compare the counter assignment strategies of utils/assignment.py, and the shared
+queue mode, on a queueing trace.
+
+Each strategy is run through a discrete-event simulation of one service: users
+arrive, join the counter picked by a CounterPool, and are served first come first
+served. The counters' average service times are learned online from finished
+services, as counter_assignment does from pops.
+
+Usage:
+    python -m benchmarks.assignment                       # synthetic trace
+    python -m benchmarks.assignment --users 50000 --load 0.95
+    python -m benchmarks.assignment --history SERVICE_ID  # trace recorded in served_history
+"""
+import argparse, heapq, random, time
+from collections import deque
+import numpy as np
+from utils.assignment import ASSIGNMENT_STRATEGIES, CounterPool
+
+
+def synthetic_trace(users: int, service_times: list, load: float, seed: int = 0):
+    """
+    Poisson arrivals at `load` times the service's capacity, exponential service times.
+
+    Returns:
+        tuple: (arrivals, work, service_times) where a user's service time at counter c is
+            work[i] * service_times[c].
+    """
+    rng = np.random.default_rng(seed)
+    capacity = sum(1 / mean for mean in service_times)
+    arrivals = np.cumsum(rng.exponential(1 / (capacity * load), users))
+    work = rng.exponential(1.0, users)
+    return arrivals, work, list(service_times)
+
+
+def history_trace(service_id: int):
+    """
+    Arrivals and per-counter service times recorded in served_history for a service.
+    """
+    from database.db import SessionLocal
+    from utils.analytics import HistoryArrays
+
+    history = HistoryArrays()
+    db = SessionLocal()
+    try:
+        history.refresh(db)
+    finally:
+        db.close()
+    mask = (history.service_id == service_id) & ~np.isnan(history.registered) & ~np.isnan(history.started)
+    if not mask.any():
+        raise SystemExit(f"no served history with start times for service {service_id}")
+    durations = history.ended[mask] - history.started[mask]
+    counters = history.counter_id[mask]
+    service_times = [float(durations[counters == counter_id].mean()) for counter_id in np.unique(counters)]
+    arrivals = np.sort(history.registered[mask] - history.registered[mask].min())
+    # per-user work relative to the mean, so every counter keeps its recorded speed
+    work = durations / durations.mean()
+    return arrivals, work, service_times
+
+
+def simulate(strategy: str, arrivals, work, service_times: list, seed: int = 0):
+    """
+    Run one strategy over a trace.
+
+    Returns:
+        dict: mean and p90 wait in seconds, throughput per hour and the mean cost of a counter selection.
+    """
+    counters = range(len(service_times))
+    loads = {counter_id: 0 for counter_id in counters}
+    learned = {}
+    served = {counter_id: (0.0, 0) for counter_id in counters}
+    pool = CounterPool(loads, strategy, learned, rng=random.Random(seed))
+    queues = {counter_id: deque() for counter_id in counters}
+    busy_until = {counter_id: 0.0 for counter_id in counters}
+    completions = []  # (time, counter_id)
+    waits = np.empty(len(arrivals))
+    select_ns = 0
+    last_end = 0.0
+
+    def start_next(counter_id, now):
+        user, arrived = queues[counter_id][0]
+        duration = work[user] * service_times[counter_id]
+        waits[user] = now - arrived
+        busy_until[counter_id] = now + duration
+        heapq.heappush(completions, (now + duration, counter_id))
+
+    def complete(now, counter_id):
+        user, _ = queues[counter_id].popleft()
+        total, count = served[counter_id]
+        duration = work[user] * service_times[counter_id]
+        served[counter_id] = (total + duration, count + 1)
+        loads[counter_id] -= 1
+        pool.touch(counter_id, service_time=(total + duration) / (count + 1))
+        if queues[counter_id]:
+            start_next(counter_id, now)
+
+    for user, arrived in enumerate(arrivals):
+        while completions and completions[0][0] <= arrived:
+            now, counter_id = heapq.heappop(completions)
+            complete(now, counter_id)
+            last_end = now
+        started = time.perf_counter_ns()
+        counter_id = pool.select()
+        select_ns += time.perf_counter_ns() - started
+        queues[counter_id].append((user, arrived))
+        loads[counter_id] += 1
+        pool.touch(counter_id)
+        if len(queues[counter_id]) == 1:
+            start_next(counter_id, max(arrived, busy_until[counter_id]))
+    while completions:
+        now, counter_id = heapq.heappop(completions)
+        complete(now, counter_id)
+        last_end = now
+
+    return {
+        "mean_wait_s": float(waits.mean()),
+        "p90_wait_s": float(np.percentile(waits, 90)),
+        "throughput_per_hour": len(arrivals) / max(last_end, 1e-9) * 3600,
+        "select_ns": select_ns / len(arrivals),
+    }
+
+
+def simulate_shared(arrivals, work, service_times: list):
+    """
+    Run the shared queue mode over a trace: one FIFO line, the first free counter takes its head.
+
+    Returns:
+        dict: The same measures as simulate(), there is no counter selection.
+    """
+    # (time the counter becomes free, counter_id)
+    free_at = [(0.0, counter_id) for counter_id in range(len(service_times))]
+    heapq.heapify(free_at)
+    waits = np.empty(len(arrivals))
+    last_end = 0.0
+    for user, arrived in enumerate(arrivals):
+        free, counter_id = heapq.heappop(free_at)
+        started = max(free, arrived)
+        waits[user] = started - arrived
+        ended = started + work[user] * service_times[counter_id]
+        last_end = max(last_end, ended)
+        heapq.heappush(free_at, (ended, counter_id))
+    return {
+        "mean_wait_s": float(waits.mean()),
+        "p90_wait_s": float(np.percentile(waits, 90)),
+        "throughput_per_hour": len(arrivals) / max(last_end, 1e-9) * 3600,
+        "select_ns": 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--load", type=float, default=0.9, help="arrival rate as a fraction of total capacity")
+    parser.add_argument("--service-times", type=float, nargs="+", default=[60, 90, 120, 300],
+                        help="mean service time of each counter in seconds")
+    parser.add_argument("--history", type=int, metavar="SERVICE_ID", help="replay a service's served_history instead")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.history is not None:
+        arrivals, work, service_times = history_trace(args.history)
+    else:
+        arrivals, work, service_times = synthetic_trace(args.users, args.service_times, args.load, args.seed)
+
+    print(f"{len(arrivals)} users, {len(service_times)} counters, mean service times {[round(t) for t in service_times]}")
+    print(f"{'strategy':<28}{'mean wait s':>12}{'p90 wait s':>12}{'served/h':>10}{'select ns':>11}")
+    results = {strategy: simulate(strategy, arrivals, work, service_times, args.seed) for strategy in ASSIGNMENT_STRATEGIES}
+    results["shared queue"] = simulate_shared(arrivals, work, service_times)
+    for strategy, result in results.items():
+        print(f"{strategy:<28}{result['mean_wait_s']:>12.1f}{result['p90_wait_s']:>12.1f}"
+              f"{result['throughput_per_hour']:>10.1f}{result['select_ns']:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Compare queue operations per second with direct and write-behind persistence.
+
+Each mode registers users on one service, updates every user's ETA once and pops
+every counter empty, by calling the route functions with a session of the
+configured database (DATABASE_URL). In the write-behind mode the flusher runs as
+it does in the app, and the final flush is included in the time.
+
+Password hashing is replaced by a trivial function in both modes: bcrypt costs
+the same in both and would hide the difference.
+
+Usage:
+    python -m benchmarks.persistence
+    python -m benchmarks.persistence --users 2000 --counters 4 --flush-ms 50
+"""
+import argparse, asyncio, time
+from unittest import mock
+
+
+async def run_mode(mode: str, users: int, counters: int):
+    from database.db import SessionLocal
+    from database.migrations import apply_migrations
+    from database.models import Service, Counter, UserData
+    from routes.counter_operator import pop_next_user_from_queue
+    from routes.get_distance import update_eta
+    from routes.user import generate_token
+    from schema.distance_models import Location, UpdateEtaReaquest
+    from schema.operator_models import SelectQueue
+    from schema.user_models import GenerateTokenRequest
+    from utils.global_settings import settings
+    from utils.helpers import load_counters
+    from utils.history import history_writer
+    from utils.queue_store import queue_store
+
+    settings.persistence_mode = mode
+    apply_migrations()
+    db = SessionLocal()
+    service = Service(name=f"benchmark_{mode}", no_of_counters=counters)
+    db.add(service)
+    db.flush()
+    db.add_all([Counter(service_id=service.id) for _ in range(counters)])
+    db.commit()
+    service_id = service.id
+    load_counters(db)
+    counter_ids = list(settings.counters[service_id])
+    queue_store.start()
+    timings = {}
+    try:
+        started = time.perf_counter()
+        user_ids = []
+        for index in range(users):
+            request = GenerateTokenRequest(name=f"benchmark_{mode}_{index}", password="x", service_id=service_id,
+                                           location=Location(latitude=24.8 + index % 50 / 1000, longitude=67.0))
+            user_ids.append((await generate_token(request, db=db)).data.id)
+        timings["register"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for index, user_id in enumerate(user_ids):
+            location = Location(latitude=24.9 + index % 70 / 1000, longitude=67.1)
+            await update_eta(request=UpdateEtaReaquest(userid=user_id, location=location), db=db)
+        timings["update_eta"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for counter_id in counter_ids:
+            while True:
+                try:
+                    await pop_next_user_from_queue(SelectQueue(service_id=service_id, counter=counter_id), db=db)
+                except Exception as e:
+                    if getattr(e, "status_code", None) == 404:
+                        break
+                    raise
+        timings["pop"] = time.perf_counter() - started
+    finally:
+        started = time.perf_counter()
+        await queue_store.stop()
+        timings["final_flush"] = time.perf_counter() - started
+        history_writer.flush()
+        db.query(UserData).filter(UserData.service_id == service_id).delete()
+        db.query(Counter).filter(Counter.service_id == service_id).delete()
+        db.query(Service).filter(Service.id == service_id).delete()
+        db.commit()
+        db.close()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--counters", type=int, default=4)
+    parser.add_argument("--flush-ms", type=int, default=None, help="write-behind flush interval")
+    args = parser.parse_args()
+
+    from utils.global_settings import settings
+    if args.flush_ms:
+        settings.write_behind_flush_ms = args.flush_ms
+
+    # no distance API calls and no rebalancing: both modes share them, they only add noise
+    with mock.patch("routes.user.hash_password", side_effect=lambda password: password), \
+            mock.patch("routes.get_distance.get_ETA", side_effect=lambda location: int(location.latitude * 1000) % 60), \
+            mock.patch("routes.counter_operator.rebalance_q"):
+        results = {mode: asyncio.run(run_mode(mode, args.users, args.counters)) for mode in ("direct", "write_behind")}
+
+    print(f"{args.users} users, {args.counters} counters, write-behind flush every {settings.write_behind_flush_ms} ms")
+    print(f"{'mode':<14}{'register/s':>12}{'update_eta/s':>14}{'pop/s':>10}{'final flush s':>15}")
+    for mode, timings in results.items():
+        print(f"{mode:<14}{args.users / timings['register']:>12.0f}{args.users / timings['update_eta']:>14.0f}"
+              f"{args.users / timings['pop']:>10.0f}{timings['final_flush']:>15.3f}")
+
+
+if __name__ == "__main__":
+    main()
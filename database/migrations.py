@@ -0,0 +1,272 @@
+from sqlalchemy import Table, Column, String, DateTime, MetaData, Index, inspect, select, insert, update, func, text, column, bindparam
+from sqlalchemy import table as raw_table
+from sqlalchemy.schema import CreateColumn
+from database.db import engine, Base
+from database.models import UserData, Counter, Service, ServedHistory, Appointment, OperatorStation, StationCounter
+from datetime import timezone
+import logging
+
+logger = logging.getLogger(__name__)
+
+# kept outside Base.metadata, the history of how the models' tables were migrated
+migration_metadata = MetaData()
+
+schema_migrations = Table(
+    "schema_migrations",
+    migration_metadata,
+    Column("id", String(100), primary_key=True),
+    Column("applied_at", DateTime, server_default=func.now()),
+)
+
+
+def _index_names(connection, table_name: str):
+    return {index["name"] for index in inspect(connection).get_indexes(table_name)}
+
+def _create_index(connection, index: Index):
+    if index.name not in _index_names(connection, index.table.name):
+        logging.info(f"creating index {index.name} on {index.table.name}")
+        index.create(connection)
+
+def _drop_index(connection, index: Index):
+    if index.name in _index_names(connection, index.table.name):
+        logging.info(f"dropping index {index.name} on {index.table.name}")
+        index.drop(connection)
+
+def _add_column(connection, column: Column):
+    table_name = column.table.name
+    if column.name not in {existing["name"] for existing in inspect(connection).get_columns(table_name)}:
+        logging.info(f"adding column {column.name} to {table_name}")
+        ddl = CreateColumn(column).compile(dialect=connection.dialect)
+        connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {ddl}"))
+
+def _make_nullable(connection, column: Column):
+    table_name = column.table.name
+    existing = next(c for c in inspect(connection).get_columns(table_name) if c["name"] == column.name)
+    if existing["nullable"]:
+        return
+    if connection.dialect.name == "sqlite":
+        # SQLite can not alter a column in place; its tables are created from the models
+        logging.warning(f"{table_name}.{column.name} is NOT NULL, recreate the table to allow NULLs")
+        return
+    logging.info(f"making {table_name}.{column.name} nullable")
+    column_type = column.type.compile(dialect=connection.dialect)
+    if connection.dialect.name == "mysql":
+        connection.execute(text(f"ALTER TABLE {table_name} MODIFY {column.name} {column_type} NULL"))
+    else:
+        connection.execute(text(f"ALTER TABLE {table_name} ALTER COLUMN {column.name} DROP NOT NULL"))
+
+def _model_index(table, name: str):
+    return next(index for index in table.indexes if index.name == name)
+
+
+def _0001_user_data_composite_indexes(connection):
+    """
+    Replace the single-column counter index on user_data with (counter, pos) and
+    (counter, ETA), so the per-counter queue reads are served in index order.
+    """
+    table = UserData.__table__
+    _create_index(connection, _model_index(table, "ix_user_data_counter_pos"))
+    _create_index(connection, _model_index(table, "ix_user_data_counter_eta"))
+    # the composite indexes now back the counter foreign key, so the old index can go
+    _drop_index(connection, Index("ix_user_data_counter", table.c.counter))
+
+
+def _0002_counters_version(connection):
+    """
+    Add the optimistic concurrency version to counters.
+    """
+    _add_column(connection, Counter.__table__.c.version)
+
+
+def _0003_served_history(connection):
+    """
+    Create the served_history archive and record when users join the queue.
+    """
+    ServedHistory.__table__.create(connection, checkfirst=True)
+    _add_column(connection, UserData.__table__.c.registered_at)
+
+
+def _0004_user_location(connection):
+    """
+    Keep the last known location of queued users so their ETA can be refreshed.
+    """
+    table = UserData.__table__
+    _add_column(connection, table.c.latitude)
+    _add_column(connection, table.c.longitude)
+    _add_column(connection, table.c.eta_updated_at)
+
+
+def _0005_service_assignment_strategy(connection):
+    """
+    Let each service choose how new users are assigned to its counters.
+    """
+    _add_column(connection, Service.__table__.c.assignment_strategy)
+
+
+def _0006_shared_service_queue(connection):
+    """
+    Let a service keep one shared queue: its waiting users have no counter yet.
+    """
+    _add_column(connection, Service.__table__.c.queue_mode)
+    _make_nullable(connection, UserData.__table__.c.counter)
+    _create_index(connection, _model_index(UserData.__table__, "ix_user_data_service_queue"))
+
+
+def _0007_service_timestamps(connection):
+    """
+    Replace user_data.processing_time with arrival and service start timestamps.
+
+    processing_time held a whole-second time.time() stamp while a user was served; it is
+    copied to service_started_at and left in place, unused. On MySQL the timestamps get
+    microsecond resolution and the counter averages become floats. SQLite stores both
+    at full precision already.
+    """
+    for column in (UserData.__table__.c.arrived_at, UserData.__table__.c.service_started_at,
+                   ServedHistory.__table__.c.arrived_at):
+        _add_column(connection, column)
+    if connection.dialect.name != "mysql":
+        return
+    if "processing_time" in {column["name"] for column in inspect(connection).get_columns("user_data")}:
+        # computed relative to the server's clock so the session time zone does not matter
+        connection.execute(text(
+            "UPDATE user_data SET service_started_at = UTC_TIMESTAMP(6) - INTERVAL (UNIX_TIMESTAMP() - processing_time) SECOND "
+            "WHERE processing_time > 0 AND service_started_at IS NULL"
+        ))
+    for table, columns in (("user_data", ("registered_at", "arrived_at", "service_started_at")),
+                           ("served_history", ("registered_at", "arrived_at", "service_started_at", "service_ended_at"))):
+        for name in columns:
+            nullable = "NOT NULL" if name == "service_ended_at" else "NULL"
+            connection.execute(text(f"ALTER TABLE {table} MODIFY {name} DATETIME(6) {nullable}"))
+    for name in ("avg_tat", "total_tat"):
+        connection.execute(text(f"ALTER TABLE counters MODIFY {name} DOUBLE NULL DEFAULT 0"))
+
+
+def _0008_user_priority(connection):
+    """
+    Record the priority level users registered with; existing users are regular.
+    """
+    _add_column(connection, UserData.__table__.c.priority)
+
+
+def _0009_appointments(connection):
+    """
+    Create the appointments table behind slot booking.
+    """
+    Appointment.__table__.create(connection, checkfirst=True)
+
+
+def _0010_user_skips(connection):
+    """
+    Count how often users were skipped or demoted, and how far that holds them back.
+    """
+    table = UserData.__table__
+    _add_column(connection, table.c.skip_count)
+    _add_column(connection, table.c.skip_offset)
+
+
+def _0011_operator_stations(connection):
+    """
+    Create the operator stations and their counter bindings.
+    """
+    OperatorStation.__table__.create(connection, checkfirst=True)
+    StationCounter.__table__.create(connection, checkfirst=True)
+
+
+def _0012_counter_status(connection):
+    """
+    Let counters be paused or drained; existing counters are open.
+    """
+    _add_column(connection, Counter.__table__.c.status)
+
+
+def _0013_station_current_user(connection):
+    """
+    Remember the user a station called, not only its counter, so exactly that user is finished.
+    """
+    _add_column(connection, OperatorStation.__table__.c.current_user)
+
+
+def _0014_user_rank_level(connection):
+    """
+    Store the level users are ranked by, so aging is a write; existing users start at their priority.
+    """
+    _add_column(connection, UserData.__table__.c.rank_level)
+    connection.execute(text("UPDATE user_data SET rank_level = priority"))
+
+
+def _0015_eta_updated_at_utc(connection):
+    """
+    Store eta_updated_at in UTC like the other timestamps; it was written as naive local time.
+
+    The existing values are converted with the local UTC offset, and on MySQL the column
+    gets microsecond resolution.
+    """
+    # read as the plain DATETIME it was, not through the model's UTCDateTime
+    user_data = raw_table("user_data", column("id"), column("eta_updated_at", DateTime))
+    rows = connection.execute(select(user_data.c.id, user_data.c.eta_updated_at).where(user_data.c.eta_updated_at.is_not(None)))
+    converted = [
+        {"user_id": user_id, "updated_at": updated_at.astimezone(timezone.utc).replace(tzinfo=None)}
+        for user_id, updated_at in rows
+    ]
+    if converted:
+        connection.execute(
+            update(user_data).where(user_data.c.id == bindparam("user_id")).values(eta_updated_at=bindparam("updated_at")),
+            converted,
+        )
+    if connection.dialect.name == "mysql":
+        connection.execute(text("ALTER TABLE user_data MODIFY eta_updated_at DATETIME(6) NULL"))
+
+
+# ordered list of (id, migration); never edit an applied entry, append a new one instead
+MIGRATIONS = [
+    ("0001_user_data_composite_indexes", _0001_user_data_composite_indexes),
+    ("0002_counters_version", _0002_counters_version),
+    ("0003_served_history", _0003_served_history),
+    ("0004_user_location", _0004_user_location),
+    ("0005_service_assignment_strategy", _0005_service_assignment_strategy),
+    ("0006_shared_service_queue", _0006_shared_service_queue),
+    ("0007_service_timestamps", _0007_service_timestamps),
+    ("0008_user_priority", _0008_user_priority),
+    ("0009_appointments", _0009_appointments),
+    ("0010_user_skips", _0010_user_skips),
+    ("0011_operator_stations", _0011_operator_stations),
+    ("0012_counter_status", _0012_counter_status),
+    ("0013_station_current_user", _0013_station_current_user),
+    ("0014_user_rank_level", _0014_user_rank_level),
+    ("0015_eta_updated_at_utc", _0015_eta_updated_at_utc),
+]
+
+
+def apply_migrations(bind=engine):
+    """
+    Apply every migration that has not been recorded in schema_migrations yet.
+
+    Args:
+        bind (Engine, optional): The engine to migrate. Defaults to the application engine.
+
+    Returns:
+        list[str]: The IDs of the migrations applied by this call.
+
+    Notes:
+        - Missing tables are created from the models first, existing ones and their rows are
+          kept. Each migration is idempotent, so a database created directly from the models
+          only gets its history recorded.
+        - This is the only place the schema is created; importing the models never touches the database.
+    """
+    migration_metadata.create_all(bind)
+    Base.metadata.create_all(bind)
+    applied_now = []
+    with bind.begin() as connection:
+        applied = set(connection.scalars(select(schema_migrations.c.id)))
+        for migration_id, migrate in MIGRATIONS:
+            if migration_id in applied:
+                continue
+            logging.info(f"applying migration {migration_id}")
+            migrate(connection)
+            connection.execute(insert(schema_migrations).values(id=migration_id))
+            applied_now.append(migration_id)
+    return applied_now
+
+
+if __name__ == "__main__":
+    print(apply_migrations() or "database is up to date")
@@ -1,7 +1,44 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, Index, DateTime, Float
+from sqlalchemy.dialects import mysql
 from sqlalchemy.orm import relationship
-from database.db import Base, engine  # Assuming db.py contains the Base and engine objects
+from sqlalchemy.types import TypeDecorator
+from database.db import Base  # Assuming db.py contains the Base object
 from passlib.context import CryptContext
+from datetime import timezone
+from utils.clock import clock
+
+
+class UTCDateTime(TypeDecorator):
+    """
+    Timezone-aware UTC timestamp with microsecond resolution.
+
+    Stored as a naive UTC DATETIME (DATETIME(6) on MySQL, which otherwise truncates to
+    whole seconds) and read back as an aware UTC datetime. Naive values are taken as UTC.
+    """
+
+    impl = DateTime
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "mysql":
+            return dialect.type_descriptor(mysql.DATETIME(fsp=6))
+        return dialect.type_descriptor(DateTime())
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
+
+
+def _registered_level(context):
+    # a user is ranked by its own priority until waiting raises it, see utils/aging.py
+    return context.get_current_parameters().get("priority") or 0
+
 
 class UserData(Base):
 
@@ -11,10 +48,19 @@ class UserData(Base):
             id (int): Primary key.
             name (str): Unique username.
             hashed_password (str): Hashed user password.
-            counter (int): Foreign key to Counter.
+            counter (int): Foreign key to Counter. NULL while waiting in a shared service queue.
             pos (int): Position in the queue.
             ETA (int): Estimated Time of Arrival.
+            priority (int): Priority level, 0 for regular users; higher levels are served first, see utils/priority.py.
+            rank_level (int): The level the user is ranked by, its priority raised by waiting, see utils/aging.py.
+            skip_count (int): How often the user was skipped at the counter or demoted as a no-show.
+            skip_offset (int): Minutes the user is held back in the queue by those skips, added to ETA when ranking.
             service_id (int): Foreign key to Service.
+            registered_at (datetime): When the user joined the queue.
+            arrived_at (datetime): When the user was first seen at the branch, if yet.
+            service_started_at (datetime): When the counter started serving the user, if yet.
+            latitude, longitude (float): Last known location of the user.
+            eta_updated_at (datetime): When ETA was last computed.
    """
 
 
@@ -22,15 +68,33 @@ class UserData(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(100), unique=True, nullable= False, index=True)
     hashed_password = Column(String(100), nullable= False)
-    counter = Column(Integer, ForeignKey('counters.id'), default=None, nullable=False, index= True)
+    counter = Column(Integer, ForeignKey('counters.id'), default=None, nullable=True)
     pos = Column(Integer, default=None, nullable= False)
     ETA = Column(Integer, default= 0)
+    priority = Column(Integer, nullable=False, default=0, server_default="0")
+    rank_level = Column(Integer, nullable=False, default=_registered_level, server_default="0")
+    skip_count = Column(Integer, nullable=False, default=0, server_default="0")
+    skip_offset = Column(Integer, nullable=False, default=0, server_default="0")
     service_id = Column(Integer, ForeignKey('services.id'), nullable=False, index= True)
-    processing_time= Column(Integer, nullable=True, default=0)
+    registered_at = Column(UTCDateTime, nullable=True, default=clock.now)
+    arrived_at = Column(UTCDateTime, nullable=True)
+    service_started_at = Column(UTCDateTime, nullable=True)
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
+    eta_updated_at = Column(UTCDateTime, nullable=True, default=clock.now)
     # Correct relationship to the Service model
     service = relationship("Service", back_populates="users")  # Single service, not services
     counter_rel = relationship("Counter", back_populates="users")
 
+    # composite indexes for the per-counter queue reads, which filter by counter and
+    # order by pos or ETA; they also serve plain counter lookups and the counter FK
+    __table_args__ = (
+        Index("ix_user_data_counter_pos", "counter", "pos"),
+        Index("ix_user_data_counter_eta", "counter", "ETA"),
+        # the shared queue of a service is its users without a counter, ordered by pos
+        Index("ix_user_data_service_queue", "service_id", "counter", "pos"),
+    )
+
 
 class Service(Base):
 
@@ -40,12 +104,16 @@ class Service(Base):
             id (int): Primary key.
             name (str): Unique service name.
             no_of_counters (int): Number of counters present in the service.            
+            assignment_strategy (str): How new users are assigned to a counter, see utils/assignment.py.
+            queue_mode (str): "per_counter" queues, or one "shared" queue feeding every counter.
    """    
     
     __tablename__ = "services"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(100), unique=True, nullable=False)
     no_of_counters = Column(Integer, nullable=False, default=0)
+    assignment_strategy = Column(String(32), nullable=False, default="least_count", server_default="least_count")
+    queue_mode = Column(String(16), nullable=False, default="per_counter", server_default="per_counter")
 
     # Correct corresponding relationship to the UserData model
     users = relationship("UserData", back_populates="service")  # Use 'service' here to match UserData
@@ -57,24 +125,125 @@ class Counter(Base):
     Attributes:
         id (int): Primary key.
         service_id(int): Foreign key to Service.
-        avg_tat(int): Average Processing(Turn-Around-Time) time of the counter.
-        total_tat(int): Total Processing(Turn-Around-Time) of the counter.
+        avg_tat(float): Average Processing(Turn-Around-Time) time of the counter, in seconds.
+        total_tat(float): Total Processing(Turn-Around-Time) of the counter, in seconds.
         users_processed(int): Number of users processed by the counter.
         in_queue(int): Number of users in the queue of the counter.
+        version(int): Row version, bumped by every statistics update for optimistic concurrency.
+        status(str): "open", "paused" (takes no users, its queue moved to the open counters) or
+            "draining" (takes no users, serves its queue to the end).
     """
     
     
     __tablename__ = "counters"
     id = Column(Integer, primary_key=True, index=True)
     service_id = Column(Integer, ForeignKey('services.id'), index= True)
-    avg_tat = Column(Integer, default= 0)
-    total_tat = Column(Integer, default= 0)
+    avg_tat = Column(Float, default= 0)
+    total_tat = Column(Float, default= 0)
     users_processed = Column(Integer, default= 0)
     in_queue = Column(Integer, default= 0)
+    version = Column(Integer, nullable=False, default= 1, server_default="1")
+    status = Column(String(16), nullable=False, default="open", server_default="open")
 
     service = relationship("Service", back_populates="counter_rel")
     users = relationship("UserData", back_populates="counter_rel")
-    
-    
-Base.metadata.drop_all(bind=engine)
-Base.metadata.create_all(bind=engine)
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+class OperatorStation(Base):
+    """
+    An operator's desk covering one or more counters, possibly of several services.
+    Attributes:
+        id (int): Primary key.
+        name (str): Unique station name.
+        current_counter (int): Foreign key to the Counter of the user the station is serving, if any.
+        current_user (int): ID of the user the station called and is serving, if any. Not a foreign key,
+            the user's row goes once the user is served.
+    """
+
+
+    __tablename__ = "operator_stations"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(100), unique=True, nullable=False)
+    current_counter = Column(Integer, ForeignKey('counters.id'), nullable=True)
+    current_user = Column(Integer, nullable=True)
+
+    counters = relationship("StationCounter", cascade="all, delete-orphan")
+
+
+class StationCounter(Base):
+    """
+    Binds a counter to an operator station.
+    Attributes:
+        station_id (int): Foreign key to OperatorStation.
+        counter_id (int): Foreign key to Counter.
+    """
+
+
+    __tablename__ = "station_counters"
+    station_id = Column(Integer, ForeignKey('operator_stations.id'), primary_key=True)
+    counter_id = Column(Integer, ForeignKey('counters.id'), primary_key=True, index=True)
+
+
+class Appointment(Base):
+    """
+    A booked time slot of a service, merged into the live queue shortly before it starts.
+    Attributes:
+        id (int): Primary key.
+        name (str): Unique username the user is registered under when merged.
+        hashed_password (str): Hashed user password.
+        service_id (int): Foreign key to Service.
+        slot_start (datetime): Start of the booked slot.
+        priority (int): Priority level the user is queued with, see utils/priority.py.
+        booked_at (datetime): When the slot was booked.
+    """
+
+
+    __tablename__ = "appointments"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(100), unique=True, nullable=False)
+    hashed_password = Column(String(100), nullable=False)
+    service_id = Column(Integer, ForeignKey('services.id'), nullable=False)
+    slot_start = Column(UTCDateTime, nullable=False)
+    priority = Column(Integer, nullable=False, default=0, server_default="0")
+    booked_at = Column(UTCDateTime, nullable=False, default=clock.now)
+
+    __table_args__ = (
+        # the merger reads due appointments, the calendar counts a service's bookings per slot
+        Index("ix_appointments_slot_start", "slot_start"),
+        Index("ix_appointments_service_slot", "service_id", "slot_start"),
+    )
+
+
+class ServedHistory(Base):
+    """
+    Append-only record of a user who was served at a counter.
+    Attributes:
+        id (int): Primary key.
+        user_id (int): ID the user had in user_data.
+        service_id (int): ID of the service the user was served for.
+        counter_id (int): ID of the counter that served the user.
+        registered_at (datetime): When the user joined the queue.
+        arrived_at (datetime): When the user arrived at the branch, if known.
+        service_started_at (datetime): When the counter started serving the user, if known.
+        service_ended_at (datetime): When the user was popped from the queue.
+    """
+
+
+    __tablename__ = "served_history"
+    # no foreign keys: history has to outlive the users, counters and services it refers to
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, nullable=False)
+    service_id = Column(Integer, nullable=False)
+    counter_id = Column(Integer, nullable=False)
+    registered_at = Column(UTCDateTime, nullable=True)
+    arrived_at = Column(UTCDateTime, nullable=True)
+    service_started_at = Column(UTCDateTime, nullable=True)
+    service_ended_at = Column(UTCDateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_served_history_ended", "service_ended_at"),
+        Index("ix_served_history_counter_ended", "counter_id", "service_ended_at"),
+        Index("ix_served_history_service_ended", "service_id", "service_ended_at"),
+    )
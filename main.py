@@ -1,15 +1,28 @@
 from fastapi import FastAPI, Depends
 from fastapi.security import OAuth2PasswordBearer
 from database.db import SessionLocal
+from database.migrations import apply_migrations
 from contextlib import asynccontextmanager
-from utils.helpers import clear_queue
+from utils.helpers import clear_queue, load_counters
+from utils.history import history_writer
+from utils.eta_refresher import eta_refresher
+from utils.distance_client import distance_client
+from utils.queue_view import queue_view
+from utils.event_log import event_log
+from utils.queue_store import queue_store
+from utils.appointments import appointment_merger
+from utils.no_show import no_show_sweeper
+from utils.aging import priority_ager
 from routes.counter_operator import router as operator_router
 from routes.user import router as user_router
 from routes.services_crud import router as services_crud_router
 from routes.get_distance import router as distance_router
+from routes.analytics import router as analytics_router
+from routes.appointments import router as appointments_router
+from routes.stations import router as stations_router
 from auth import verify_access_token
 import os, logging
-from utils.global_settings import setup_logging
+from utils.global_settings import settings, setup_logging
 from dotenv import load_dotenv
 
 setup_logging()
@@ -42,13 +55,37 @@ def check_env():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     check_env()
+    apply_migrations()
     db = SessionLocal()
     try:
         clear_queue(db)
+        load_counters(db)
+        queue_view.invalidate()
     finally:
         # Close the database session after setup
         db.close()
+    history_writer.start()
+    if settings.event_log_enabled:
+        event_log.start()
+        # clear_queue emptied user_data above, replays start over from here
+        event_log.reset()
+    if queue_store.enabled:
+        queue_store.start()
+    eta_refresher.start()
+    appointment_merger.start()
+    no_show_sweeper.start()
+    priority_ager.start()
     yield
+    await priority_ager.stop()
+    await no_show_sweeper.stop()
+    await appointment_merger.stop()
+    await eta_refresher.stop()
+    # write-behind changes go before the event log closes, so both end at the same point
+    await queue_store.stop()
+    # write out any served users still buffered
+    await history_writer.stop()
+    await event_log.stop()
+    await distance_client.aclose()
 
 oauth2_scheme= OAuth2PasswordBearer(tokenUrl= "login")
 
@@ -92,3 +129,6 @@ app.include_router(services_crud_router)
 app.include_router(user_router)
 app.include_router(operator_router)
 app.include_router(distance_router)
+app.include_router(analytics_router)
+app.include_router(appointments_router)
+app.include_router(stations_router)
@@ -0,0 +1,95 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import SQLAlchemyError
+from datetime import datetime, timedelta
+from database.db import get_db
+from schema.analytics_models import CounterStats, ServiceStats, HourlyStats
+from utils.analytics import served_history_arrays, service_report
+from utils.clock import as_utc, clock
+import logging
+from status import StatusCode, StatusResponse
+from utils.global_settings import setup_logging
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix="/analytics",
+    tags=["analytics"]
+)
+
+def _report(db: Session, group_by: str, start: datetime, end: datetime, counter_id: int = None, service_id: int = None):
+    """
+    Refresh the in-memory history and summarize the selected window.
+
+    Raises:
+        HTTPException:
+            - If the window is empty or reversed (400).
+            - If the history can not be loaded (500).
+    """
+    # timestamps are recorded in UTC, a window without a time zone is taken as UTC too
+    end = as_utc(end) or clock.now()
+    start = as_utc(start) or end - timedelta(days=1)
+    if start >= end:
+        raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
+    try:
+        served_history_arrays.refresh(db)
+    except SQLAlchemyError as e:
+        logging.error(f"loading served history failed: {str(e)}")
+        raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+    mask = served_history_arrays.select(start, end, counter_id=counter_id, service_id=service_id)
+    return service_report(served_history_arrays, mask, group_by, (end - start).total_seconds() / 3600)
+
+@router.get("/counters", response_model=StatusResponse)
+async def counter_analytics(start: datetime = None, end: datetime = None, service_id: int = None, counter_id: int = None, db: Session = Depends(get_db)):
+    """
+    Throughput, service times and wait times per counter.
+
+    Args:
+        start (datetime, optional): Start of the window. Defaults to 24 hours before end.
+        end (datetime, optional): End of the window (exclusive). Defaults to now.
+        service_id (int, optional): Only include counters of this service.
+        counter_id (int, optional): Only include this counter.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A list of CounterStats, times in seconds.
+    """
+    report = _report(db, "counter", start, end, counter_id=counter_id, service_id=service_id)
+    return StatusResponse(status_code=StatusCode.OK.value, status_message=StatusCode.OK.message, data=[CounterStats(**entry) for entry in report])
+
+@router.get("/services", response_model=StatusResponse)
+async def service_analytics(start: datetime = None, end: datetime = None, service_id: int = None, db: Session = Depends(get_db)):
+    """
+    Throughput, service times and wait times per service.
+
+    Args:
+        start (datetime, optional): Start of the window. Defaults to 24 hours before end.
+        end (datetime, optional): End of the window (exclusive). Defaults to now.
+        service_id (int, optional): Only include this service.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A list of ServiceStats, times in seconds.
+    """
+    report = _report(db, "service", start, end, service_id=service_id)
+    return StatusResponse(status_code=StatusCode.OK.value, status_message=StatusCode.OK.message, data=[ServiceStats(**entry) for entry in report])
+
+@router.get("/hourly", response_model=StatusResponse)
+async def hourly_analytics(start: datetime = None, end: datetime = None, service_id: int = None, counter_id: int = None, db: Session = Depends(get_db)):
+    """
+    Throughput, service times and wait times per hour, e.g. the p90 wait at counter 3
+    between 11:00 and 13:00 last week.
+
+    Args:
+        start (datetime, optional): Start of the window. Defaults to 24 hours before end.
+        end (datetime, optional): End of the window (exclusive). Defaults to now.
+        service_id (int, optional): Only include this service.
+        counter_id (int, optional): Only include this counter.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A list of HourlyStats, times in seconds.
+    """
+    report = _report(db, "hour", start, end, counter_id=counter_id, service_id=service_id)
+    return StatusResponse(status_code=StatusCode.OK.value, status_message=StatusCode.OK.message, data=[HourlyStats(**entry) for entry in report])
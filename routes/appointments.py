@@ -0,0 +1,129 @@
+from datetime import datetime
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from database.db import get_db
+from database.models import Appointment, UserData
+from schema.appointment_models import BookAppointmentRequest, AppointmentResponse, FreeSlotResponse
+from utils.appointments import appointment_calendar
+from utils.priority import priority_level
+from auth import hash_password
+from status import StatusCode, StatusResponse
+from utils.global_settings import settings, setup_logging
+import logging
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+router = APIRouter(
+    prefix="/appointments",
+    tags=["appointments"]
+)
+
+@router.get("/next_free", response_model=StatusResponse)
+async def get_next_free_slot(service_id: int, after: Optional[datetime] = None, db: Session = Depends(get_db)):
+    """
+    Find the first slot of a service that can still be booked.
+
+    Args:
+        service_id (int): The ID of the service.
+        after (datetime, optional): Earliest acceptable slot start. Defaults to now.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A response object containing the slot start and the bookings it still takes.
+
+    Raises:
+        HTTPException: If the service does not exist (400) or no slot is free within the booking horizon (404).
+    """
+    if service_id not in settings.counters:
+        raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
+    free = appointment_calendar.next_free(db, service_id, after)
+    if free is None:
+        raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+    slot_start, remaining = free
+    return StatusResponse(status_code=StatusCode.OK.value, status_message=StatusCode.OK.message,
+                          data=FreeSlotResponse(service_id=service_id, slot_start=slot_start, remaining=remaining))
+
+@router.post("", response_model=StatusResponse)
+async def book_appointment(request: BookAppointmentRequest, db: Session = Depends(get_db)):
+    """
+    Book the first free slot of a service.
+
+    The user is not queued yet: shortly before the slot starts, the appointment merger
+    registers the user under the booked name and places it in the live queue.
+
+    Args:
+        request (BookAppointmentRequest): A request object containing the user's name, password,
+                                          service ID, earliest slot start and priority class.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A response object containing the booked appointment.
+
+    Raises:
+        HTTPException: If the request is invalid or the service does not exist (400), if the
+                        name is taken or no slot is free within the booking horizon (409),
+                        or if there is an internal server error (500).
+    """
+    if not request.name or not request.password or request.service_id not in settings.counters:
+        raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
+
+    # the name becomes the user name once merged, so it must be free in both tables
+    name_taken = (
+        db.query(UserData.id).filter(UserData.name == request.name).first()
+        or db.query(Appointment.id).filter(Appointment.name == request.name).first()
+    )
+    if name_taken:
+        raise HTTPException(status_code=StatusCode.CONFLICT.value, detail=StatusCode.CONFLICT.message)
+
+    slot_start = appointment_calendar.reserve(db, request.service_id, request.after)
+    if slot_start is None:
+        raise HTTPException(status_code=StatusCode.CONFLICT.value, detail=StatusCode.CONFLICT.message)
+
+    appointment = Appointment(name=request.name, hashed_password=hash_password(request.password), service_id=request.service_id,
+                              slot_start=slot_start, priority=priority_level(request.priority))
+    try:
+        db.add(appointment)
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        appointment_calendar.release(request.service_id, slot_start)
+        logging.error(f"book_appointment failed: {str(e)}")
+        raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+    logging.info(f"booked {request.name} on service {request.service_id} at {slot_start}")
+
+    booked = AppointmentResponse(id=appointment.id, name=appointment.name, service_id=appointment.service_id, slot_start=slot_start)
+    return StatusResponse(status_code=StatusCode.CREATED.value, status_message=StatusCode.CREATED.message, data=booked)
+
+@router.delete("/{appointment_id}", response_model=StatusResponse)
+async def cancel_appointment(appointment_id: int, db: Session = Depends(get_db)):
+    """
+    Cancel an appointment that has not been merged into the live queue yet.
+
+    Args:
+        appointment_id (int): The ID of the appointment.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A response object containing the cancelled appointment.
+
+    Raises:
+        HTTPException: If the appointment is not found (404) or if there is an internal server error (500).
+    """
+    appointment = db.query(Appointment).filter(Appointment.id == appointment_id).first()
+    if not appointment:
+        raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+    cancelled = AppointmentResponse(id=appointment.id, name=appointment.name, service_id=appointment.service_id,
+                                    slot_start=appointment.slot_start)
+    try:
+        db.delete(appointment)
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        logging.error(f"cancel_appointment failed: {str(e)}")
+        raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+    appointment_calendar.release(cancelled.service_id, cancelled.slot_start)
+    return StatusResponse(status_code=StatusCode.OK.value, status_message=StatusCode.OK.message, data=cancelled)
@@ -1,10 +1,19 @@
-from utils.helpers import rebalance_q
+from utils.helpers import rebalance_q, adjust_counter_load, update_counter_stats, start_service, move_to_rank, remove_ranked, migrate_users, apply_migration
+from utils.clock import clock, duration_s
+from utils.locks import counter_locks, service_queue_lock
+from utils.history import history_writer
+from utils.assignment import counter_assignment
+from utils.queue_view import queue_view
+from utils.event_log import event_log
+from utils.queue_store import queue_store
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import update
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
-from schema.operator_models import SelectQueue, UserDataResponse
+from schema.operator_models import SelectQueue, UserDataResponse, SnapshotResponse, ChangesResponse, SkipRequest, SkipResponse, CounterStatusResponse
 from database.db import get_db
 from database.models import Service, UserData, Counter
-import time, logging
+import logging
 from status import StatusCode, StatusResponse
 from utils.global_settings import settings, setup_logging
 
@@ -98,12 +107,102 @@ async def get_queue(counter_id:int, db:Session = Depends(get_db)):
         logging.debug(f"Failed get_queue(): {str(e)}")
         raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
 
+@router.get("/queue/service/{service_id}")
+async def get_service_queue(service_id: int, db: Session = Depends(get_db)):
+    """
+    Retrieve the shared queue of a service in the shared queue mode.
+
+    Args:
+        service_id (int): The ID of the service.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        The waiting users of the service in queue order.
+
+    Raises:
+        HTTPException:
+            - If the service is not found (404).
+    """
+    if db.query(Service.id).filter(Service.id == service_id).first() is None:
+        raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+    return (
+        db.query(UserData)
+        .filter(UserData.service_id == service_id, UserData.counter.is_(None))
+        .order_by(UserData.pos)
+        .all()
+    )
+
+@router.get("/snapshot", response_model=StatusResponse)
+async def get_snapshot(db: Session = Depends(get_db)):
+    """
+    Retrieve every service with its counters, queue lengths and heads of queue.
+
+    The snapshot is served from the in-memory queue view: only services changed since
+    the last call are reloaded, in at most three queries, so dashboards can poll it
+    instead of calling get_services, get_counter and get_queue per service and counter.
+
+    Args:
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A response object containing a SnapshotResponse.
+
+    Raises:
+        HTTPException:
+            - If the view can not be reloaded (500).
+    """
+    try:
+        snapshot = queue_view.snapshot(db)
+    except SQLAlchemyError as e:
+        logging.error(f"get_snapshot failed: {str(e)}")
+        raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+    return StatusResponse(status_code=StatusCode.OK.value, status_message=StatusCode.OK.message, data=SnapshotResponse(**snapshot))
+
+@router.get("/changes", response_model=StatusResponse)
+async def get_changes(since: int, db: Session = Depends(get_db)):
+    """
+    Retrieve the queue entries changed after a view version.
+
+    Clients keep the version of their last snapshot or changes response and poll with it.
+    Every registration, pop, ETA update, rebalance move and service change bumps the version.
+
+    Args:
+        since (int): The version the client is at.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A response object containing a ChangesResponse. When the changes
+            after `since` are no longer in the ring buffer, or `since` comes from another
+            process, it carries a full snapshot instead.
+
+    Raises:
+        HTTPException:
+            - If the version is negative (400).
+            - If the view can not be reloaded (500).
+    """
+    if since < 0:
+        raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
+    try:
+        changes = queue_view.changes(db, since)
+        if changes is None:
+            logging.debug(f"changes since version {since} are not retained, sending a snapshot")
+            snapshot = queue_view.snapshot(db)
+            response = ChangesResponse(version=snapshot["version"], snapshot=SnapshotResponse(**snapshot))
+        else:
+            response = ChangesResponse(version=queue_view.version, changes=changes)
+    except SQLAlchemyError as e:
+        logging.error(f"get_changes failed: {str(e)}")
+        raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+    return StatusResponse(status_code=StatusCode.OK.value, status_message=StatusCode.OK.message, data=response)
+
 @router.post("/queue/next")
 async def pop_next_user_from_queue(request: SelectQueue, db: Session= Depends(get_db)):
     """
     Pop the next user from the queue for a specific service and counter.
 
     This endpoint removes the next user from the queue for a specific service and counter.
+    For a service in the shared queue mode it finishes the counter's current user and calls
+    the head of the service's queue to the counter instead, see serve_from_shared_queue.
 
     Args:
         request (SelectQueue): A request object containing the service ID and counter.
@@ -118,66 +217,434 @@ async def pop_next_user_from_queue(request: SelectQueue, db: Session= Depends(ge
             - If there's an error during the retrieval process (500).
             - If the queue is empty (404).
     """    
-    # finding the user at position 1
+    return await pop_user(request, db)
+
+
+async def pop_user(request: SelectQueue, db: Session, user_id: int = None):
+    """
+    Pop the head of a counter's queue, or with `user_id` finish exactly that user of the counter.
+
+    A station finishes the user it called, who is not necessarily the head any more once
+    a higher ranked user joined or the queue was re-sorted, see routes.stations.
+
+    Args:
+        request (SelectQueue): The service and the counter.
+        db (Session): A database session.
+        user_id (int, optional): The user to finish, wherever it is in the counter's queue.
+            Only for services with per-counter queues.
+
+    Returns:
+        StatusResponse: A response object indicating the success or failure of the operation.
+
+    Raises:
+        HTTPException: As pop_next_user_from_queue; 404 also if the user is not in the counter's queue.
+    """
+    service = db.query(Service).filter(Service.id == request.service_id).first()
+    if not service:
+        logging.error(f"Error while popping user, service not found")
+        db.rollback()
+        raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+
+    if service.queue_mode == "shared":
+        await serve_from_shared_queue(request, db)
+        return StatusResponse(status_code=StatusCode.OK.value,status_message=StatusCode.OK.message)
+    if queue_store.enabled and user_id is None:
+        await pop_from_store(request, db)
+        await rebalance_q(request.service_id, db)
+        return StatusResponse(status_code=StatusCode.OK.value,status_message=StatusCode.OK.message)
+
+    # only pops on this counter are serialized, other counters keep running
+    async with counter_locks(request.counter):
+        # the user is looked up in the database, a write-behind copy must be written first
+        queue_store.release(request.counter)
+        # finding the user at position 1, or the given user
+        in_queue = db.query(UserData).filter(UserData.service_id == request.service_id, UserData.counter == request.counter)
+        if user_id is not None:
+            in_queue = in_queue.filter(UserData.id == user_id)
+        first_user = in_queue.order_by(UserData.pos).first()
+        if not first_user:
+            raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+
+        # archive the served user instead of losing its history with the delete
+        service_ended_at = clock.now()
+        served = dict(
+            user_id=first_user.id,
+            service_id=first_user.service_id,
+            counter_id=first_user.counter,
+            registered_at=first_user.registered_at,
+            arrived_at=first_user.arrived_at,
+            service_started_at=first_user.service_started_at,
+            service_ended_at=service_ended_at,
+        )
+        # None when the service was never started, the counter statistics are then left alone
+        served_time = duration_s(first_user.service_started_at, service_ended_at)
+        # add the user processing time to the counters statistics in one atomic update
+        if not update_counter_stats(db, request.counter, in_queue_delta=-1, served_time=served_time):
+            db.rollback()
+            raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+        # deleting the first user, the users behind it move up and stay in rank order
+        remove_ranked(db, first_user)
+        try:
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logging.debug(f"pop_next_user_from_queue failed because: {str(e)} ")
+            raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+        adjust_counter_load(request.service_id, request.counter, -1) # decrementing the number of users in the counters dictionary 
+        if served_time is not None:
+            counter_assignment.record_service(request.service_id, request.counter, served_time)
+        history_writer.add(**served)
+        event_log.pop(served["user_id"], request.service_id, request.counter)
+        queue_view.remove(request.service_id, served["user_id"], served_time=served_time)
+        logging.debug(f"popped user {served['user_id']}, from counter {request.counter}")
+
+        next_user = db.query(UserData).filter(UserData.counter == request.counter, UserData.pos == 1).first()
+        if next_user:
+            settings.is_empty = False
+        # the next user may have arrived already and starts being served now
+        if next_user and next_user.ETA == 0:
+            start_service(next_user)
+        db.commit()
+        logging.debug(f"Rescheduled counter {request.counter}, next user: {next_user.id if next_user else None}")
+
+    # rebalancing takes its own counter locks, so it must run after ours is released
+    await rebalance_q(request.service_id, db)
+
+    return StatusResponse(status_code=StatusCode.OK.value,status_message=StatusCode.OK.message)
+
+
+@router.post("/queue/skip", response_model=StatusResponse)
+async def skip_head_of_queue(request: SkipRequest, db: Session = Depends(get_db)):
+    """
+    Move the head of a counter's queue back, for a user who is not at the counter.
+
+    With `places` the user goes behind that many users, with `minutes` it is held back as
+    if it arrived that much later. The hold-back is kept in the user's skip_offset, so the
+    user keeps its place through later re-sorts; it is never moved behind a lower priority
+    class. Only the users it passes are renumbered, see helpers.move_to_rank.
+
+    Every skip counts, and a user skipped more than settings.max_skip_count times is
+    evicted instead of moved.
+
+    Args:
+        request (SkipRequest): A request object containing the service ID, the counter and how far to move the head.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A response object containing the user's new position and skip count, or that it was evicted.
+
+    Raises:
+        HTTPException:
+            - If the service is in the shared queue mode, whose users wait without a counter (400).
+            - If the service is not found or the queue is empty (404).
+            - If the changes can not be saved (500).
+    """
     service = db.query(Service).filter(Service.id == request.service_id).first()
-    if service:
-        users = (
+    if not service:
+        raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+    if service.queue_mode == "shared":
+        raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
+
+    async with counter_locks(request.counter):
+        # the queue is changed in the database, a write-behind copy must not overwrite it
+        queue_store.release(request.counter)
+        head = (
             db.query(UserData)
             .filter(UserData.service_id == request.service_id, UserData.counter == request.counter)
             .order_by(UserData.pos)
-            .all()
-        )
-        if not users:
-            raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
-        _q = (
-            db.query(Counter)
-            .filter(Counter.id == request.counter)
             .first()
         )
-        first_user = users[0]
-        if first_user:
-            # deleting the first user 
-            if first_user:
-                _q.in_queue -=1
-                _q.users_processed +=1
-                # add processing time to the user 
-                first_user.processing_time = time.time() - first_user.processing_time
-                # add the user processing time to the counters total processing time
-                _q.total_tat = _q.total_tat + first_user.processing_time
-                _q.avg_tat = _q.total_tat/ _q.users_processed
-                try:
-                    # db.add()
-                    db.commit()
-                except Exception as e:
-                    db.rollback()
-                    logging.debug(f"pop_next_user_from_queue failed because: {str(e)} ")
-                    raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
-                db.delete(first_user)
-                db.commit()
-                settings.counters[request.service_id][request.counter] -= 1 # decrementing the number of users in the counters dictionary 
-                logging.debug(f"popped user {first_user.id}, from counter {request.counter}")
-            
-                remaining_users = (
+        if not head:
+            raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+
+        head.skip_count += 1
+        skipped = SkipResponse(user_id=head.id, skip_count=head.skip_count, evicted=head.skip_count > settings.max_skip_count)
+        if skipped.evicted:
+            # the users behind the head move up and stay in rank order
+            remove_ranked(db, head)
+            if not update_counter_stats(db, request.counter, in_queue_delta=-1):
+                db.rollback()
+                raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+        else:
+            if request.minutes:
+                head.skip_offset += request.minutes
+            else:
+                places = request.places or settings.skip_default_places
+                target = (
                     db.query(UserData)
-                    .filter(UserData.service_id == request.service_id, UserData.counter == request.counter)
-                    .order_by(UserData.ETA)
-                    .all()
+                    .filter(UserData.counter == request.counter, UserData.pos <= head.pos + places)
+                    .order_by(UserData.pos.desc())
+                    .first()
                 )
-                if remaining_users:
-                    settings.is_empty = False
-                
-                # reassigning indices 
-                for index, user in enumerate(remaining_users, start=1):
-                    user.pos = index
-                db.commit()
-                logging.debug(f"Rescheduled counter {request.counter}, updated Queue: {remaining_users}")
+                # ranked just behind the target: same ETA plus hold-back, later on ties
+                held_eta = target.ETA + target.skip_offset + (head.id < target.id)
+                head.skip_offset = max(head.skip_offset, held_eta - head.ETA)
+            # the user was not served after all
+            head.service_started_at = None
+            skipped.pos = move_to_rank(db, head)
+            skip_offset = head.skip_offset
 
-                rebalance_q(request.service_id, db)
+        next_user = db.query(UserData).filter(UserData.counter == request.counter).order_by(UserData.pos).first()
+        if next_user is not None and next_user.ETA == 0:
+            start_service(next_user)
+        try:
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            logging.error(f"skip_head_of_queue failed for counter {request.counter}: {str(e)}")
+            raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+        if skipped.evicted:
+            adjust_counter_load(request.service_id, request.counter, -1)
+            event_log.pop(skipped.user_id, request.service_id, request.counter)
+            queue_view.remove(request.service_id, skipped.user_id)
+        else:
+            # a move within the counter, so a replay ranks the user with its hold-back
+            event_log.move(skipped.user_id, request.service_id, request.counter, skip_offset)
+            queue_view.move(request.service_id, skipped.user_id, request.counter, skipped.pos)
+        logging.debug(f"skipped user {skipped.user_id} at counter {request.counter}: {skipped}")
 
-                return StatusResponse(status_code=StatusCode.OK.value,status_message=StatusCode.OK.message)
-            else:
-                raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
-    else: 
-        logging.error(f"Error while popping user, service not found")
-        db.rollback()
+    if skipped.evicted:
+        # rebalancing takes its own counter locks, so it must run after ours is released
+        await rebalance_q(request.service_id, db)
+    return StatusResponse(status_code=StatusCode.OK.value, status_message=StatusCode.OK.message, data=skipped)
+
+
+@router.post("/counter/pause", response_model=StatusResponse)
+async def pause_counter(request: SelectQueue, db: Session = Depends(get_db)):
+    """
+    Close a counter temporarily and move its waiting users to the service's open counters.
+
+    The users are redistributed with one bulk assignment pass over the open counters'
+    loads and committed in one transaction, see helpers.migrate_users. A user whose
+    service has already started stays, to be finished with /operator/queue/next.
+
+    Args:
+        request (SelectQueue): A request object containing the service ID and the counter.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A response object containing the counter's status and the number of users moved.
+
+    Raises:
+        HTTPException:
+            - If users are waiting and no other counter of the service is open (400).
+            - If the counter does not belong to the service (404).
+            - If the changes can not be saved (500).
+    """
+    return await set_counter_status(request, "paused", db)
+
+
+@router.post("/counter/drain", response_model=StatusResponse)
+async def drain_counter(request: SelectQueue, db: Session = Depends(get_db)):
+    """
+    Stop assigning users to a counter; the users already in its queue are still served.
+
+    Args:
+        request (SelectQueue): A request object containing the service ID and the counter.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A response object containing the counter's status.
+
+    Raises:
+        HTTPException:
+            - If the counter does not belong to the service (404).
+            - If the changes can not be saved (500).
+    """
+    return await set_counter_status(request, "draining", db)
+
+
+@router.post("/counter/resume", response_model=StatusResponse)
+async def resume_counter(request: SelectQueue, db: Session = Depends(get_db)):
+    """
+    Open a paused or draining counter for new users again.
+
+    Args:
+        request (SelectQueue): A request object containing the service ID and the counter.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A response object containing the counter's status.
+
+    Raises:
+        HTTPException:
+            - If the counter does not belong to the service (404).
+            - If the changes can not be saved (500).
+    """
+    response = await set_counter_status(request, "open", db)
+    # the reopened counter is the shortest queue, let it take a user from the longest one
+    await rebalance_q(request.service_id, db)
+    return response
+
+
+async def set_counter_status(request: SelectQueue, status: str, db: Session):
+    """
+    Change a counter's status, moving its waiting users away when it is paused.
+
+    Args:
+        request (SelectQueue): The service and the counter.
+        status (str): "open", "paused" or "draining".
+        db (Session): A database session.
+
+    Returns:
+        StatusResponse: A response object containing a CounterStatusResponse.
+
+    Raises:
+        HTTPException: See pause_counter.
+    """
+    counter = db.query(Counter.service_id).filter(Counter.id == request.counter).first()
+    if counter is None or counter.service_id != request.service_id:
+        raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+    # in the shared queue mode users wait without a counter, there is nothing to move
+    migrate = status == "paused" and not counter_assignment.is_shared(request.service_id)
+    targets = [counter_id for counter_id in counter_assignment.open_loads(request.service_id) if counter_id != request.counter] if migrate else []
+
+    async with counter_locks(request.counter, *targets):
+        moves = []
+        try:
+            if migrate:
+                # the queues are changed in the database, write-behind copies must not overwrite them
+                queue_store.release(request.counter, *targets)
+                moves = migrate_users(db, request.service_id, [request.counter], targets, keep_started=True)
+            # a plain UPDATE, the statistics updates of the migration bumped the row version already
+            db.execute(
+                update(Counter).where(Counter.id == request.counter).values(status=status, version=Counter.version + 1),
+                execution_options={"synchronize_session": False}
+            )
+            db.commit()
+        except HTTPException:
+            db.rollback()
+            raise
+        except SQLAlchemyError as e:
+            db.rollback()
+            logging.error(f"set_counter_status failed for counter {request.counter}: {str(e)}")
+            raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+        counter_assignment.set_counter_status(request.service_id, request.counter, status)
+        apply_migration(request.service_id, moves)
+        queue_view.touch(request.service_id)
+    logging.info(f"counter {request.counter} of service {request.service_id} is {status}, {len(moves)} users moved")
+    return StatusResponse(status_code=StatusCode.OK.value, status_message=StatusCode.OK.message,
+                          data=CounterStatusResponse(counter=request.counter, status=status, moved=len(moves)))
+
+
+async def pop_from_store(request: SelectQueue, db: Session):
+    """
+    Pop the head of a counter's queue in the write-behind persistence mode.
+
+    The queue is changed in memory only; utils.queue_store writes the deletion, the new
+    positions and the counter statistics with its next flush.
+
+    Args:
+        request (SelectQueue): The service and the counter.
+        db (Session): A database session, used only if the counter's queue is not loaded yet.
+
+    Raises:
+        HTTPException:
+            - If the queue is empty or the counter does not belong to the service (404).
+    """
+    async with counter_locks(request.counter):
+        users = queue_store.queue(db, request.counter)
+        if not users or users[0]["service_id"] != request.service_id:
+            raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+        served = queue_store.pop(db, request.counter)
+        served_time = served.pop("served_time")
+        adjust_counter_load(request.service_id, request.counter, -1)
+        if served_time is not None:
+            counter_assignment.record_service(request.service_id, request.counter, served_time)
+        history_writer.add(**served)
+        event_log.pop(served["user_id"], request.service_id, request.counter)
+        queue_view.remove(request.service_id, served["user_id"], served_time=served_time)
+        logging.debug(f"popped user {served['user_id']} from counter {request.counter} in memory")
+    await queue_store.acknowledge()
+
+
+async def serve_from_shared_queue(request: SelectQueue, db: Session):
+    """
+    Finish the user served at a counter and call the head of the service's shared queue.
+
+    In the shared queue mode a user waits without a counter; the first counter to free up
+    takes the head of the queue. The remaining users keep their ETA order and all move up
+    one place with a single UPDATE, so there is no re-sorting and no rebalancing.
+
+    Args:
+        request (SelectQueue): The service and the counter that is free.
+        db (Session): A database session.
+
+    Raises:
+        HTTPException:
+            - If the counter does not belong to the service, or it is idle and the queue is empty (404).
+            - If the changes can not be saved (500).
+    """
+    counter = db.query(Counter.service_id).filter(Counter.id == request.counter).first()
+    if counter is None or counter.service_id != request.service_id:
         raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+
+    # the shared queue lock is always taken before a counter lock
+    async with service_queue_lock(request.service_id):
+        async with counter_locks(request.counter):
+            current_user = db.query(UserData).filter(UserData.counter == request.counter).first()
+            next_user = None
+            # a paused or draining counter finishes its user but calls nobody
+            if counter_assignment.is_open(request.counter):
+                next_user = (
+                    db.query(UserData)
+                    .filter(UserData.service_id == request.service_id, UserData.counter.is_(None))
+                    .order_by(UserData.pos)
+                    .with_for_update()
+                    .first()
+                )
+            if current_user is None and next_user is None:
+                raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+
+            now = clock.now()
+            served = served_time = None
+            if current_user is not None:
+                served = dict(
+                    user_id=current_user.id,
+                    service_id=current_user.service_id,
+                    counter_id=request.counter,
+                    registered_at=current_user.registered_at,
+                    arrived_at=current_user.arrived_at,
+                    service_started_at=current_user.service_started_at,
+                    service_ended_at=now,
+                )
+                served_time = duration_s(current_user.service_started_at, now)
+                db.delete(current_user)
+            if next_user is not None:
+                next_user.counter = request.counter
+                next_user.pos = 1
+                if next_user.ETA == 0:
+                    # an arrived user is served right away, others once update_eta reports their arrival
+                    start_service(next_user)
+                db.flush()
+                db.execute(
+                    update(UserData)
+                    .where(UserData.service_id == request.service_id, UserData.counter.is_(None))
+                    .values(pos=UserData.pos - 1)
+                )
+
+            in_queue_delta = (next_user is not None) - (current_user is not None)
+            if not update_counter_stats(db, request.counter, in_queue_delta=in_queue_delta, served_time=served_time):
+                db.rollback()
+                raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+            try:
+                db.commit()
+            except SQLAlchemyError as e:
+                db.rollback()
+                logging.error(f"serve_from_shared_queue failed for counter {request.counter}: {str(e)}")
+                raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+
+            adjust_counter_load(request.service_id, request.counter, in_queue_delta)
+            if served is not None:
+                event_log.pop(served["user_id"], request.service_id, request.counter)
+                queue_view.remove(request.service_id, served["user_id"], served_time=served_time)
+            if next_user is not None:
+                event_log.move(next_user.id, request.service_id, request.counter, next_user.skip_offset)
+                queue_view.move(request.service_id, next_user.id, request.counter, 1)
+    if served_time is not None:
+        counter_assignment.record_service(request.service_id, request.counter, served_time)
+    if served is not None:
+        history_writer.add(**served)
+        logging.debug(f"served user {served['user_id']} at counter {request.counter}")
+    if next_user is not None:
+        logging.debug(f"called user {next_user.id} from the shared queue of service {request.service_id} to counter {request.counter}")
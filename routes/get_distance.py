@@ -1,14 +1,19 @@
-import time
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from database.db import get_db
 from database.models import UserData#, Counter
-import re, httpx, logging
+import logging
 from dotenv import load_dotenv
 from schema.distance_models import UpdateEtaReaquest, UpdateUserResponse
-from utils.helpers import is_here
-from utils.global_settings import setup_logging, DISTANCEMATRIX_API_KEY, Q_SOLUTIONS_COORDS
-from status import StatusCode, StatusResponse, map_http_status_to_enum
+from utils.helpers import get_ETA, move_to_rank, start_service, COUNTER_UPDATE_RETRIES
+from utils.clock import clock
+from utils.distance_client import is_within_geofence
+from utils.locks import counter_locks, service_queue_lock
+from utils.queue_view import queue_view
+from utils.event_log import event_log
+from utils.queue_store import queue_store
+from utils.global_settings import setup_logging
+from status import StatusCode, StatusResponse
 from sqlalchemy.exc import SQLAlchemyError
 
 load_dotenv()
@@ -28,6 +33,7 @@ async def update_eta(request: UpdateEtaReaquest, db: Session = Depends(get_db)):
     Update the ETA (Estimated Time of Arrival) for a user.
 
     This endpoint calculates the ETA based on the user's current location and updates it in the database.
+    A user inside the branch's geofence is marked as arrived (ETA 0) without calling the distance API.
 
     Args:
         request (UpdateEtaRequest): A request object containing the user ID and current location.
@@ -39,54 +45,17 @@ async def update_eta(request: UpdateEtaReaquest, db: Session = Depends(get_db)):
     Raises:
         HTTPException:
             - If the user is not found (404).
-            - If there's an error during the ETA calculation or update process (500).
+            - If the ETA update can not be saved (400).
+            - If the user keeps being moved between queues while it is updated (409).
     """
-    try:
-        response = httpx.get(
-            "https://api.distancematrix.ai/maps/api/distancematrix/json",
-            params={
-                "origins": f"{request.location.latitude},{request.location.longitude}",
-                "destinations": f"{Q_SOLUTIONS_COORDS[0]},{Q_SOLUTIONS_COORDS[1]}",
-                "key": DISTANCEMATRIX_API_KEY
-            }
-        )
-        response.raise_for_status()  # Raises an HTTPStatusError for bad responses
-
-        data = response.json()
-
-    except httpx.HTTPStatusError as http_err:
-        logging.debug(f"HTTP error occurred: {http_err}")
-        mapped_status = map_http_status_to_enum(http_err.response.status_code)
-        raise HTTPException(status_code=mapped_status.code, detail=http_err.response.text)
-    
-    except httpx.RequestError as req_err:
-        logging.debug(f"Request error occurred: {req_err}")
-        raise HTTPException(status_code=StatusCode.SERVICE_UNAVAILABLE.code, detail=StatusCode.SERVICE_UNAVAILABLE.message)
-    
-    except ValueError as json_err:
-        logging.debug(f"JSON decoding error: {json_err}")
-        raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.code, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
-
-    except Exception as e:
-        logging.debug(f"Unexpected error: {str(e)}")
-        raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.code, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
-
-    if "rows" in data and data["rows"]:
-        # distance = data["rows"][0]["elements"][0]["distance"]["text"]
-        duration_str = data["rows"][0]["elements"][0]["duration"]["text"]
-        
-        # Extract the integer value from the duration string (e.g., "15 mins" -> 15)
-        duration_match = re.search(r'(?:(\d+)\s*hour[s]?)?\s*(?:(\d+)\s*min[s]?)?', duration_str)
-        if duration_match:
-            hours = int(duration_match.group(1)) if duration_match.group(1) else 0
-            minutes = int(duration_match.group(2)) if duration_match.group(2) else 0
-
-            duration_in_minutes = (hours*60) + minutes
-            logging.debug(f"user {request.userid} has an updated ETA of {duration_in_minutes}")
-            # return duration_in_minutes
-        else:
-            raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
-    # logging.debug(f"---------------------------------out of loop here")
+    if is_within_geofence(request.location):
+        # the user is at the branch already, no need to ask the distance API
+        duration_in_minutes = 0
+        logging.debug(f"user {request.userid} is inside the geofence, marking as arrived")
+    else:
+        # never fails: falls back to the local estimate when the distance API is unavailable
+        duration_in_minutes = await get_ETA(request.location)
+        logging.debug(f"user {request.userid} has an updated ETA of {duration_in_minutes}")
 
     user_to_update = (
         db.query(UserData)
@@ -95,53 +64,73 @@ async def update_eta(request: UpdateEtaReaquest, db: Session = Depends(get_db)):
         )
     # logging.debug(f"user to update = {user_to_update}")
 
-    if user_to_update:
-        logging.debug(f"old ETA for user {request.userid} = {user_to_update.ETA}")
-        user_to_update.ETA = duration_in_minutes
-        logging.debug(f"new ETA for user {request.userid} = {user_to_update.ETA}")
-
-    else:
+    if not user_to_update:
         raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
 
-    db.flush()
-    db.refresh(user_to_update)
-    logging.debug(f"user_to_update.counter = {user_to_update.counter}")
-    
-    users_in_counter = (
-        db.query(UserData)
-        .filter(UserData.counter == user_to_update.counter)
-        .order_by(UserData.ETA)
-        .all()
-    )
-    updated_user = UpdateUserResponse(userid=user_to_update.id, update_eta=user_to_update.ETA)
-    for new_pos, user in enumerate(users_in_counter, start=1):
-        user.pos = new_pos
-    try:
-        db.flush()
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
-
-    get_counter= (
-        db.query(UserData.counter)
-        .filter(UserData.id == request.userid)
-        .first() # or use .scalar() to directly use the value instead of extracting it out of the tuple
-    )
-    counter_id = get_counter[0]
-    if is_here(counter_id=counter_id, db=db) == True:
-        first_user= (
-            db.query(UserData)
-            .filter(UserData.counter == counter_id)
-            .order_by(UserData.pos)
-            .first()
-        )
-        first_user.processing_time = time.time() - first_user.processing_time
-        try:
-            # db.add()
-            db.commit()
-        except SQLAlchemyError as e:
-            db.rollback()
-            logging.debug(f"Can not start processing time for counter no{counter_id} because {str(e)}")
-            raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.message, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
-        
-    return StatusResponse(status_code=StatusCode.OK.value,status_message= StatusCode.OK.message, data=updated_user)
\ No newline at end of file
+    if queue_store.enabled and user_to_update.counter is not None:
+        # write-behind: the counter's queue is re-sorted in memory and written with the next flush
+        async with counter_locks(user_to_update.counter):
+            queued = queue_store.update_eta(db, user_to_update.counter, request.userid, duration_in_minutes,
+                                            request.location.latitude, request.location.longitude)
+        if queued is not None:
+            queue_view.move(user_to_update.service_id, request.userid, user_to_update.counter, queued["pos"], duration_in_minutes)
+            event_log.eta(request.userid, user_to_update.service_id, user_to_update.counter, duration_in_minutes)
+            await queue_store.acknowledge()
+            updated_user = UpdateUserResponse(userid=request.userid, update_eta=duration_in_minutes)
+            return StatusResponse(status_code=StatusCode.OK.value,status_message= StatusCode.OK.message, data=updated_user)
+
+    # the user was read before its queue's lock was held, so a rebalance, a counter pause or a call from
+    # the shared queue may have moved it since: it is read again under the lock, and followed if it moved
+    for attempt in range(COUNTER_UPDATE_RETRIES):
+        counter_id = user_to_update.counter
+        # moving the user renumbers the users it passes, so it shares the queue's lock with pops
+        lock = service_queue_lock(user_to_update.service_id) if counter_id is None else counter_locks(counter_id)
+        async with lock:
+            user_to_update = (
+                db.query(UserData)
+                .filter(UserData.id == request.userid)
+                .populate_existing()
+                .with_for_update()
+                .first()
+            )
+            if not user_to_update:
+                raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+            if user_to_update.counter != counter_id:
+                # releases the row lock before the new queue's lock is taken
+                db.rollback()
+                logging.debug(f"user {request.userid} moved from counter {counter_id} to {user_to_update.counter}, attempt {attempt + 1}")
+                continue
+            if counter_id is not None:
+                # the queue is changed in the database, a write-behind copy must not overwrite it
+                queue_store.release(counter_id)
+
+            logging.debug(f"old ETA for user {request.userid} = {user_to_update.ETA}")
+            if duration_in_minutes == 0 and user_to_update.arrived_at is None:
+                user_to_update.arrived_at = clock.now()
+            user_to_update.ETA = duration_in_minutes
+            user_to_update.eta_updated_at = clock.now()
+            # remembered so the background refresher can keep this ETA fresh
+            user_to_update.latitude = request.location.latitude
+            user_to_update.longitude = request.location.longitude
+            pos = move_to_rank(db, user_to_update)
+            # a shared queue's head is only served once a counter calls it
+            if counter_id is not None:
+                head = user_to_update if pos == 1 else db.query(UserData).filter(UserData.counter == counter_id, UserData.pos == 1).first()
+                if head is not None and head.ETA == 0:
+                    # the arrived user at the head of the queue starts being served now
+                    start_service(head)
+            service_id = user_to_update.service_id
+            updated_user = UpdateUserResponse(userid=request.userid, update_eta=duration_in_minutes)
+            try:
+                db.commit()
+            except SQLAlchemyError as e:
+                db.rollback()
+                logging.error(f"update_eta failed for user {request.userid}: {str(e)}")
+                raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
+            queue_view.move(service_id, request.userid, counter_id, pos, duration_in_minutes)
+            event_log.eta(request.userid, service_id, counter_id, duration_in_minutes)
+        logging.debug(f"new ETA for user {request.userid} = {duration_in_minutes} at position {pos}")
+        return StatusResponse(status_code=StatusCode.OK.value,status_message= StatusCode.OK.message, data=updated_user)
+
+    logging.warning(f"update_eta gave up on user {request.userid} after {COUNTER_UPDATE_RETRIES} moves")
+    raise HTTPException(status_code=StatusCode.CONFLICT.value, detail=StatusCode.CONFLICT.message)
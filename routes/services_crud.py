@@ -1,12 +1,20 @@
 from sqlalchemy.orm import Session
 from fastapi import APIRouter, Depends, HTTPException
-from database.models import UserData, Service, Counter
+from database.models import UserData, Service, Counter, Appointment
 from database.db import get_db
 from schema.services_models import CreateServiceRequest, UpdateServiceRequest, ServiceResponse
 import logging
 from utils.global_settings import settings, setup_logging
 from status import StatusCode, StatusResponse
 from sqlalchemy.exc import SQLAlchemyError
+from utils.helpers import allocate_counters, migrate_users, apply_migration
+from utils.locks import counter_locks, drop_counter_lock, drop_service_queue_lock
+from utils.assignment import counter_assignment
+from utils.queue_view import queue_view
+from utils.queue_store import queue_store
+from utils.appointments import appointment_calendar
+from utils.stations import unbind_counters
+from utils.event_log import event_log, SERVICE_CREATE, SERVICE_UPDATE, SERVICE_DELETE
 
 setup_logging()
 logger = logging.getLogger(__name__)
@@ -22,7 +30,8 @@ async def add_service(request: CreateServiceRequest, db: Session = Depends(get_d
     """
     Create a new service.
 
-    This endpoint creates a new service with the specified name and number of counters.
+    This endpoint creates a new service with the specified name, number of counters, counter assignment strategy
+    and queue mode.
 
     Args:
         request (CreateServiceRequest): A request object containing the service name and number of counters.
@@ -42,46 +51,36 @@ async def add_service(request: CreateServiceRequest, db: Session = Depends(get_d
     if not already_exists:
     
         # Create a new service in the database
-        new_service = Service(name=request.name, no_of_counters=request.no_of_counters)
+        new_service = Service(name=request.name, no_of_counters=request.no_of_counters, assignment_strategy=request.assignment_strategy,
+                              queue_mode=request.queue_mode)
         db.add(new_service)
-        db.flush()  # Commit to assign an ID to new_service
-
-        # for i in range(request.no_of_counters):
-        #     new_counter = Counters(no_of_counters=request.no_of_counters)
-
-        # Re-query the database to fetch the newly created service (to ensure service ID is available)
-        db.refresh(new_service)
-
-        # Initialize counters for the new service
-        service_counters = {}
-        new_counters=[]
-
-        # Use global_counter to assign unique counter numbers across all services
+        db.flush()  # Flush to assign an ID to new_service
 
+        # Counter IDs come from the database so they stay unique across workers and restarts
         try:
-            for _ in range(request.no_of_counters):
-                service_counters[settings.global_counter] = 0  # No users in the counter at start
-                logging.info(f"Assigned counter {settings.global_counter} to service {new_service.name}")
-                new_counter = Counter(id=settings.global_counter, service_id = new_service.id)
-                new_counters.append(new_counter)
-            
-                settings.global_counter += 1  # Increment global counter for the next assignment
-            db.add_all(new_counters)
+            counter_ids = allocate_counters(db, new_service.id, request.no_of_counters)
             db.commit()
         except SQLAlchemyError as e:
             db.rollback()
             logging.error(f"Error occurred while assigning counters: {str(e)}")
             raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
-        # db.refresh(new_counters)
+
+        # No users in the counters at start
+        service_counters = {counter_id: 0 for counter_id in counter_ids}
 
         # Add this service's counters to the global counters dictionary using the service ID
         settings.counters[new_service.id] = service_counters
+        counter_assignment.set_strategy(new_service.id, new_service.assignment_strategy)
+        counter_assignment.set_queue_mode(new_service.id, new_service.queue_mode)
+        queue_view.touch(new_service.id)
+        event_log.service(SERVICE_CREATE, new_service.id, new_service.no_of_counters)
 
         # Log the initialization
         logging.info(f"Initialized counters for service {new_service.name}: {service_counters}")
         logging.info(f"Global counters state after addition: {settings.counters}")
 
-        service_to_return = ServiceResponse(id=new_service.id, name=new_service.name, no_of_counters=new_service.no_of_counters)
+        service_to_return = ServiceResponse(id=new_service.id, name=new_service.name, no_of_counters=new_service.no_of_counters,
+                                            assignment_strategy=new_service.assignment_strategy, queue_mode=new_service.queue_mode)
 
         return StatusResponse(status_code=StatusCode.CREATED.value, status_message=StatusCode.CREATED.message, data=service_to_return)
         
@@ -99,7 +98,12 @@ async def update_service(request: UpdateServiceRequest, db: Session = Depends(ge
     """
     Update service details.
 
-    This endpoint updates the name and/or number of counters for an existing service.
+    This endpoint updates the name, number of counters, assignment strategy and/or queue mode of an existing service.
+
+    The number of counters can be changed while users are queued: the users of removed
+    counters are redistributed over the remaining open counters with one bulk assignment
+    pass, in the same transaction as the resize, see helpers.migrate_users. Paused and
+    draining counters are removed first, then the most recently allocated ones.
 
     Args:
         request (UpdateServiceRequest): A request object containing the service ID, 
@@ -112,49 +116,104 @@ async def update_service(request: UpdateServiceRequest, db: Session = Depends(ge
     Raises:
         HTTPException: 
             - If the service is not found (404).
-            - If there are active users in the service queues (400).
+            - If the queue mode is switched while users are queued (400).
+            - If removed counters have users and no open counter is left to take them,
+              or, in the shared queue mode, are serving a user (400).
             - If there's an error updating the service (500).
     """    
     service = db.query(Service).filter(Service.id == request.service_id).first()
     if not service:
         raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
 
-    # Check for active users in the service queues
-    if db.query(UserData).filter(UserData.service_id == request.service_id).count() > 0:
+    # pops still held in memory by the write-behind store must be written before counting
+    queue_store.release(*settings.counters.get(request.service_id, {}))
+    # the queues of both modes are kept differently, so the mode only changes in an empty service
+    if request.queue_mode and request.queue_mode != service.queue_mode and db.query(UserData).filter(UserData.service_id == request.service_id).count() > 0:
         raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
 
     # Update service name if provided
     if request.name:
         service.name = request.name
 
-    # Update number of counters if provided
+    if request.assignment_strategy:
+        service.assignment_strategy = request.assignment_strategy
+
+    # only switched while the service has no users, checked above
+    if request.queue_mode:
+        service.queue_mode = request.queue_mode
+
+    current_ids = []
     if request.no_of_counters is not None:
-        current_counters = len(settings.counters.get(service.id, {}))
-        if request.no_of_counters > current_counters:
-            for _ in range(current_counters + 1, request.no_of_counters + 1):
-                new_counter = Counter(id=settings.global_counter, service_id=service.id)
-                db.add(new_counter)
-                settings.counters[service.id][settings.global_counter] = 0  # Initialize new counter
-                settings.global_counter += 1
-        else:
-            for i in range(current_counters, request.no_of_counters, -1):
-                if settings.counters[service.id][i] > 0:
-                    raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
-                del settings.counters[service.id][i]
-                db.query(Counter).filter(Counter.id == i).delete()
-
-        service.no_of_counters = request.no_of_counters
-
-    # Commit changes to the database
-    try:
-        db.commit()
-        db.refresh(service)
-    except SQLAlchemyError as e:
-        db.rollback()
-        logging.error(f"Update_service failed because: {str(e)}")
-        raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+        current_counters = (
+            db.query(Counter.id)
+            .filter(Counter.service_id == service.id)
+            .order_by(Counter.id)
+            .all()
+        )
+        current_ids = [counter_id for (counter_id,) in current_counters]
+    kept_ids, removed_ids, moves = current_ids, [], []
+
+    # a resize changes the queues of the service's counters, registrations and pops wait for it
+    async with counter_locks(*current_ids):
+        # Update number of counters if provided
+        if request.no_of_counters is not None:
+            try:
+                if request.no_of_counters > len(current_ids):
+                    kept_ids = current_ids + allocate_counters(db, service.id, request.no_of_counters - len(current_ids))
+                else:
+                    # drop the closed counters first, then the most recently allocated ones
+                    removal_order = sorted(current_ids, key=lambda counter_id: (counter_assignment.is_open(counter_id), -counter_id))
+                    removed_ids = removal_order[:len(current_ids) - request.no_of_counters]
+                    kept_ids = [counter_id for counter_id in current_ids if counter_id not in removed_ids]
+                if removed_ids:
+                    if service.queue_mode == "shared":
+                        # the user a removed counter is serving has no queue to go back to
+                        if db.query(UserData.id).filter(UserData.counter.in_(removed_ids)).first():
+                            raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
+                    else:
+                        # the queues are changed in the database, write-behind copies must not overwrite them
+                        queue_store.release(*current_ids)
+                        open_ids = [counter_id for counter_id in kept_ids if counter_assignment.is_open(counter_id)]
+                        moves = migrate_users(db, service.id, removed_ids, open_ids)
+                    unbind_counters(db, removed_ids)
+                    db.query(Counter).filter(Counter.id.in_(removed_ids)).delete(synchronize_session=False)
+            except HTTPException:
+                db.rollback()
+                raise
+            except SQLAlchemyError as e:
+                db.rollback()
+                logging.error(f"Update_service failed to resize counters: {str(e)}")
+                raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+
+            service.no_of_counters = request.no_of_counters
+
+        # Commit changes to the database
+        try:
+            db.commit()
+            db.refresh(service)
+        except SQLAlchemyError as e:
+            db.rollback()
+            logging.error(f"Update_service failed because: {str(e)}")
+            raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
 
-    service_to_return = ServiceResponse(id=service.id, name=service.name, no_of_counters=service.no_of_counters)
+        if request.no_of_counters is not None:
+            # the remaining counters keep their loads, the moved users are added by apply_migration
+            loads = settings.counters.get(service.id, {})
+            settings.counters[service.id] = {counter_id: loads.get(counter_id, 0) for counter_id in kept_ids}
+            counter_assignment.forget_counters(*removed_ids)
+            apply_migration(service.id, moves)
+            # slot capacities follow the number of counters
+            appointment_calendar.invalidate(service.id)
+            logging.info(f"Global counters state after update: {settings.counters}")
+    for counter_id in removed_ids:
+        drop_counter_lock(counter_id)
+    counter_assignment.set_strategy(service.id, service.assignment_strategy)
+    counter_assignment.set_queue_mode(service.id, service.queue_mode)
+    queue_view.touch(service.id)
+    event_log.service(SERVICE_UPDATE, service.id, service.no_of_counters)
+
+    service_to_return = ServiceResponse(id=service.id, name=service.name, no_of_counters=service.no_of_counters,
+                                        assignment_strategy=service.assignment_strategy, queue_mode=service.queue_mode)
     return StatusResponse(status_code=StatusCode.OK.value, status_message=StatusCode.OK.message, data=service_to_return)
 
     
@@ -177,11 +236,12 @@ async def delete_service(service_id: int, db: Session = Depends(get_db)):
     Raises:
         HTTPException:
             - If the service is not found (404).
-            - If there are active users in the service queues (400).
+            - If there are active users in the service queues or booked appointments (400).
             - If there's an error during the deletion process (500).
     """
     service = db.query(Service).filter(Service.id == service_id).first()
-    to_return = ServiceResponse(id=service.id, name= service.name, no_of_counters=service.no_of_counters)
+    to_return = ServiceResponse(id=service.id, name= service.name, no_of_counters=service.no_of_counters, assignment_strategy=service.assignment_strategy,
+                                queue_mode=service.queue_mode)
     try:
     # Find the service by ID
         counters_to_del = (
@@ -193,26 +253,35 @@ async def delete_service(service_id: int, db: Session = Depends(get_db)):
         if not service:
             raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
 
+        queue_store.release(*settings.counters.get(service_id, {}))
         # Check if there are active users in the service queues before deletion
         active_users = db.query(UserData).filter(UserData.service_id == service_id).count()
+        # booked appointments are users to come
+        active_users += db.query(Appointment).filter(Appointment.service_id == service_id).count()
 
         if active_users > 0:
             logging.debug(f"delete_service failed: there are active users in the service {service_id}")
             raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
         
         # Remove service from global queue
-        del settings.counters[service_id]
+        settings.counters.pop(service_id, None)
+        appointment_calendar.invalidate(service_id)
 
         # Delete the service from DB
         try:
+            unbind_counters(db, [items.id for items in counters_to_del])
             db.delete(service)
             for items in counters_to_del:
                 db.delete(items)
+                drop_counter_lock(items.id)
+            drop_service_queue_lock(service_id)
             db.commit()
         except SQLAlchemyError as e:
             db.rollback()
             logging.error(f"failed delete_service: {str(e)}")
             raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+        queue_view.touch(service_id)
+        event_log.service(SERVICE_DELETE, service_id)
         return StatusResponse(status_code=StatusCode.OK.value,status_message= StatusCode.OK.message, data=to_return)
 
     except Exception as e:
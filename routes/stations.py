@@ -0,0 +1,190 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from database.db import get_db
+from database.models import Counter, Service, UserData, OperatorStation, StationCounter
+from routes.counter_operator import pop_user
+from schema.operator_models import SelectQueue, CreateStationRequest, StationResponse, StationHead, StationNextResponse
+from utils.locks import station_lock, drop_station_lock
+from utils.stations import queue_heads, merge_heads
+from status import StatusCode, StatusResponse
+from utils.global_settings import setup_logging
+import logging
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+router = APIRouter(
+    prefix="/operator/stations",
+    tags=["operator"]
+)
+
+def _station_response(station: OperatorStation):
+    return StationResponse(id=station.id, name=station.name, counters=sorted(bound.counter_id for bound in station.counters),
+                           current_counter=station.current_counter, current_user=station.current_user)
+
+def _get_station(db: Session, station_id: int):
+    station = db.query(OperatorStation).filter(OperatorStation.id == station_id).first()
+    if not station:
+        raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+    return station
+
+@router.post("", response_model=StatusResponse)
+async def create_station(request: CreateStationRequest, db: Session = Depends(get_db)):
+    """
+    Create an operator station covering several counters.
+
+    The counters may belong to different services, which must use per-counter queues. A
+    counter is bound to one station at most, so two stations never call the same head.
+
+    Args:
+        request (CreateStationRequest): A request object containing the station name and its counter IDs.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A response object containing the new station.
+
+    Raises:
+        HTTPException:
+            - If a counter does not exist or belongs to a service in the shared queue mode (400).
+            - If a station with the same name already exists, or a counter is bound to another station (409).
+            - If the station can not be saved (500).
+    """
+    counter_ids = set(request.counters)
+    modes = dict(
+        db.query(Counter.id, Service.queue_mode)
+        .join(Service, Service.id == Counter.service_id)
+        .filter(Counter.id.in_(counter_ids))
+        .all()
+    )
+    # a shared queue is already served by whichever of its counters is free
+    if len(modes) != len(counter_ids) or "shared" in modes.values():
+        raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
+    if (
+        db.query(OperatorStation.id).filter(OperatorStation.name == request.name).first()
+        # each station only locks itself, so stations sharing a counter would both call its head
+        or db.query(StationCounter.counter_id).filter(StationCounter.counter_id.in_(counter_ids)).first()
+    ):
+        raise HTTPException(status_code=StatusCode.CONFLICT.value, detail=StatusCode.CONFLICT.message)
+
+    station = OperatorStation(name=request.name, counters=[StationCounter(counter_id=counter_id) for counter_id in counter_ids])
+    try:
+        db.add(station)
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        logging.error(f"create_station failed: {str(e)}")
+        raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+    logging.info(f"created station {station.name} for counters {sorted(counter_ids)}")
+    return StatusResponse(status_code=StatusCode.CREATED.value, status_message=StatusCode.CREATED.message, data=_station_response(station))
+
+@router.get("/{station_id}", response_model=StatusResponse)
+async def get_station(station_id: int, db: Session = Depends(get_db)):
+    """
+    Retrieve a station and the heads of its counters' queues, best first.
+
+    Args:
+        station_id (int): The ID of the station.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A response object containing the station and the queue heads in the order it would call them.
+
+    Raises:
+        HTTPException: If the station is not found (404).
+    """
+    station = _get_station(db, station_id)
+    heads = [StationHead(user_id=head["id"], service_id=head["service_id"], counter=head["counter"], ETA=head["ETA"],
+                         priority=head["priority"], waited_s=head["waited_s"])
+             for head in merge_heads(queue_heads(db, [bound.counter_id for bound in station.counters]))]
+    return StatusResponse(status_code=StatusCode.OK.value, status_message=StatusCode.OK.message,
+                          data={"station": _station_response(station), "heads": heads})
+
+@router.post("/{station_id}/next", response_model=StatusResponse)
+async def call_next_at_station(station_id: int, db: Session = Depends(get_db)):
+    """
+    Finish the station's current user and call the best head across its counters.
+
+    The user the station called last is finished like with /operator/queue/next, even if
+    it is no longer the head of its counter, e.g. after a higher priority user joined. A
+    user who left the counter meanwhile, popped elsewhere or moved to another counter,
+    is reported as missing and nothing is popped for it. The next user is picked from the heads of all the
+    station's counters by priority, ETA and then the longest wait, with a heap-based
+    k-way merge over the heads: one index read per counter and O(log k) to pick, the
+    queues themselves are not scanned.
+
+    Args:
+        station_id (int): The ID of the station.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A response object containing the finished or missing user and the called user.
+
+    Raises:
+        HTTPException:
+            - If the station is not found (404).
+            - If the changes can not be saved (500).
+    """
+    async with station_lock(station_id):
+        station = _get_station(db, station_id)
+        response = StationNextResponse(station_id=station_id)
+        if station.current_user is not None:
+            called = db.query(UserData.service_id, UserData.counter).filter(UserData.id == station.current_user).first()
+            response.finished_counter = station.current_counter
+            response.finished_user = station.current_user
+            try:
+                if called is None or called.counter != station.current_counter:
+                    raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+                await pop_user(SelectQueue(service_id=called.service_id, counter=called.counter), db, user_id=station.current_user)
+            except HTTPException as e:
+                # served from elsewhere meanwhile, or moved by a rebalance, a resize or a pause
+                if e.status_code != StatusCode.NOT_FOUND.value:
+                    raise
+                logging.warning(f"station {station_id} could not finish user {station.current_user}, it left counter {station.current_counter}")
+                response.finished_counter = response.finished_user = None
+                response.missing_user = station.current_user
+            station = _get_station(db, station_id)
+
+        best = next(merge_heads(queue_heads(db, [bound.counter_id for bound in station.counters])), None)
+        station.current_counter = best["counter"] if best else None
+        station.current_user = best["id"] if best else None
+        try:
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            logging.error(f"call_next_at_station failed for station {station_id}: {str(e)}")
+            raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+
+    if best:
+        response.called = StationHead(user_id=best["id"], service_id=best["service_id"], counter=best["counter"], ETA=best["ETA"],
+                                      priority=best["priority"], waited_s=best["waited_s"])
+        logging.debug(f"station {station_id} called user {best['id']} at counter {best['counter']}")
+    return StatusResponse(status_code=StatusCode.OK.value, status_message=StatusCode.OK.message, data=response)
+
+@router.delete("/{station_id}", response_model=StatusResponse)
+async def delete_station(station_id: int, db: Session = Depends(get_db)):
+    """
+    Delete a station. Its counters and their queues are left as they are.
+
+    Args:
+        station_id (int): The ID of the station.
+        db (Session, optional): A database session. Defaults to Depends(get_db).
+
+    Returns:
+        StatusResponse: A response object containing the deleted station.
+
+    Raises:
+        HTTPException: If the station is not found (404) or can not be deleted (500).
+    """
+    station = _get_station(db, station_id)
+    deleted = _station_response(station)
+    try:
+        db.delete(station)
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        logging.error(f"delete_station failed: {str(e)}")
+        raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+    drop_station_lock(station_id)
+    return StatusResponse(status_code=StatusCode.OK.value, status_message=StatusCode.OK.message, data=deleted)
@@ -1,10 +1,19 @@
 from fastapi import APIRouter, Depends, HTTPException, Depends
+from sqlalchemy import null
 from sqlalchemy.orm import Session
 from database.db import get_db
-from database.models import UserData, Counter
+from database.models import UserData, Counter, Appointment
 from schema.user_models import GenerateTokenRequest, UserLoginRequest, UserResponse
 from utils.global_settings import settings
-from utils.helpers import get_ETA, is_here
+from utils.helpers import provisional_ETA, is_here, adjust_counter_load, update_counter_stats, insert_ranked, start_service
+from utils.clock import clock
+from utils.priority import priority_level
+from utils.eta_refresher import eta_refresher
+from utils.locks import counter_locks, service_queue_lock
+from utils.assignment import counter_assignment
+from utils.queue_view import queue_view
+from utils.event_log import event_log
+from utils.queue_store import queue_store
 import time, logging
 from auth import create_access_token, hash_password, verify_password
 from status import StatusCode, StatusResponse
@@ -26,12 +35,16 @@ async def generate_token(request: GenerateTokenRequest, db: Session = Depends(ge
     """
     Generate a token for a new user.
 
-    This endpoint generates a token for a new user, assigns them to a counter with the fewest users, 
-    and updates the queue positions based on the user's ETA.
+    This endpoint generates a token for a new user, assigns them to a counter chosen by the service's
+    assignment strategy, and updates the queue positions based on the user's priority class and ETA.
+
+    The ETA is answered locally from the travel grid or a straight-line estimate. When it is only an
+    estimate, the background ETA refresher resolves the real one and re-sorts the counter; the new
+    position is visible on the next poll of the queue.
 
     Args:
         request (GenerateTokenRequest): A request object containing the user's name, password, 
-                                        service ID, and location.
+                                        service ID, location and priority class.
         db (Session, optional): A database session. Defaults to Depends(get_db).
 
     Returns:
@@ -49,6 +62,8 @@ async def generate_token(request: GenerateTokenRequest, db: Session = Depends(ge
         db.query(UserData)
         .filter(UserData.name == request.name)
         .first()
+        # booked users get their name once their appointment is merged
+        or db.query(Appointment.id).filter(Appointment.name == request.name).first()
     )
     if existing_user:
         raise HTTPException(status_code=StatusCode.CONFLICT.value, detail= StatusCode.CONFLICT.message)
@@ -62,86 +77,102 @@ async def generate_token(request: GenerateTokenRequest, db: Session = Depends(ge
     if request.service_id not in settings.counters:
         raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
 
-    service_counters = settings.counters[request.service_id]
-    logging.info(f"Service counters for service {request.service_id}: {service_counters}")
+    logging.info(f"Service counters for service {request.service_id}: {settings.counters[request.service_id]}")
 
-    # Find the counter with the fewest users
-    min_queue = min(service_counters.values())
-    shortest_queues = [counter for counter, users in service_counters.items() if users == min_queue]
-    selected_counter = shortest_queues[0]  # Select the first counter with the least number of users
+    # in a shared queue the user gets a counter only when one calls them
+    shared_queue = counter_assignment.is_shared(request.service_id)
+    selected_counter = None
+    if not shared_queue:
+        # the service's assignment strategy picks the counter, least_count by default
+        selected_counter = counter_assignment.select(request.service_id)
+        if selected_counter is None:
+            raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
 
     logging.info(f"Selected counter for user {request.name}: {selected_counter}")
 
+    # registration never waits for the distance API: a provisional ETA is resolved in the background
+    eta, eta_is_final = provisional_ETA(request.location)
+
     # Save the new user to the UserData table
-    new_user = UserData(name=request.name, hashed_password=hashed_password, counter=selected_counter, pos=0, service_id=request.service_id, ETA= get_ETA(request.location))
+    new_user = UserData(name=request.name, hashed_password=hashed_password, counter=selected_counter, pos=0, service_id=request.service_id, ETA=eta,
+                        priority=priority_level(request.priority),
+                        latitude=request.location.latitude, longitude=request.location.longitude,
+                        # NULL marks the ETA as never computed, a plain None would get the column default
+                        eta_updated_at=clock.now() if eta_is_final else null(),
+                        arrived_at=clock.now() if eta_is_final and eta == 0 else None)
 
     try:
-        db.add(new_user)
-        db.flush()  # Commit to generate a valid user ID
-        db.refresh(new_user)  # Refresh the user to fetch the latest state
-        # Update the counters dictionary to reflect the newly added user
-        settings.counters[request.service_id][selected_counter] += 1
-        logging.debug(f"Adding the new user {request.name} we have: {settings.counters}")
-
-        # Update queue position based on ETA
-        # Fetch all users in the selected counter, sorted by ETA
-        users_in_counter = (
-            db.query(UserData)
-            .filter(UserData.service_id == request.service_id, UserData.counter == selected_counter)
-            .order_by(UserData.ETA)
-            .all()
-        )
-
-        # Recalculate positions based on ETA
-        for index, user in enumerate(users_in_counter, start=1):
-            user.pos = index
-
-        db.flush()  # Commit changes to save the updated positions
-
-        if is_here(counter_id=selected_counter, db=db) == True:
-            first_user= (
-                db.query(UserData)
-                .filter(UserData.counter == selected_counter)
-                .order_by(UserData.pos)
-                .first()
-            )
-            if first_user:
-                first_user.processing_time = time.time() - first_user.processing_time
+        if shared_queue:
+            async with service_queue_lock(request.service_id):
+                insert_ranked(db, new_user)
+                db.commit()
+            logging.info(f"Adding the new user {request.name} to the shared queue of service {request.service_id}")
+        elif queue_store.enabled:
+            # write-behind: only the new row is written now, positions and statistics follow with the next flush
+            async with counter_locks(selected_counter):
+                queue_store.queue(db, selected_counter)
+                db.add(new_user)
+                db.flush()
+                queued = queue_store.entry(new_user)
+                # detached, so the commit does not expire it and the response needs no reload
+                db.expunge(new_user)
+                db.commit()
+                new_user.pos = queue_store.register(selected_counter, queued)["pos"]
+                adjust_counter_load(request.service_id, selected_counter, 1)
+            logging.info(f"Adding the new user {request.name} to counter {selected_counter} in memory")
+        else:
+            # registrations on other counters are not blocked by this one
+            async with counter_locks(selected_counter):
+                # placed at its rank by priority and ETA, only the users behind it are renumbered
+                insert_ranked(db, new_user)
+
+                if await is_here(counter_id=selected_counter, db=db):
+                    first_user= (
+                        db.query(UserData)
+                        .filter(UserData.counter == selected_counter)
+                        .order_by(UserData.pos)
+                        .first()
+                    )
+                    if first_user:
+                        start_service(first_user)
+                        try:
+                            # db.add()
+                            db.flush()
+                        except SQLAlchemyError as e:
+                            logging.error(f"generate_token failed: {str(e)}")
+                            db.rollback()
+                            raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+                    else:
+                        raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+
+                # in_queue is incremented by the database itself, no need to read the counter first
+                if not update_counter_stats(db, selected_counter, in_queue_delta=1):
+                    raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
+                logging.info(f"Adding the new user  {request.name} to counter {selected_counter}")
+
                 try:
                     # db.add()
-                    db.flush()
+                    db.commit()
                 except SQLAlchemyError as e:
                     logging.error(f"generate_token failed: {str(e)}")
                     db.rollback()
                     raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
-            else:
-                raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
-        
-
-        
-        processing_counter= (
-                db.query(Counter)
-                .filter(Counter.id == selected_counter)
-                .first()
-            )
-        processing_counter.in_queue +=1
-        logging.info(f"Adding the new user  {request.name} we have: {processing_counter.in_queue} in queue")
-
-        try:
-            # db.add()
-            db.commit()
-        except SQLAlchemyError as e:
-            logging.error(f"generate_token failed: {str(e)}")
-            db.rollback()
-            raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
-        
+
+                # Update the counters dictionary to reflect the newly added user
+                adjust_counter_load(request.service_id, selected_counter, 1)
+        queue_view.register(request.service_id, new_user.id, new_user.counter, new_user.name, new_user.pos, new_user.ETA)
+        event_log.register(new_user.id, request.service_id, new_user.counter, new_user.ETA, new_user.priority)
+        if not eta_is_final:
+            eta_refresher.resolve_soon(new_user.id)
+        await queue_store.acknowledge()
         logging.info(f"Updated counters: {settings.counters}")
 
     except Exception as e:
         db.rollback()  # Rollback if there are any errors
         logging.error(f"Failed to register user {request.name}: {str(e)}")
         raise HTTPException(status_code=StatusCode.INTERNAL_SERVER_ERROR.value, detail=StatusCode.INTERNAL_SERVER_ERROR.message)
-    user_to_return= UserResponse(id=new_user.id, name=new_user.name, counter= new_user.counter, pos=new_user.pos, eta=new_user.ETA)
+    user_to_return= UserResponse(id=new_user.id, name=new_user.name, counter= new_user.counter, pos=new_user.pos, eta=new_user.ETA,
+                                priority=request.priority)
     # Return a success message
     return StatusResponse(status_code=StatusCode.CREATED.value, status_message=StatusCode.CREATED.message, data=user_to_return)
 
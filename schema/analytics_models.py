@@ -0,0 +1,32 @@
+from pydantic import BaseModel
+from typing import Optional
+from datetime import datetime
+
+class TimeSummary(BaseModel):
+    # all values in seconds
+    count: int
+    mean: float
+    p50: float
+    p90: float
+    p99: float
+
+class CounterStats(BaseModel):
+    counter_id: int
+    served: int
+    throughput_per_hour: float
+    service_time: Optional[TimeSummary] = None
+    wait_time: Optional[TimeSummary] = None
+
+class ServiceStats(BaseModel):
+    service_id: int
+    served: int
+    throughput_per_hour: float
+    service_time: Optional[TimeSummary] = None
+    wait_time: Optional[TimeSummary] = None
+
+class HourlyStats(BaseModel):
+    hour: datetime
+    served: int
+    throughput_per_hour: float
+    service_time: Optional[TimeSummary] = None
+    wait_time: Optional[TimeSummary] = None
@@ -0,0 +1,22 @@
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel
+from schema.user_models import PriorityClass
+
+class BookAppointmentRequest(BaseModel):
+    name: str
+    password: str
+    service_id: int
+    after: Optional[datetime] = None  # earliest acceptable slot start, now by default
+    priority: PriorityClass = "regular"
+
+class AppointmentResponse(BaseModel):
+    id: int
+    name: str
+    service_id: int
+    slot_start: datetime
+
+class FreeSlotResponse(BaseModel):
+    service_id: int
+    slot_start: datetime
+    remaining: int  # bookings the slot still takes
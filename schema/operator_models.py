@@ -1,12 +1,106 @@
-from pydantic import BaseModel
+from typing import List, Literal, Optional
+from pydantic import BaseModel, Field
+from schema.services_models import CounterStatus
 
 class SelectQueue(BaseModel):
     service_id: int
     counter: int
     
+class SkipRequest(BaseModel):
+    service_id: int
+    counter: int
+    # how far back the head goes: a number of places, or minutes added to its ETA; places by default
+    places: Optional[int] = Field(default=None, gt=0)
+    minutes: Optional[int] = Field(default=None, gt=0)
+
+class SkipResponse(BaseModel):
+    user_id: int
+    skip_count: int
+    evicted: bool = False
+    pos: Optional[int] = None  # the new position, None once evicted
+
+class CounterStatusResponse(BaseModel):
+    counter: int
+    status: CounterStatus
+    moved: int = 0  # users moved to the open counters by a pause
+
 class UserDataResponse(BaseModel):
     # define the attributes of the UserData object here
     id: int
     service_id: int
-    counter: int
+    counter: Optional[int] = None
     pos: int
+
+class QueueHead(BaseModel):
+    id: int
+    name: str
+    pos: int
+    ETA: int
+
+class CounterSnapshot(BaseModel):
+    id: int
+    queue_length: int
+    avg_tat: float
+    users_processed: int
+    head: Optional[QueueHead] = None
+
+class ServiceSnapshot(BaseModel):
+    id: int
+    name: str
+    queue_mode: str
+    version: int  # view version the service was last reloaded at
+    waiting: int  # users in the shared queue, always 0 for per-counter services
+    head: Optional[QueueHead] = None
+    counters: List[CounterSnapshot]
+
+class SnapshotResponse(BaseModel):
+    version: int
+    services: List[ServiceSnapshot]
+
+class QueueChange(BaseModel):
+    version: int
+    kind: Literal["service", "counter", "user"]
+    id: int
+    service_id: int
+    removed: bool = False
+    # the new state of the entry, fields of other kinds stay None
+    name: Optional[str] = None
+    queue_mode: Optional[str] = None
+    avg_tat: Optional[float] = None
+    users_processed: Optional[int] = None
+    counter: Optional[int] = None
+    pos: Optional[int] = None
+    ETA: Optional[int] = None
+
+class ChangesResponse(BaseModel):
+    version: int
+    # the latest change of every entry after the requested version
+    changes: List[QueueChange] = []
+    # set instead of changes when the requested version is no longer retained
+    snapshot: Optional[SnapshotResponse] = None
+
+class CreateStationRequest(BaseModel):
+    name: str
+    counters: List[int] = Field(min_length=1)
+
+class StationResponse(BaseModel):
+    id: int
+    name: str
+    counters: List[int]
+    current_counter: Optional[int] = None
+    current_user: Optional[int] = None
+
+class StationHead(BaseModel):
+    user_id: int
+    service_id: int
+    counter: int
+    ETA: int
+    priority: int
+    waited_s: Optional[float] = None  # since registration
+
+class StationNextResponse(BaseModel):
+    station_id: int
+    finished_counter: Optional[int] = None  # the counter of the finished user
+    finished_user: Optional[int] = None  # the user called by the previous call, now served
+    missing_user: Optional[int] = None  # the user called before, no longer at its counter, so not finished
+    called: Optional[StationHead] = None  # the user the station serves now, None when every queue is empty
@@ -1,18 +1,29 @@
 from pydantic import BaseModel, Field
-from typing import Annotated
+from typing import Annotated, Literal
 
 PositiveInt = Annotated[int, Field(strict=True, gt=0, le=10)]
+# "shared" keeps one queue per service that every free counter takes the head of
+QueueMode = Literal["per_counter", "shared"]
+# how a new user's counter is chosen, see utils/assignment.py
+# "paused" and "draining" counters get no new users, see routes/counter_operator.py
+CounterStatus = Literal["open", "paused", "draining"]
+AssignmentStrategy = Literal["least_count", "least_expected_wait", "shortest_expected_workload", "power_of_two"]
 
 class CreateServiceRequest(BaseModel):
     name: str
     no_of_counters: PositiveInt
+    assignment_strategy: AssignmentStrategy = "least_count"
+    queue_mode: QueueMode = "per_counter"
 
 class UpdateServiceRequest(BaseModel):
     service_id: int
     name: str = None
     no_of_counters: PositiveInt = None
+    assignment_strategy: AssignmentStrategy = None
+    queue_mode: QueueMode = None
 
 class ServiceResponse(BaseModel):
     id: int
     name: str
     no_of_counters: PositiveInt
+    assignment_strategy: AssignmentStrategy = "least_count"
@@ -1,11 +1,16 @@
 from schema.distance_models import Location
+from typing import Literal, Optional
 from pydantic import BaseModel
 
+# served ahead of regular users, see settings.priority_levels and utils/priority.py
+PriorityClass = Literal["regular", "vip", "elderly", "disabled"]
+
 class GenerateTokenRequest(BaseModel):
     name: str
     password: str
     service_id: int
     location: Location
+    priority: PriorityClass = "regular"
 
 class UserLoginRequest(BaseModel):
     name: str
@@ -14,6 +19,7 @@ class UserLoginRequest(BaseModel):
 class UserResponse(BaseModel):
     id: int
     name: str
-    counter:int
+    counter: Optional[int] = None  # None while waiting in a shared service queue
     pos: int
-    eta: int
\ No newline at end of file
+    eta: int
+    priority: PriorityClass = "regular"
\ No newline at end of file
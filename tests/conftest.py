@@ -0,0 +1,30 @@
+import os, subprocess, sys
+import pytest
+from database.migrations import apply_migrations
+
+# what main.lifespan does to the database when the app starts
+STARTUP = """
+from database.db import SessionLocal
+from database.migrations import apply_migrations
+from utils.helpers import clear_queue, load_counters
+apply_migrations()
+db = SessionLocal()
+clear_queue(db)
+load_counters(db)
+db.close()
+"""
+
+@pytest.fixture(scope="session", autouse=True)
+def migrated_db():
+    # the schema is owned by the migrations, importing the models creates nothing
+    apply_migrations()
+
+@pytest.fixture
+def restart_app():
+    """
+    Run the app's database startup in a new process, as a restart or a new worker would.
+    """
+    def restart():
+        subprocess.run([sys.executable, "-c", STARTUP], check=True, env=os.environ.copy(),
+                       cwd=os.getcwd(), capture_output=True)
+    return restart
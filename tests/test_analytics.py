@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from datetime import datetime, timedelta
+from database.db import get_db
+from database.models import ServedHistory
+from routes.analytics import counter_analytics, hourly_analytics
+from utils.analytics import HistoryArrays, grouped_stats, service_report, served_history_arrays
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def setup_db():
+    db = next(get_test_db())
+    db.query(ServedHistory).delete()
+    db.commit()
+    served_history_arrays.__init__()
+
+    yield db
+
+    # Clean up
+    db.query(ServedHistory).delete()
+    db.commit()
+
+def test_grouped_stats_matches_numpy_percentiles():
+    rng = np.random.default_rng(7)
+    keys = rng.integers(1, 6, size=10_000)
+    values = rng.exponential(300, size=10_000)
+    values[::50] = np.nan
+
+    stats = grouped_stats(keys, values, percentiles=(50, 90, 99))
+
+    for key in range(1, 6):
+        expected = values[(keys == key) & ~np.isnan(values)]
+        assert stats[key]["count"] == len(expected)
+        assert stats[key]["mean"] == pytest.approx(expected.mean())
+        for q in (50, 90, 99):
+            assert stats[key][f"p{q}"] == pytest.approx(np.percentile(expected, q))
+
+def test_grouped_stats_empty():
+    assert grouped_stats(np.array([1, 2]), np.array([np.nan, np.nan])) == {}
+
+def test_service_report_by_counter():
+    history = HistoryArrays()
+    base = datetime(2026, 1, 5, 11, 0).timestamp()
+    history.counter_id = np.array([3, 3, 4])
+    history.service_id = np.array([1, 1, 1])
+    history.registered = np.array([base, base, base])
+    history.started = np.array([base + 60, base + 120, np.nan])
+    history.ended = np.array([base + 360, base + 720, base + 900])
+
+    report = service_report(history, np.ones(3, dtype=bool), "counter", window_hours=2)
+
+    assert [entry["counter_id"] for entry in report] == [3, 4]
+    assert report[0]["served"] == 2
+    assert report[0]["throughput_per_hour"] == 1
+    assert report[0]["wait_time"]["mean"] == 90
+    assert report[0]["service_time"]["p50"] == 450
+    assert report[1]["wait_time"] is None
+
+@pytest.mark.asyncio
+async def test_counter_analytics_from_history(setup_db):
+    db = setup_db
+    start = (datetime.now() - timedelta(days=7)).replace(hour=11, minute=0, second=0, microsecond=0)
+    db.add_all([
+        ServedHistory(user_id=i, service_id=1, counter_id=3, registered_at=start + timedelta(minutes=i),
+                      service_started_at=start + timedelta(minutes=i + 5), service_ended_at=start + timedelta(minutes=i + 8))
+        for i in range(100)
+    ])
+    db.commit()
+
+    response = await counter_analytics(start=start, end=start + timedelta(hours=2), service_id=None, counter_id=3, db=db)
+
+    assert response.status_code == 200
+    assert len(response.data) == 1
+    assert response.data[0].served == 100
+    assert response.data[0].wait_time.p90 == pytest.approx(300)
+    assert response.data[0].service_time.mean == pytest.approx(180)
+
+    hourly = await hourly_analytics(start=start, end=start + timedelta(hours=2), service_id=None, counter_id=3, db=db)
+    assert [entry.hour for entry in hourly.data] == [start, start + timedelta(hours=1)]
+    assert sum(entry.served for entry in hourly.data) == 100
@@ -0,0 +1,103 @@
+import pytest
+from datetime import timedelta
+from database.db import get_db
+from database.models import Service, Counter, UserData, Appointment
+from utils.appointments import SlotTree, AppointmentCalendar, AppointmentMerger
+from utils.assignment import counter_assignment
+from utils.clock import clock
+from utils.global_settings import settings
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def booking_service(mocker):
+    db = next(get_test_db())
+    service = Service(name="booking_service", no_of_counters=1)
+    db.add(service)
+    db.flush()
+    counter = Counter(service_id=service.id)
+    db.add(counter)
+    db.commit()
+    mocker.patch.object(settings, 'counters', {service.id: {counter.id: 0}})
+    # one booking per 15 minute slot
+    mocker.patch.object(settings, 'appointment_default_service_s', 900.0)
+    mocker.patch.object(settings, 'appointment_capacity_share', 1.0)
+    counter_assignment.reset()
+
+    yield db, service.id, counter.id
+
+    # Clean up
+    db.query(Appointment).filter(Appointment.service_id == service.id).delete()
+    db.query(UserData).filter(UserData.service_id == service.id).delete()
+    db.query(Counter).filter(Counter.id == counter.id).delete()
+    db.query(Service).filter(Service.id == service.id).delete()
+    db.commit()
+    db.close()
+
+def test_slot_tree_finds_the_first_free_slot():
+    tree = SlotTree([0, 2, 0, 0, 1])
+    assert tree.first_free() == 1
+    assert tree.first_free(2) == 4
+    tree.add(4, -1)
+    assert tree.first_free(2) is None
+    tree.add(1, -2)
+    assert tree.first_free() is None
+    tree.add(3, 1)
+    assert (tree.first_free(), tree.remaining(3)) == (3, 1)
+
+@pytest.mark.asyncio
+async def test_full_slots_move_bookings_to_the_next(booking_service):
+    db, service_id, _ = booking_service
+    calendar = AppointmentCalendar()
+    first = calendar.reserve(db, service_id)
+    assert first > clock.now()
+    second = calendar.reserve(db, service_id)
+    assert second - first == timedelta(minutes=15)
+
+    # a rebuilt calendar counts the stored bookings
+    db.add(Appointment(name="booked_a", hashed_password="x", service_id=service_id, slot_start=first))
+    db.commit()
+    calendar.invalidate()
+    assert calendar.next_free(db, service_id) == (second, 1)
+    calendar.release(service_id, first)
+    assert calendar.next_free(db, service_id)[0] == first
+
+@pytest.mark.asyncio
+async def test_due_appointments_join_the_queue_at_their_rank(booking_service):
+    db, service_id, counter_id = booking_service
+    for name, eta in (("walk_in_a", 2), ("walk_in_b", 20)):
+        db.add(UserData(name=name, hashed_password="x", counter=counter_id, service_id=service_id, pos=0, ETA=eta))
+    db.flush()
+    for index, user in enumerate(db.query(UserData).filter(UserData.counter == counter_id).order_by(UserData.ETA), start=1):
+        user.pos = index
+    now = clock.now()
+    db.add(Appointment(name="booked_a", hashed_password="x", service_id=service_id, slot_start=now + timedelta(minutes=5)))
+    db.add(Appointment(name="booked_later", hashed_password="x", service_id=service_id, slot_start=now + timedelta(hours=2)))
+    db.commit()
+
+    assert await AppointmentMerger().merge_due(now) == 1
+    db.expire_all()
+    queue = db.query(UserData.name, UserData.pos, UserData.ETA).filter(UserData.counter == counter_id).order_by(UserData.pos).all()
+    assert [tuple(row) for row in queue] == [("walk_in_a", 1, 2), ("booked_a", 2, 5), ("walk_in_b", 3, 20)]
+    assert [name for (name,) in db.query(Appointment.name).filter(Appointment.service_id == service_id)] == ["booked_later"]
+    assert db.get(Counter, counter_id).in_queue == 1
+    assert settings.counters[service_id][counter_id] == 1
+
+@pytest.mark.asyncio
+async def test_bookings_survive_a_restart(booking_service, restart_app):
+    db, service_id, _ = booking_service
+    first = AppointmentCalendar().reserve(db, service_id)
+    db.add(Appointment(name="booked_restart", hashed_password="x", service_id=service_id, slot_start=first))
+    db.commit()
+
+    restart_app()
+    db.expire_all()
+    assert db.query(Appointment).filter(Appointment.name == "booked_restart").count() == 1
+    # the calendar of the restarted process is rebuilt from the stored bookings
+    assert AppointmentCalendar().next_free(db, service_id) == (first + timedelta(minutes=15), 1)
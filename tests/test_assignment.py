@@ -0,0 +1,89 @@
+import random
+import pytest
+from utils.assignment import CounterAssignment, CounterPool
+from utils.global_settings import settings
+
+
+def test_least_count_picks_fewest_users_lowest_id_first():
+    loads = {1: 2, 2: 1, 3: 1}
+    pool = CounterPool(loads, "least_count", {})
+    assert pool.select() == 2
+
+    loads[2] += 2
+    pool.touch(2)
+    assert pool.select() == 3
+    loads[3] += 3
+    pool.touch(3)
+    assert pool.select() == 1
+
+def test_least_expected_wait_avoids_slow_counters():
+    # counter 1 serves in 600 s, counter 2 in 60 s
+    loads = {1: 1, 2: 4}
+    service_times = {1: 600, 2: 60}
+    assert CounterPool(loads, "least_count", service_times).select() == 1
+    assert CounterPool(loads, "least_expected_wait", service_times).select() == 2
+
+def test_shortest_expected_workload_counts_own_service():
+    # both queues are empty, only the workload strategy sees that counter 1 is slower
+    loads = {1: 0, 2: 0}
+    service_times = {1: 600, 2: 60}
+    assert CounterPool(loads, "least_expected_wait", service_times).select() == 1
+    assert CounterPool(loads, "shortest_expected_workload", service_times).select() == 2
+
+def test_counter_without_history_uses_service_average():
+    pool = CounterPool({1: 1, 2: 1, 3: 1}, "least_expected_wait", {1: 100, 2: 300})
+    assert pool.expected_service_time(3) == 200
+
+    pool.touch(3, service_time=50)
+    assert pool.select() == 3
+
+def test_power_of_two_picks_shorter_of_two_samples():
+    loads = {1: 5, 2: 0, 3: 9}
+    pool = CounterPool(loads, "power_of_two", {}, rng=random.Random(7))
+    picks = [pool.select() for _ in range(200)]
+    # the longest queue never wins a comparison
+    assert 3 not in picks
+    assert CounterPool({4: 3}, "power_of_two", {}).select() == 4
+
+def test_heap_stays_compact_under_many_updates():
+    loads = {counter_id: 0 for counter_id in range(1, 11)}
+    pool = CounterPool(loads, "least_count", {})
+    for step in range(1000):
+        counter_id = pool.select()
+        loads[counter_id] += 1
+        pool.touch(counter_id)
+    assert len(pool._heap) <= 4 * len(loads) + 8
+    assert set(loads.values()) == {100}
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        CounterPool({1: 0}, "round_robin", {})
+
+def test_assignment_follows_settings_counters(mocker):
+    mocker.patch.object(settings, 'counters', {1: {10: 0, 11: 2}})
+    assignment = CounterAssignment()
+    assignment.set_strategy(1, "shortest_expected_workload")
+    assignment.load_counter(10, total_tat=3000, users_processed=5)
+    assignment.load_counter(11, total_tat=100, users_processed=5)
+
+    assert assignment.select(1) == 11
+    # counter 11 becomes much slower
+    for _ in range(20):
+        assignment.record_service(1, 11, 2000)
+    assert assignment.select(1) == 10
+
+    # a resized service replaces its dictionary and gets a new pool
+    settings.counters[1] = {12: 0}
+    assert assignment.select(1) == 12
+    assert assignment.select(2) is None
+
+def test_closed_counters_get_no_users(mocker):
+    mocker.patch.object(settings, 'counters', {1: {10: 0, 11: 5}})
+    assignment = CounterAssignment()
+    assignment.set_counter_status(1, 10, "paused")
+    assert assignment.select(1) == 11
+    assert assignment.open_loads(1) == {11: 5}
+    assignment.set_counter_status(1, 11, "draining")
+    assert assignment.select(1) is None
+    assignment.set_counter_status(1, 10, "open")
+    assert assignment.select(1) == 10
@@ -0,0 +1,43 @@
+from datetime import datetime, timezone
+from utils.clock import Clock, as_utc, duration_s
+
+
+class FakeTime:
+    def __init__(self, wall_ns: int):
+        self.wall_ns = wall_ns
+        self.monotonic_ns = 0
+
+    def advance(self, seconds: float):
+        self.wall_ns += int(seconds * 1e9)
+        self.monotonic_ns += int(seconds * 1e9)
+
+
+def make_clock(fake: FakeTime):
+    return Clock(wall_ns=lambda: fake.wall_ns, monotonic_ns=lambda: fake.monotonic_ns)
+
+def test_now_is_aware_utc_with_microseconds():
+    fake = FakeTime(1_700_000_000_123_456_789)
+    clock = make_clock(fake)
+    now = clock.now()
+    assert now.tzinfo == timezone.utc
+    assert now == datetime(2023, 11, 14, 22, 13, 20, 123456, tzinfo=timezone.utc)
+
+def test_wall_clock_steps_do_not_change_durations():
+    fake = FakeTime(1_700_000_000 * 10**9)
+    clock = make_clock(fake)
+    started = clock.now()
+    fake.advance(90.5)
+    # the system clock is set back an hour while the user is served
+    fake.wall_ns -= 3600 * 10**9
+    assert duration_s(started, clock.now()) == 90.5
+
+    assert clock.resync()
+    assert clock.skew_s() == 0
+    assert not clock.resync()
+
+def test_duration_of_unknown_start_is_none():
+    assert duration_s(None, datetime.now(timezone.utc)) is None
+
+def test_naive_datetimes_are_taken_as_utc():
+    assert as_utc(datetime(2024, 1, 1, 12)) == datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+    assert as_utc(None) is None
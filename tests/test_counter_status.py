@@ -0,0 +1,88 @@
+import pytest
+from datetime import datetime, timezone
+from database.db import get_db
+from database.models import Service, Counter, UserData
+from routes.counter_operator import pause_counter, resume_counter
+from routes.services_crud import update_service
+from schema.operator_models import SelectQueue
+from schema.services_models import UpdateServiceRequest
+from utils.assignment import counter_assignment
+from utils.global_settings import settings
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def three_counters(mocker):
+    db = next(get_test_db())
+    service = Service(name="status_service", no_of_counters=3)
+    db.add(service)
+    db.flush()
+    counters = [Counter(service_id=service.id, in_queue=load) for load in (4, 1, 0)]
+    db.add_all(counters)
+    db.flush()
+    started = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+    for pos, eta in enumerate((0, 5, 10, 20), start=1):
+        db.add(UserData(name=f"status_a{pos}", hashed_password="x", counter=counters[0].id, service_id=service.id, pos=pos, ETA=eta,
+                        service_started_at=started if pos == 1 else None))
+    db.add(UserData(name="status_b1", hashed_password="x", counter=counters[1].id, service_id=service.id, pos=1, ETA=8))
+    db.commit()
+    counter_ids = [counter.id for counter in counters]
+    mocker.patch.object(settings, 'counters', {service.id: dict(zip(counter_ids, (4, 1, 0)))})
+    mocker.patch("routes.counter_operator.rebalance_q")
+
+    yield db, service.id, counter_ids
+
+    # Clean up
+    counter_assignment.forget_counters(*counter_ids)
+    db.query(UserData).filter(UserData.service_id == service.id).delete()
+    db.query(Counter).filter(Counter.service_id == service.id).delete()
+    db.query(Service).filter(Service.id == service.id).delete()
+    db.commit()
+    db.close()
+
+def queues(db, counter_ids):
+    db.expire_all()
+    return {
+        counter_id: [name for (name,) in db.query(UserData.name).filter(UserData.counter == counter_id).order_by(UserData.pos)]
+        for counter_id in counter_ids
+    }
+
+@pytest.mark.asyncio
+async def test_pause_moves_waiting_users_and_resume_reopens(three_counters):
+    db, service_id, (a, b, c) = three_counters
+    response = await pause_counter(SelectQueue(service_id=service_id, counter=a), db=db)
+    assert (response.data.status, response.data.moved) == ("paused", 3)
+
+    # the user being served stays, the others go to the least loaded open counter in rank order
+    after = queues(db, (a, b, c))
+    assert after[a] == ["status_a1"]
+    assert after[c] == ["status_a2", "status_a4"]
+    assert after[b] == ["status_b1", "status_a3"]
+    assert settings.counters[service_id] == {a: 1, b: 2, c: 2}
+    assert [db.get(Counter, counter_id).in_queue for counter_id in (a, b, c)] == [1, 2, 2]
+    assert db.get(Counter, a).status == "paused"
+    assert counter_assignment.select(service_id) != a
+
+    response = await resume_counter(SelectQueue(service_id=service_id, counter=a), db=db)
+    assert response.data.status == "open"
+    assert counter_assignment.select(service_id) == a
+
+@pytest.mark.asyncio
+async def test_live_resize_migrates_users_of_removed_counters(three_counters):
+    db, service_id, (a, b, c) = three_counters
+    # the paused counter is removed first, then the newest one
+    await pause_counter(SelectQueue(service_id=service_id, counter=b), db=db)
+    response = await update_service(UpdateServiceRequest(service_id=service_id, no_of_counters=1), db=db)
+    assert response.data.no_of_counters == 1
+
+    after = queues(db, (a,))
+    assert after[a] == ["status_a1", "status_a2", "status_b1", "status_a3", "status_a4"]
+    assert db.query(Counter.id).filter(Counter.service_id == service_id).all() == [(a,)]
+    assert db.get(Counter, a).in_queue == 5
+    assert settings.counters[service_id] == {a: 5}
@@ -0,0 +1,244 @@
+import asyncio
+import httpx
+import pytest
+from schema.distance_models import Location
+from utils.distance_client import (
+    CircuitBreaker,
+    DistanceClient,
+    LocalEstimator,
+    QuotaTracker,
+    distance_to_branch_km,
+    haversine_km,
+    is_within_geofence,
+    parse_duration_minutes,
+)
+from utils.global_settings import Q_SOLUTIONS_COORDS
+from utils.travel_grid import TravelGrid, build_grid
+
+# roughly 11 km north of the branch
+FAR = Location(latitude=Q_SOLUTIONS_COORDS[0] + 0.1, longitude=Q_SOLUTIONS_COORDS[1])
+
+
+@pytest.fixture
+def grid(tmp_path):
+    return TravelGrid(path=str(tmp_path / "grid.npy"), cell_m=250, radius_km=20)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_haversine_km():
+    assert haversine_km(0, 0, 0, 0) == 0
+    # one degree of latitude is about 111 km
+    assert haversine_km(0, 0, 1, 0) == pytest.approx(111.2, abs=0.1)
+
+
+def test_parse_duration_minutes():
+    assert parse_duration_minutes({"rows": [{"elements": [{"duration": {"value": 930, "text": "15 mins"}}]}]}) == 16
+    assert parse_duration_minutes({"rows": [{"elements": [{"duration": {"text": "1 hour 5 mins"}}]}]}) == 65
+    assert parse_duration_minutes({"rows": [{"elements": [{"status": "ZERO_RESULTS"}]}]}) is None
+    assert parse_duration_minutes({"rows": []}) is None
+
+
+def test_circuit_breaker_opens_and_recovers():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout_s=10, clock=clock)
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    # after the reset timeout a single trial call is let through
+    clock.now = 10
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+    # a failed trial opens the breaker again
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now = 20
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_quota_tracker_resets_daily():
+    day = [1]
+    quota = QuotaTracker(daily_limit=2, today=lambda: day[0])
+    assert quota.try_use() and quota.try_use()
+    assert not quota.try_use()
+    day[0] = 2
+    assert quota.try_use()
+
+
+def test_estimator_calibrates_road_factor():
+    estimator = LocalEstimator(road_factor=1.0, speed_kmh=30.0)
+    km = distance_to_branch_km(FAR)
+    assert estimator.estimate(FAR) == round(km * 2)
+
+    # the API keeps answering twice the straight-line time
+    for _ in range(100):
+        estimator.observe(FAR, round(km * 4))
+    assert estimator.road_factor == pytest.approx(2.0, abs=0.05)
+    assert estimator.estimate(FAR) == pytest.approx(km * 4, abs=1)
+
+
+@pytest.mark.asyncio
+async def test_eta_uses_api_answer(mocker, grid):
+    client = DistanceClient(api_key="k", grid=grid)
+    mocker.patch.object(client, "fetch", return_value=42)
+    assert await client.eta(FAR) == 42
+    assert client.estimator.samples == 1
+
+
+@pytest.mark.asyncio
+async def test_eta_falls_back_on_failure_and_opens_breaker(mocker, grid):
+    client = DistanceClient(api_key="k", grid=grid)
+    client.breaker = CircuitBreaker(failure_threshold=2, reset_timeout_s=60)
+    fetch = mocker.patch.object(client, "fetch", side_effect=httpx.ConnectError("down"))
+
+    for _ in range(3):
+        assert await client.eta(FAR) == client.estimator.estimate(FAR)
+    # the third lookup is answered locally without calling the API
+    assert fetch.call_count == 2
+    assert client.breaker.state == CircuitBreaker.OPEN
+
+
+@pytest.mark.asyncio
+async def test_eta_falls_back_on_timeout(mocker, grid):
+    client = DistanceClient(api_key="k", timeout_s=0.01, grid=grid)
+
+    async def slow_fetch(location):
+        await asyncio.sleep(1)
+        return 1
+
+    mocker.patch.object(client, "fetch", side_effect=slow_fetch)
+    assert await client.eta(FAR) == client.estimator.estimate(FAR)
+    assert client.breaker.failures == 1
+
+
+@pytest.mark.asyncio
+async def test_eta_falls_back_when_quota_is_used_up(mocker, grid):
+    client = DistanceClient(api_key="k", grid=grid)
+    client.quota = QuotaTracker(daily_limit=1)
+    fetch = mocker.patch.object(client, "fetch", return_value=42)
+
+    assert await client.eta(FAR) == 42
+    elsewhere = Location(latitude=FAR.latitude + 0.1, longitude=FAR.longitude)
+    assert await client.eta(elsewhere) == client.estimator.estimate(elsewhere)
+    # the fallback prefers what the grid learned from the first answer
+    assert await client.eta(FAR) == 42
+    assert fetch.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_identical_lookups_share_one_call(mocker, grid):
+    client = DistanceClient(api_key="k", grid=grid)
+    release = asyncio.Event()
+    calls = []
+
+    async def fetch(location):
+        calls.append(location)
+        await release.wait()
+        return 12
+
+    mocker.patch.object(client, "fetch", side_effect=fetch)
+    nearby = Location(latitude=FAR.latitude + 0.0001, longitude=FAR.longitude)
+    elsewhere = Location(latitude=FAR.latitude + 0.01, longitude=FAR.longitude)
+
+    lookups = [asyncio.ensure_future(client.eta(location)) for location in (FAR, nearby, FAR, elsewhere)]
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await asyncio.gather(*lookups) == [12, 12, 12, 12]
+    # FAR and nearby round to the same cell, elsewhere does not
+    assert len(calls) == 2
+    assert client._in_flight == {}
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_shared_lookup(mocker, grid):
+    client = DistanceClient(api_key="k", grid=grid)
+    release = asyncio.Event()
+
+    async def fetch(location):
+        await release.wait()
+        return 7
+
+    mocker.patch.object(client, "fetch", side_effect=fetch)
+    first = asyncio.ensure_future(client.eta(FAR))
+    second = asyncio.ensure_future(client.eta(FAR))
+    await asyncio.sleep(0)
+    first.cancel()
+    release.set()
+
+    assert await second == 7
+    assert first.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_api_answers_are_learned_by_the_grid(mocker, grid):
+    client = DistanceClient(api_key="k", grid=grid)
+    fetch = mocker.patch.object(client, "fetch", return_value=42)
+
+    assert await client.eta(FAR, prefer_local=True) == 42
+    # the second registration from the same place is answered from the grid
+    assert await client.eta(FAR, prefer_local=True) == 42
+    assert fetch.call_count == 1
+    # a live lookup still calls the API
+    await client.eta(FAR)
+    assert fetch.call_count == 2
+
+
+def test_grid_lookup_and_nearest_cell(grid):
+    assert grid.lookup(FAR) is None
+    grid.observe(FAR, 20)
+    grid.observe(FAR, 30)
+    assert grid.lookup(FAR) == 25
+
+    row, column = grid.cell_of(FAR)
+    neighbour = grid.cell_center(row + 1, column + 1)
+    assert grid.lookup(neighbour) == 25
+    assert grid.lookup(neighbour, search_cells=0) is None
+    assert grid.lookup(grid.cell_center(row + 5, column)) is None
+    # outside the grid
+    assert grid.lookup(Location(latitude=FAR.latitude + 1, longitude=FAR.longitude)) is None
+
+
+def test_grid_survives_reopen(grid):
+    grid.observe(FAR, 17)
+    grid.close()
+
+    reopened = TravelGrid(path=grid.path, cell_m=250, radius_km=20)
+    assert reopened.lookup(FAR) == 17
+    # another geometry starts from an empty grid
+    assert TravelGrid(path=grid.path, cell_m=500, radius_km=20).lookup(FAR) is None
+
+
+@pytest.mark.asyncio
+async def test_build_grid_samples_cells(tmp_path):
+    grid = TravelGrid(path=str(tmp_path / "grid.npy"), cell_m=1000, radius_km=5)
+
+    async def fetch(location):
+        return round(distance_to_branch_km(location) * 3)
+
+    filled = await build_grid(grid, fetch, step=2)
+    assert filled == grid.known_cells() > 0
+    # the branch cell is sampled and every cell in between has a sampled neighbour
+    assert grid.lookup(grid.cell_center(grid.half, grid.half)) == 0
+    assert grid.lookup(grid.cell_center(grid.half + 1, grid.half + 1), search_cells=1) is not None
+
+
+def test_is_within_geofence():
+    assert is_within_geofence(Location(latitude=Q_SOLUTIONS_COORDS[0], longitude=Q_SOLUTIONS_COORDS[1]), radius_m=100)
+    assert not is_within_geofence(FAR, radius_m=100)
+    assert is_within_geofence(FAR, radius_m=20_000)
@@ -0,0 +1,193 @@
+import pytest
+from datetime import timedelta
+from types import SimpleNamespace
+from database.db import get_db, SessionLocal
+from database.models import Service, Counter, UserData
+from routes.user import generate_token
+from schema.distance_models import Location
+from schema.user_models import GenerateTokenRequest
+from utils.clock import clock
+from utils.eta_refresher import EtaRefresher, refresh_interval, select_due
+from utils.global_settings import settings
+from utils.rate_limit import TokenBucket
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def setup_db():
+    db = next(get_test_db())
+    service = Service(name="refresh_service", no_of_counters=1)
+    db.add(service)
+    db.flush()
+    counter = Counter(service_id=service.id)
+    db.add(counter)
+    db.flush()
+    stale = clock.now() - timedelta(hours=1)
+    # latitude doubles as the new ETA the fake API will answer with
+    for pos, (eta, new_eta) in enumerate([(5, 30), (10, 2), (20, 15)], start=1):
+        db.add(UserData(name=f"refresh_user_{pos}", hashed_password="x", service_id=service.id, counter=counter.id,
+                        pos=pos, ETA=eta, latitude=new_eta, longitude=0, eta_updated_at=stale))
+    db.commit()
+
+    yield db, counter.id
+
+    # Clean up
+    db.query(UserData).filter(UserData.counter == counter.id).delete()
+    db.query(Counter).filter(Counter.id == counter.id).delete()
+    db.query(Service).filter(Service.id == service.id).delete()
+    db.commit()
+
+def test_refresh_interval_grows_with_position(mocker):
+    mocker.patch.object(settings, 'eta_refresh_cycle_s', 10.0)
+    mocker.patch.object(settings, 'eta_refresh_front_size', 3)
+
+    assert [refresh_interval(pos) for pos in (1, 3, 4, 6, 7)] == [10, 10, 20, 20, 30]
+
+def test_select_due_prefers_front_and_respects_budget(mocker):
+    mocker.patch.object(settings, 'eta_refresh_cycle_s', 10.0)
+    mocker.patch.object(settings, 'eta_refresh_front_size', 1)
+    now = clock.now()
+    users = [
+        SimpleNamespace(id=1, pos=1, eta_updated_at=now - timedelta(seconds=15)),
+        SimpleNamespace(id=2, pos=2, eta_updated_at=now - timedelta(seconds=15)),  # not due yet
+        SimpleNamespace(id=3, pos=4, eta_updated_at=now - timedelta(seconds=400)),
+        SimpleNamespace(id=4, pos=1, eta_updated_at=None),
+    ]
+
+    assert [user.id for user in select_due(users, now, budget=10)] == [4, 3, 1]
+    assert [user.id for user in select_due(users, now, budget=2)] == [4, 3]
+    assert select_due(users, now, budget=0) == []
+
+def test_token_bucket_refills_over_time():
+    now = [0.0]
+    bucket = TokenBucket(rate=2, capacity=4, clock=lambda: now[0])
+
+    assert bucket.try_acquire(4)
+    assert not bucket.try_acquire()
+    now[0] = 1.0
+    assert bucket.available() == 2
+
+@pytest.mark.asyncio
+async def test_refresh_once_updates_and_resorts_counter(setup_db):
+    db, counter_id = setup_db
+    calls = []
+
+    async def fake_eta(location):
+        calls.append(location)
+        return int(location.latitude)
+
+    refresher = EtaRefresher(SessionLocal, fetch_eta=fake_eta)
+
+    refreshed = await refresher.refresh_once()
+
+    assert refreshed == 3
+    assert len(calls) == 3
+    users = db.query(UserData).filter(UserData.counter == counter_id).order_by(UserData.pos).populate_existing().all()
+    assert [(user.pos, user.ETA) for user in users] == [(1, 2), (2, 15), (3, 30)]
+
+    # nothing is due right after a refresh
+    assert await refresher.refresh_once() == 0
+
+@pytest.mark.asyncio
+async def test_refresh_once_stays_within_api_budget(setup_db):
+    db, counter_id = setup_db
+    calls = []
+
+    async def fake_eta(location):
+        calls.append(location)
+        return 1
+
+    refresher = EtaRefresher(SessionLocal, fetch_eta=fake_eta)
+    refresher.budget = TokenBucket(rate=0.0001, capacity=2)
+
+    await refresher.refresh_once()
+    await refresher.refresh_once()
+
+    assert len(calls) == 2
+
+@pytest.mark.asyncio
+async def test_resolve_pending_resolves_only_queued_users(setup_db):
+    db, counter_id = setup_db
+    users = db.query(UserData).filter(UserData.counter == counter_id).order_by(UserData.pos).all()
+
+    async def fake_eta(location):
+        return int(location.latitude)
+
+    refresher = EtaRefresher(SessionLocal, fetch_eta=fake_eta)
+    refresher.resolve_soon(users[0].id)
+    refresher.resolve_soon(users[1].id)
+
+    assert await refresher.resolve_pending() == 2
+    assert refresher.pending() == 0
+    users = db.query(UserData).filter(UserData.counter == counter_id).order_by(UserData.pos).populate_existing().all()
+    # the third user keeps its ETA of 20 and is re-sorted once with the others
+    assert [(user.pos, user.ETA) for user in users] == [(1, 2), (2, 20), (3, 30)]
+
+@pytest.mark.asyncio
+async def test_generate_token_defers_eta_resolution(setup_db, mocker):
+    db, counter_id = setup_db
+    service_id = db.get(Counter, counter_id).service_id
+    mocker.patch.object(settings, 'counters', {service_id: {counter_id: 3}})
+    mocker.patch("routes.user.provisional_ETA", return_value=(7, False))
+    resolve_soon = mocker.patch("routes.user.eta_refresher.resolve_soon")
+    fetch = mocker.patch("utils.distance_client.distance_client.fetch")
+
+    result = await generate_token(
+        GenerateTokenRequest(name="deferred_user", password="x", service_id=service_id, location=Location(latitude=1, longitude=1)),
+        db=db,
+    )
+
+    fetch.assert_not_called()
+    user = db.query(UserData).filter(UserData.name == "deferred_user").populate_existing().one()
+    assert (user.ETA, user.pos, user.eta_updated_at) == (7, 2, None)
+    assert result.data.eta == 7
+    resolve_soon.assert_called_once_with(user.id)
+
+@pytest.mark.asyncio
+async def test_refresh_once_skips_users_updated_meanwhile(setup_db):
+    db, counter_id = setup_db
+    users = db.query(UserData).filter(UserData.counter == counter_id).order_by(UserData.pos).all()
+    moved_id = users[0].id
+
+    async def fake_eta(location):
+        if location.latitude == 30:
+            # PUT /distance reports a new location while the API call is in flight
+            other = SessionLocal()
+            try:
+                other.query(UserData).filter(UserData.id == moved_id).update(
+                    {UserData.ETA: 1, UserData.latitude: 1, UserData.eta_updated_at: clock.now()}
+                )
+                other.commit()
+            finally:
+                other.close()
+        return int(location.latitude)
+
+    refresher = EtaRefresher(SessionLocal, fetch_eta=fake_eta)
+
+    assert await refresher.refresh_once() == 2
+    users = db.query(UserData).filter(UserData.counter == counter_id).order_by(UserData.pos).populate_existing().all()
+    # the moved user keeps the ETA of its new location instead of the stale 30
+    assert [(user.id == moved_id, user.ETA) for user in users] == [(True, 1), (False, 2), (False, 15)]
+
+@pytest.mark.asyncio
+async def test_refresh_once_starts_service_of_arrived_head(setup_db):
+    db, counter_id = setup_db
+    head_id = db.query(UserData.id).filter(UserData.counter == counter_id, UserData.pos == 2).scalar()
+
+    async def fake_eta(location):
+        return 0 if location.latitude == 2 else int(location.latitude)
+
+    refresher = EtaRefresher(SessionLocal, fetch_eta=fake_eta)
+
+    assert await refresher.refresh_once() == 3
+    head = db.query(UserData).filter(UserData.counter == counter_id, UserData.pos == 1).populate_existing().one()
+    assert (head.id, head.ETA) == (head_id, 0)
+    assert head.arrived_at is not None and head.service_started_at is not None
+    others = db.query(UserData).filter(UserData.counter == counter_id, UserData.pos > 1).all()
+    assert all(user.arrived_at is None and user.service_started_at is None for user in others)
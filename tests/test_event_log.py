@@ -0,0 +1,151 @@
+import os
+import numpy as np
+import pytest
+from utils.event_log import (EventLog, EVENT_DTYPE, NO_COUNTER, REGISTER, POP, SERVICE_CREATE, SERVICE_DELETE,
+                             read_events, replay, _segment_paths)
+
+
+@pytest.fixture
+def log_dir(tmp_path):
+    return str(tmp_path / "events")
+
+def open_log(log_dir, **kwargs):
+    log = EventLog(directory=log_dir, segment_mb=1, **kwargs)
+    log.open()
+    return log
+
+def test_events_survive_a_restart(log_dir):
+    log = open_log(log_dir)
+    log.service(SERVICE_CREATE, 1, 2)
+    log.register(10, 1, 5, 12)
+    # nothing is written before the group commit
+    assert len(read_events(log_dir)) == 0
+    assert log.flush() == 2
+    log.pop(10, 1, 5)
+    log.close()
+
+    events = read_events(log_dir, verify=True)
+    assert list(events["seq"]) == [1, 2, 3]
+    assert list(events["kind"]) == [SERVICE_CREATE, REGISTER, POP]
+    assert (events["user_id"][1], events["counter_id"][1], events["value"][1]) == (10, 5, 12)
+
+    reopened = open_log(log_dir)
+    assert reopened.next_seq == 4
+
+def test_closed_log_records_nothing(log_dir):
+    log = EventLog(directory=log_dir)
+    log.register(1, 1, 1, 1)
+    assert log.pending() == 0
+
+def test_full_segments_roll_over(log_dir):
+    log = open_log(log_dir)
+    per_segment = log.segment_records
+    for user_id in range(per_segment + 10):
+        log.register(user_id, 1, 1, 0)
+    log.flush()
+    log.close()
+    paths = _segment_paths(log_dir)
+    assert [os.path.basename(path) for path in paths] == [f"events-{1:020d}.log", f"events-{per_segment + 1:020d}.log"]
+    assert len(read_events(log_dir)) == per_segment + 10
+
+def test_torn_group_commit_is_dropped_on_open(log_dir):
+    log = open_log(log_dir)
+    for user_id in range(5):
+        log.register(user_id, 1, 1, 0)
+    log.close()
+    segment = np.memmap(_segment_paths(log_dir)[0], dtype=EVENT_DTYPE, mode="r+")
+    # the last record was only half written
+    segment["value"][4] = 99
+    segment.flush()
+    del segment
+
+    assert len(read_events(log_dir)) == 4
+    log = open_log(log_dir)
+    assert log.next_seq == 5
+    log.register(7, 1, 1, 0)
+    log.close()
+    assert list(read_events(log_dir, verify=True)["user_id"]) == [0, 1, 2, 3, 7]
+
+def test_replay_rebuilds_the_queues(log_dir):
+    log = open_log(log_dir)
+    log.service(SERVICE_CREATE, 1, 2)
+    log.service(SERVICE_CREATE, 2, 1)
+    log.register(1, 1, 10, 30)
+    log.register(2, 1, 10, 20)
+    log.register(3, 1, 11, 5)
+    log.register(4, 2, None, 8)
+    log.eta(1, 1, 10, 10)
+    log.move(2, 1, 11)
+    log.register(5, 1, 10, 1)
+    log.pop(5, 1, 10)
+    log.register(6, 2, None, 3)
+    log.service(SERVICE_CREATE, 3, 1)
+    log.register(7, 3, 12, 0)
+    log.service(SERVICE_DELETE, 3)
+    # a user registered before the log existed
+    log.eta(99, 1, 10, 4)
+    log.close()
+
+    state = replay(read_events(log_dir))
+    queues = list(zip(*(state[name].tolist() for name in ("user_id", "service_id", "counter_id", "eta", "pos"))))
+    assert queues == [
+        (1, 1, 10, 10, 1),
+        (3, 1, 11, 5, 1),
+        (2, 1, 11, 20, 2),
+        (6, 2, NO_COUNTER, 3, 1),
+        (4, 2, NO_COUNTER, 8, 2),
+    ]
+    assert state["services"].tolist() == [1, 2]
+
+def test_replay_orders_by_priority(log_dir):
+    log = open_log(log_dir)
+    log.service(SERVICE_CREATE, 1, 1)
+    log.register(1, 1, 10, 5)
+    log.register(2, 1, 10, 30, priority=2)
+    log.register(3, 1, 10, 1)
+    log.close()
+
+    state = replay(read_events(log_dir))
+    assert list(zip(state["user_id"].tolist(), state["priority"].tolist(), state["pos"].tolist())) == [(2, 2, 1), (3, 0, 2), (1, 0, 3)]
+
+def test_replay_ranks_by_the_promoted_level(log_dir):
+    log = open_log(log_dir)
+    log.service(SERVICE_CREATE, 1, 1)
+    log.register(1, 1, 10, 5)
+    log.register(2, 1, 10, 30, priority=1)
+    log.register(3, 1, 10, 40)
+    log.promote(3, 1, 10, 2)
+    log.close()
+
+    state = replay(read_events(log_dir))
+    assert list(zip(state["user_id"].tolist(), state["priority"].tolist(), state["pos"].tolist())) == [(3, 0, 1), (2, 1, 2), (1, 0, 3)]
+
+def test_replay_starts_over_at_a_reset(log_dir):
+    log = open_log(log_dir)
+    log.service(SERVICE_CREATE, 1, 1)
+    log.register(1, 1, 10, 5)
+    log.register(2, 1, 10, 8)
+    log.close()
+
+    # the next run empties the queues and hands out user 1 again
+    restarted = open_log(log_dir)
+    restarted.reset()
+    restarted.register(1, 1, 10, 20)
+    restarted.close()
+
+    state = replay(read_events(log_dir))
+    assert list(zip(state["user_id"].tolist(), state["eta"].tolist())) == [(1, 20)]
+    assert state["services"].tolist() == [1]
+
+def test_replay_keeps_skipped_users_held_back(log_dir):
+    log = open_log(log_dir)
+    log.service(SERVICE_CREATE, 1, 1)
+    log.register(1, 1, 10, 5)
+    log.register(2, 1, 10, 10)
+    log.register(3, 1, 10, 20)
+    # user 1 was skipped behind user 2 at the counter
+    log.move(1, 1, 10, skip_offset=6)
+    log.close()
+
+    state = replay(read_events(log_dir))
+    assert list(zip(state["user_id"].tolist(), state["skip_offset"].tolist(), state["pos"].tolist())) == [(2, 0, 1), (1, 6, 2), (3, 0, 3)]
@@ -2,7 +2,7 @@ import pytest
 from fastapi.testclient import TestClient
 from fastapi import HTTPException
 from sqlalchemy import text
-from database.models import UserData#, Counter
+from database.models import UserData, Service, Counter
 from schema.distance_models import Location
 from auth import hash_password, SECRET_KEY, ALGORITHM
 from database.db import get_db
@@ -12,6 +12,8 @@ from datetime import timedelta, datetime
 from routes.get_distance import update_eta
 from schema.distance_models import UpdateEtaReaquest
 from jose import jwt#, JWTError
+from utils.global_settings import Q_SOLUTIONS_COORDS
+from utils.locks import counter_locks
 
 _off = text("SET FOREIGN_KEY_CHECKS = 0;")
 _on = text("SET FOREIGN_KEY_CHECKS = 1;")
@@ -114,3 +116,77 @@ async def test_update_eta_user_not_found(mocker):
     db.execute(_on)
     db.commit()
     
+
+
+@pytest.mark.asyncio
+async def test_update_eta_inside_geofence_skips_distance_api(mocker):
+    db = next(get_test_db())
+    service = Service(name="geofence_service", no_of_counters=1)
+    db.add(service)
+    db.flush()
+    counter = Counter(service_id=service.id)
+    db.add(counter)
+    db.flush()
+    waiting = UserData(name="geofence_waiting", hashed_password="x", service_id=service.id, counter=counter.id, pos=1, ETA=5)
+    arriving = UserData(name="geofence_arriving", hashed_password="x", service_id=service.id, counter=counter.id, pos=2, ETA=20)
+    db.add_all([waiting, arriving])
+    db.commit()
+
+    get_eta = mocker.patch("routes.get_distance.get_ETA")
+    # about 50 m from the branch
+    at_branch = Location(latitude=Q_SOLUTIONS_COORDS[0] + 0.0004, longitude=Q_SOLUTIONS_COORDS[1])
+    result = await update_eta(request=UpdateEtaReaquest(userid=arriving.id, location=at_branch), db=db)
+
+    assert result.data.update_eta == 0
+    get_eta.assert_not_called()
+    db.expire_all()
+    arrived = db.get(UserData, arriving.id)
+    assert arrived.pos == 1
+    assert arrived.arrived_at is not None
+    assert arrived.service_started_at >= arrived.arrived_at
+
+    db.query(UserData).filter(UserData.counter == counter.id).delete()
+    db.query(Counter).filter(Counter.id == counter.id).delete()
+    db.query(Service).filter(Service.id == service.id).delete()
+    db.commit()
+
+@pytest.mark.asyncio
+async def test_update_eta_follows_a_user_moved_before_the_lock(mocker):
+    db = next(get_test_db())
+    service = Service(name="moved_eta_service", no_of_counters=2)
+    db.add(service)
+    db.flush()
+    counters = [Counter(service_id=service.id), Counter(service_id=service.id)]
+    db.add_all(counters)
+    db.flush()
+    first, second = (counter.id for counter in counters)
+    moving = UserData(name="moved_eta_user", hashed_password="x", service_id=service.id, counter=first, pos=1, ETA=30)
+    staying = UserData(name="moved_eta_other", hashed_password="x", service_id=service.id, counter=second, pos=1, ETA=10)
+    db.add_all([moving, staying])
+    db.commit()
+    mocker.patch("routes.get_distance.get_ETA", return_value=5)
+
+    # a rebalance moves the user while update_eta waits for its counter's lock
+    taken = []
+    def moving_locks(*counter_ids):
+        if not taken:
+            other = next(get_test_db())
+            other.query(UserData).filter(UserData.id == moving.id).update({"counter": second, "pos": 2})
+            other.commit()
+            other.close()
+        taken.append(counter_ids)
+        return counter_locks(*counter_ids)
+    mocker.patch("routes.get_distance.counter_locks", side_effect=moving_locks)
+
+    result = await update_eta(request=UpdateEtaReaquest(userid=moving.id, location=Location(latitude=0, longitude=0)), db=db)
+    assert result.data.update_eta == 5
+    assert taken == [(first,), (second,)]
+    db.expire_all()
+    assert [(user.name, user.pos, user.ETA) for user in db.query(UserData).filter(UserData.counter == second).order_by(UserData.pos)] == [
+        ("moved_eta_user", 1, 5), ("moved_eta_other", 2, 10)
+    ]
+
+    db.query(UserData).filter(UserData.service_id == service.id).delete()
+    db.query(Counter).filter(Counter.service_id == service.id).delete()
+    db.query(Service).filter(Service.id == service.id).delete()
+    db.commit()
@@ -0,0 +1,72 @@
+import pytest
+from database.models import Counter
+from database.db import get_db
+from utils.helpers import update_counter_stats
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def setup_counter():
+    db = next(get_test_db())
+
+    counter = Counter(service_id=None, avg_tat=0, total_tat=0, users_processed=0, in_queue=0)
+    db.add(counter)
+    db.commit()
+
+    yield db, counter.id
+
+    # Clean up
+    db.query(Counter).filter(Counter.id == counter.id).delete()
+    db.commit()
+
+@pytest.mark.asyncio
+async def test_update_counter_stats_atomic_increments(setup_counter):
+    db, counter_id = setup_counter
+
+    assert update_counter_stats(db, counter_id, in_queue_delta=1)
+    assert update_counter_stats(db, counter_id, in_queue_delta=1)
+    assert update_counter_stats(db, counter_id, in_queue_delta=-1, served_time=30)
+    assert update_counter_stats(db, counter_id, served_time=10)
+    db.commit()
+
+    counter = db.query(Counter).filter(Counter.id == counter_id).populate_existing().first()
+    assert counter.in_queue == 1
+    assert counter.users_processed == 2
+    assert counter.total_tat == 40
+    assert counter.avg_tat == 20
+    assert counter.version == 5
+
+@pytest.mark.asyncio
+async def test_update_counter_stats_in_queue_never_negative(setup_counter):
+    db, counter_id = setup_counter
+
+    assert update_counter_stats(db, counter_id, in_queue_delta=-1)
+    db.commit()
+
+    counter = db.query(Counter).filter(Counter.id == counter_id).populate_existing().first()
+    assert counter.in_queue == 0
+
+@pytest.mark.asyncio
+async def test_update_counter_stats_version_conflict(setup_counter):
+    db, counter_id = setup_counter
+    counter = db.query(Counter).filter(Counter.id == counter_id).first()
+    stale_version = counter.version
+
+    # another worker updates the counter first
+    assert update_counter_stats(db, counter_id, in_queue_delta=1)
+
+    assert update_counter_stats(db, counter_id, in_queue_delta=1, expected_version=stale_version) == False
+    assert update_counter_stats(db, counter_id, in_queue_delta=1, expected_version=stale_version + 1)
+    db.commit()
+
+@pytest.mark.asyncio
+async def test_update_counter_stats_missing_counter(setup_counter):
+    db, _ = setup_counter
+
+    assert update_counter_stats(db, 999999, in_queue_delta=1) == False
@@ -0,0 +1,93 @@
+import asyncio
+import pytest
+from datetime import datetime, timedelta
+from database.db import get_db, SessionLocal
+from database.models import ServedHistory
+from utils.history import HistoryWriter, purge_history
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def setup_db():
+    db = next(get_test_db())
+    db.query(ServedHistory).delete()
+    db.commit()
+
+    yield db
+
+    # Clean up
+    db.query(ServedHistory).delete()
+    db.commit()
+
+def served_row(user_id: int, ended_at: datetime = None):
+    ended_at = ended_at or datetime.now()
+    return dict(user_id=user_id, service_id=1, counter_id=1, service_ended_at=ended_at,
+                registered_at=ended_at - timedelta(minutes=10), service_started_at=ended_at - timedelta(minutes=2))
+
+@pytest.mark.asyncio
+async def test_history_writer_flushes_on_batch_size(setup_db):
+    db = setup_db
+    writer = HistoryWriter(SessionLocal, batch_size=5, flush_ms=60_000)
+    writer.start()
+
+    for user_id in range(5):
+        writer.add(**served_row(user_id))
+    await asyncio.sleep(0.05)
+
+    assert writer.pending() == 0
+    assert db.query(ServedHistory).count() == 5
+    await writer.stop()
+
+@pytest.mark.asyncio
+async def test_history_writer_flushes_on_interval(setup_db):
+    db = setup_db
+    writer = HistoryWriter(SessionLocal, batch_size=1000, flush_ms=20)
+    writer.start()
+
+    writer.add(**served_row(1))
+    assert db.query(ServedHistory).count() == 0
+    await asyncio.sleep(0.1)
+
+    assert db.query(ServedHistory).count() == 1
+    await writer.stop()
+
+@pytest.mark.asyncio
+async def test_history_writer_flushes_on_stop(setup_db):
+    db = setup_db
+    writer = HistoryWriter(SessionLocal, batch_size=1000, flush_ms=60_000)
+    writer.start()
+
+    for user_id in range(3):
+        writer.add(**served_row(user_id))
+    await writer.stop()
+
+    assert db.query(ServedHistory).count() == 3
+
+@pytest.mark.asyncio
+async def test_purge_history_keeps_recent_rows(setup_db):
+    db = setup_db
+    writer = HistoryWriter(SessionLocal)
+    writer.add(**served_row(1, datetime.now() - timedelta(days=100)))
+    writer.add(**served_row(2, datetime.now() - timedelta(days=10)))
+    writer.add(**served_row(3))
+    writer.flush()
+
+    deleted = purge_history(db, retention_days=30)
+
+    assert deleted == 1
+    assert sorted(user_id for (user_id,) in db.query(ServedHistory.user_id).all()) == [2, 3]
+
+def test_history_survives_a_restart(setup_db, restart_app):
+    db = setup_db
+    db.add(ServedHistory(**served_row(1)))
+    db.commit()
+
+    restart_app()
+    db.expire_all()
+    assert db.query(ServedHistory).count() == 1
@@ -0,0 +1,194 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from database.db import get_db
+from database.models import Service, Counter, UserData
+from routes.counter_operator import pop_next_user_from_queue
+from routes.user import generate_token
+from schema.distance_models import Location
+from schema.operator_models import SelectQueue
+from schema.user_models import GenerateTokenRequest
+from utils.global_settings import settings
+from utils.helpers import rebalance_q
+from utils.history import history_writer
+from utils.locks import counter_locks
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def stress_service(mocker):
+    db = next(get_test_db())
+    service = Service(name="stress_service", no_of_counters=3)
+    db.add(service)
+    db.flush()
+    counters = [Counter(service_id=service.id) for _ in range(3)]
+    db.add_all(counters)
+    db.commit()
+    counter_ids = [counter.id for counter in counters]
+    mocker.patch.object(settings, 'counters', {service.id: dict.fromkeys(counter_ids, 0)})
+    mocker.patch("routes.user.provisional_ETA", return_value=(10, True))
+    # bcrypt would dominate the run and serialize nothing
+    mocker.patch("routes.user.hash_password", return_value="x")
+    mocker.patch.object(history_writer, 'add')
+
+    yield db, service.id, counter_ids
+
+    # Clean up
+    db.query(UserData).filter(UserData.service_id == service.id).delete()
+    db.query(Counter).filter(Counter.service_id == service.id).delete()
+    db.query(Service).filter(Service.id == service.id).delete()
+    db.commit()
+    db.close()
+
+
+async def _bump(counts: dict, counter_id: int):
+    # read-modify-write with a yield point in the middle, the classic lost update
+    async with counter_locks(counter_id):
+        current = counts[counter_id]
+        await asyncio.sleep(0)
+        counts[counter_id] = current + 1
+
+
+@pytest.mark.asyncio
+async def test_counter_locks_no_lost_updates():
+    counts = {1: 0, 2: 0, 3: 0}
+
+    await asyncio.gather(*[_bump(counts, counter_id) for _ in range(500) for counter_id in counts])
+
+    assert counts == {1: 500, 2: 500, 3: 500}
+
+
+@pytest.mark.asyncio
+async def test_counter_locks_independent_counters_run_in_parallel():
+    inside = set()
+    overlapped = asyncio.Event()
+
+    async def work(counter_id: int):
+        async with counter_locks(counter_id):
+            inside.add(counter_id)
+            if len(inside) > 1:
+                overlapped.set()
+            await asyncio.sleep(0.01)
+            inside.discard(counter_id)
+
+    await asyncio.gather(work(1), work(2))
+
+    assert overlapped.is_set()
+
+
+@pytest.mark.asyncio
+async def test_counter_locks_same_counter_is_serialized():
+    inside = []
+    max_inside = 0
+
+    async def work():
+        nonlocal max_inside
+        async with counter_locks(7):
+            inside.append(1)
+            max_inside = max(max_inside, len(inside))
+            await asyncio.sleep(0)
+            inside.pop()
+
+    await asyncio.gather(*[work() for _ in range(50)])
+
+    assert max_inside == 1
+
+
+@pytest.mark.asyncio
+async def test_counter_locks_pairs_do_not_deadlock():
+    counts = {1: 0, 2: 0}
+
+    async def move(src: int, dst: int):
+        async with counter_locks(src, dst):
+            counts[src] -= 1
+            await asyncio.sleep(0)
+            counts[dst] += 1
+
+    await asyncio.wait_for(
+        asyncio.gather(*[move(1, 2) if i % 2 else move(2, 1) for i in range(200)]),
+        timeout=5
+    )
+
+    assert counts == {1: 0, 2: 0}
+
+
+@pytest.mark.asyncio
+async def test_adjust_counter_load_stress(mocker):
+    from utils.global_settings import settings
+    from utils.helpers import adjust_counter_load
+
+    mocker.patch.object(settings, 'counters', {1: {1: 0, 2: 0}, 2: {3: 0}})
+
+    async def register_then_pop(service_id: int, counter_id: int):
+        async with counter_locks(counter_id):
+            adjust_counter_load(service_id, counter_id, 1)
+        await asyncio.sleep(0)
+        async with counter_locks(counter_id):
+            adjust_counter_load(service_id, counter_id, -1)
+
+    async def register(service_id: int, counter_id: int):
+        async with counter_locks(counter_id):
+            adjust_counter_load(service_id, counter_id, 1)
+
+    jobs = []
+    for _ in range(300):
+        jobs += [register_then_pop(1, 1), register(1, 2), register_then_pop(2, 3)]
+    await asyncio.gather(*jobs)
+
+    assert settings.counters == {1: {1: 0, 2: 300}, 2: {3: 0}}
+
+
+@pytest.mark.asyncio
+async def test_routes_keep_counter_loads_consistent_under_stress(stress_service):
+    db, service_id, counter_ids = stress_service
+
+    # every call gets its own session, like concurrent requests
+    async def register(index: int):
+        session = next(get_test_db())
+        try:
+            request = GenerateTokenRequest(name=f"stress_user_{index}", password="x", service_id=service_id,
+                                           location=Location(latitude=1, longitude=1))
+            await generate_token(request, db=session)
+        finally:
+            session.close()
+
+    async def pop(counter_id: int):
+        session = next(get_test_db())
+        try:
+            await pop_next_user_from_queue(SelectQueue(service_id=service_id, counter=counter_id), db=session)
+        except HTTPException as e:
+            # the counter's queue may be empty at this point
+            assert e.status_code == 404
+        finally:
+            session.close()
+
+    async def rebalance():
+        session = next(get_test_db())
+        try:
+            await rebalance_q(service_id, session)
+        finally:
+            session.close()
+
+    jobs = []
+    for index in range(60):
+        jobs.append(register(index))
+        if index % 2:
+            jobs.append(pop(counter_ids[index % 3]))
+        if index % 5 == 0:
+            jobs.append(rebalance())
+    await asyncio.wait_for(asyncio.gather(*jobs), timeout=60)
+
+    db.expire_all()
+    for counter_id in counter_ids:
+        positions = [pos for (pos,) in db.query(UserData.pos).filter(UserData.counter == counter_id).order_by(UserData.pos)]
+        assert positions == list(range(1, len(positions) + 1))
+        assert db.get(Counter, counter_id).in_queue == len(positions)
+        assert settings.counters[service_id][counter_id] == len(positions)
+    assert history_writer.add.call_count > 0
+    assert db.query(UserData).filter(UserData.service_id == service_id).count() == 60 - history_writer.add.call_count
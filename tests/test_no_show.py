@@ -0,0 +1,73 @@
+import pytest
+from datetime import timedelta
+from database.db import get_db
+from database.models import Service, Counter, UserData
+from utils.clock import clock
+from utils.global_settings import settings
+from utils.no_show import NoShowSweeper
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def swept_counter(mocker):
+    db = next(get_test_db())
+    service = Service(name="no_show_service", no_of_counters=1)
+    db.add(service)
+    db.flush()
+    counter = Counter(service_id=service.id, in_queue=4)
+    db.add(counter)
+    db.commit()
+    mocker.patch.object(settings, 'counters', {service.id: {counter.id: 4}})
+    mocker.patch.object(settings, 'no_show_grace_s', 600.0)
+    mocker.patch.object(settings, 'no_show_demote_minutes', 10)
+    mocker.patch.object(settings, 'max_skip_count', 2)
+
+    yield db, service.id, counter.id
+
+    # Clean up
+    db.query(UserData).filter(UserData.service_id == service.id).delete()
+    db.query(Counter).filter(Counter.id == counter.id).delete()
+    db.query(Service).filter(Service.id == service.id).delete()
+    db.commit()
+    db.close()
+
+@pytest.mark.asyncio
+async def test_no_shows_are_demoted_then_evicted(swept_counter):
+    db, service_id, counter_id = swept_counter
+    an_hour_ago = clock.now() - timedelta(hours=1)
+    users = [
+        # name, ETA, skip_count, eta_updated_at
+        ("late_once", 5, 0, an_hour_ago),
+        ("late_again", 10, 2, an_hour_ago),
+        ("on_time", 30, 0, clock.now()),
+        ("skipped_too_often", 40, 3, clock.now()),
+    ]
+    for pos, (name, eta, skip_count, updated_at) in enumerate(users, start=1):
+        db.add(UserData(name=name, hashed_password="x", counter=counter_id, service_id=service_id, pos=pos, ETA=eta,
+                        skip_count=skip_count, eta_updated_at=updated_at))
+    db.commit()
+
+    assert await NoShowSweeper().sweep() == (1, 2)
+    db.expire_all()
+    queue = db.query(UserData.name, UserData.pos, UserData.skip_count, UserData.skip_offset).filter(UserData.counter == counter_id).order_by(UserData.pos)
+    # 55 minutes late, late_once is held back to 10 minutes from now and ranks with an ETA of 70
+    assert [tuple(row) for row in queue] == [("on_time", 1, 0, 0), ("late_once", 2, 1, 65)]
+    assert db.get(Counter, counter_id).in_queue == 2
+    assert settings.counters[service_id][counter_id] == 2
+
+    # the demotion moved its predicted arrival, so it is not swept again right away
+    assert await NoShowSweeper().sweep() == (0, 0)
+
+@pytest.mark.asyncio
+async def test_arrived_users_are_never_no_shows(swept_counter):
+    db, service_id, counter_id = swept_counter
+    db.add(UserData(name="here_already", hashed_password="x", counter=counter_id, service_id=service_id, pos=1, ETA=0,
+                    eta_updated_at=clock.now() - timedelta(hours=2), arrived_at=clock.now()))
+    db.commit()
+    assert await NoShowSweeper().sweep() == (0, 0)
@@ -0,0 +1,127 @@
+import pytest
+from datetime import timedelta
+from database.db import get_db
+from database.models import Service, Counter, UserData
+from utils.clock import clock
+from utils.global_settings import settings
+from utils.aging import PriorityAger
+from utils.helpers import resort_counter, insert_ranked, move_to_rank, remove_ranked
+from utils.priority import effective_level, rank_order, rank_key, priority_level
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def aging(mocker):
+    mocker.patch.object(settings, 'priority_levels', {"regular": 0, "vip": 1, "elderly": 2, "disabled": 2})
+    mocker.patch.object(settings, 'priority_aging_s', 600.0)
+
+def test_waiting_raises_the_level_up_to_the_top(aging):
+    now = clock.now()
+    assert effective_level(0, now, now) == 0
+    assert effective_level(0, now - timedelta(minutes=10), now) == 1
+    assert effective_level(1, now - timedelta(hours=5), now) == 2
+    assert effective_level(priority_level("disabled"), now - timedelta(hours=5), now) == 2
+
+def test_rank_order_is_by_level_then_eta(aging):
+    users = [
+        {"id": 1, "priority": 0, "rank_level": 0, "ETA": 0},
+        {"id": 2, "priority": 2, "rank_level": 2, "ETA": 20},
+        {"id": 3, "priority": 1, "rank_level": 1, "ETA": 5},
+        # a regular user aged into the VIP level ranks with the VIPs
+        {"id": 4, "priority": 0, "rank_level": 1, "ETA": 1},
+    ]
+    assert [user["id"] for user in rank_order(users)] == [2, 4, 3, 1]
+
+def test_aging_can_be_disabled(aging, mocker):
+    mocker.patch.object(settings, 'priority_aging_s', 0)
+    now = clock.now()
+    assert effective_level(0, now - timedelta(days=1), now) == 0
+
+@pytest.mark.asyncio
+async def test_resort_counter_serves_higher_classes_first(aging):
+    db = next(get_test_db())
+    service = Service(name="priority_service", no_of_counters=1)
+    db.add(service)
+    db.flush()
+    counter = Counter(service_id=service.id)
+    db.add(counter)
+    db.flush()
+    for name, eta, priority in (("p_regular", 0, 0), ("p_vip", 30, 1), ("p_elderly", 40, 2), ("p_regular_late", 10, 0)):
+        db.add(UserData(name=name, hashed_password="x", counter=counter.id, pos=0, service_id=service.id, ETA=eta, priority=priority))
+    db.flush()
+    try:
+        users = resort_counter(db, counter.id)
+        assert [(user.name, user.pos) for user in users] == [
+            ("p_elderly", 1), ("p_vip", 2), ("p_regular", 3), ("p_regular_late", 4)
+        ]
+    finally:
+        db.rollback()
+        db.close()
+
+@pytest.fixture
+def ranked_counter(aging):
+    db = next(get_test_db())
+    service = Service(name="ranked_service", no_of_counters=1)
+    db.add(service)
+    db.flush()
+    counter = Counter(service_id=service.id)
+    db.add(counter)
+    db.commit()
+
+    yield db, service.id, counter.id
+
+    # Clean up
+    db.rollback()
+    db.query(UserData).filter(UserData.service_id == service.id).delete()
+    db.query(Counter).filter(Counter.id == counter.id).delete()
+    db.query(Service).filter(Service.id == service.id).delete()
+    db.commit()
+    db.close()
+
+def stored_order(db, counter_id):
+    db.expire_all()
+    return db.query(UserData).filter(UserData.counter == counter_id).order_by(UserData.pos).all()
+
+def test_ranked_changes_keep_the_stored_order(ranked_counter):
+    db, service_id, counter_id = ranked_counter
+    users = {}
+    for name, eta, priority in (("r_1", 30, 0), ("r_2", 5, 0), ("r_3", 40, 2), ("r_4", 12, 1), ("r_5", 12, 0), ("r_6", 1, 0)):
+        users[name] = UserData(name=name, hashed_password="x", counter=counter_id, service_id=service_id, ETA=eta, priority=priority)
+        insert_ranked(db, users[name])
+    queue = stored_order(db, counter_id)
+    assert [user.name for user in queue] == ["r_3", "r_4", "r_6", "r_2", "r_5", "r_1"]
+    assert [user.pos for user in queue] == [1, 2, 3, 4, 5, 6]
+
+    users["r_1"].ETA = 0
+    move_to_rank(db, users["r_1"])
+    users["r_4"].ETA = 60
+    move_to_rank(db, users["r_4"])
+    remove_ranked(db, users["r_6"])
+    queue = stored_order(db, counter_id)
+    assert [user.name for user in queue] == ["r_3", "r_4", "r_1", "r_2", "r_5"]
+    assert [user.pos for user in queue] == [1, 2, 3, 4, 5]
+    assert [user.name for user in queue] == [user.name for user in sorted(queue, key=rank_key)]
+
+@pytest.mark.asyncio
+async def test_aging_promotes_waiting_users_in_the_stored_order(ranked_counter):
+    db, service_id, counter_id = ranked_counter
+    now = clock.now()
+    for name, eta, priority, waited in (("a_vip", 5, 1, 0), ("a_new", 1, 0, 0), ("a_old", 20, 0, 25), ("a_older", 30, 0, 15)):
+        insert_ranked(db, UserData(name=name, hashed_password="x", counter=counter_id, service_id=service_id, ETA=eta,
+                                   priority=priority, registered_at=now - timedelta(minutes=waited)))
+    db.commit()
+    assert [user.name for user in stored_order(db, counter_id)] == ["a_vip", "a_new", "a_old", "a_older"]
+
+    # 25 minutes raise a regular user to the top level, 15 minutes to the VIP level
+    assert await PriorityAger().age(now) == 2
+    queue = stored_order(db, counter_id)
+    assert [(user.name, user.rank_level, user.pos) for user in queue] == [
+        ("a_old", 2, 1), ("a_vip", 1, 2), ("a_older", 1, 3), ("a_new", 0, 4)
+    ]
+    assert await PriorityAger().age(now) == 0
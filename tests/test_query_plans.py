@@ -0,0 +1,111 @@
+import pytest
+from sqlalchemy import text
+from database.models import Service, Counter, UserData
+from database.db import get_db
+from database.migrations import apply_migrations, _0015_eta_updated_at_utc
+from datetime import datetime, timezone
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def setup_db():
+    db = next(get_test_db())
+    apply_migrations(db.get_bind())
+
+    # enough rows that the planner prefers an index over scanning the table
+    service = Service(name="plan_service", no_of_counters=10)
+    db.add(service)
+    db.flush()
+    counters = [Counter(service_id=service.id) for _ in range(10)]
+    db.add_all(counters)
+    db.flush()
+    db.add_all([
+        UserData(name=f"plan_user_{i}", hashed_password="x", service_id=service.id,
+                 counter=counters[i % 10].id, pos=i // 10 + 1, ETA=(i * 7) % 60)
+        for i in range(2000)
+    ])
+    db.commit()
+    if db.get_bind().dialect.name == "mysql":
+        db.execute(text("ANALYZE TABLE user_data"))
+    else:
+        db.execute(text("ANALYZE"))
+
+    yield db, service.id, counters[0].id
+
+    # Clean up
+    db.query(UserData).filter(UserData.service_id == service.id).delete()
+    db.query(Counter).filter(Counter.service_id == service.id).delete()
+    db.query(Service).filter(Service.id == service.id).delete()
+    db.commit()
+
+def explain(db, query):
+    """Return the plan lines of a query as lower-case strings."""
+    dialect = db.get_bind().dialect
+    sql = str(query.statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+    if dialect.name == "mysql":
+        rows = db.execute(text("EXPLAIN " + sql)).mappings().all()
+        return [f"type={row['type']} key={row['key']} extra={row['Extra']}".lower() for row in rows]
+    return [str(row[-1]).lower() for row in db.execute(text("EXPLAIN QUERY PLAN " + sql)).all()]
+
+def assert_index_ordered(plan):
+    for line in plan:
+        # a full table scan
+        assert "type=all" not in line and not line.startswith("scan user_data"), plan
+        # an explicit sort step instead of reading in index order
+        assert "filesort" not in line and "temp b-tree" not in line, plan
+    assert any("ix_user_data_counter" in line or "ix_user_data_service_queue" in line for line in plan), plan
+
+def hot_queries(db, service_id, counter_id):
+    # the per-counter reads of generate_token, pop_next_user_from_queue, update_eta, is_here and rebalance_q
+    return {
+        "head_by_pos": db.query(UserData)
+            .filter(UserData.service_id == service_id, UserData.counter == counter_id)
+            .order_by(UserData.pos),
+        "counter_by_pos": db.query(UserData)
+            .filter(UserData.counter == counter_id)
+            .order_by(UserData.pos),
+        "service_counter_by_eta": db.query(UserData)
+            .filter(UserData.service_id == service_id, UserData.counter == counter_id)
+            .order_by(UserData.ETA),
+        "counter_by_eta": db.query(UserData)
+            .filter(UserData.counter == counter_id)
+            .order_by(UserData.ETA),
+        "counter_at_pos": db.query(UserData)
+            .filter(UserData.counter == counter_id, UserData.pos == 3),
+        # the shared queue of a service in the shared queue mode
+        "shared_queue_by_pos": db.query(UserData)
+            .filter(UserData.service_id == service_id, UserData.counter.is_(None))
+            .order_by(UserData.pos),
+    }
+
+@pytest.mark.parametrize("name", ["head_by_pos", "counter_by_pos", "service_counter_by_eta", "counter_by_eta", "counter_at_pos", "shared_queue_by_pos"])
+def test_hot_query_uses_composite_index(setup_db, name):
+    db, service_id, counter_id = setup_db
+
+    plan = explain(db, hot_queries(db, service_id, counter_id)[name])
+
+    assert_index_ordered(plan)
+
+def test_apply_migrations_is_idempotent(setup_db):
+    db, _, _ = setup_db
+
+    assert apply_migrations(db.get_bind()) == []
+
+def test_eta_updated_at_is_converted_to_utc(setup_db):
+    db, service_id, counter_id = setup_db
+    user_id = db.query(UserData.id).filter(UserData.name == "plan_user_0").scalar()
+    written = datetime(2026, 1, 15, 9, 30, 0, 250000)
+    # as the routes wrote it before: naive local time
+    db.execute(text("UPDATE user_data SET eta_updated_at = :written WHERE id = :user_id"), {"written": written, "user_id": user_id})
+    db.commit()
+
+    with db.get_bind().begin() as connection:
+        _0015_eta_updated_at_utc(connection)
+    db.expire_all()
+    assert db.get(UserData, user_id).eta_updated_at == written.astimezone(timezone.utc)
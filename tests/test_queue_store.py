@@ -0,0 +1,110 @@
+import pytest
+from database.db import get_db
+from database.models import Service, Counter, UserData
+from routes.counter_operator import pop_next_user_from_queue
+from routes.get_distance import update_eta
+from routes.user import generate_token
+from schema.distance_models import Location, UpdateEtaReaquest
+from schema.operator_models import SelectQueue
+from schema.user_models import GenerateTokenRequest
+from utils.assignment import counter_assignment
+from utils.global_settings import settings
+from utils.history import history_writer
+from utils.queue_store import queue_store
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def write_behind(mocker):
+    db = next(get_test_db())
+    service = Service(name="store_service", no_of_counters=1)
+    db.add(service)
+    db.flush()
+    counter = Counter(service_id=service.id)
+    db.add(counter)
+    db.commit()
+    mocker.patch.object(settings, 'persistence_mode', "write_behind")
+    mocker.patch.object(settings, 'counters', {service.id: {counter.id: 0}})
+    counter_assignment.reset()
+    mocker.patch("routes.user.eta_refresher.resolve_soon")
+    mocker.patch("routes.counter_operator.rebalance_q")
+    mocker.patch("routes.get_distance.is_within_geofence", return_value=False)
+    mocker.patch.object(history_writer, 'add')
+
+    yield db, service.id, counter.id
+
+    # Clean up
+    queue_store.release()
+    db.query(UserData).filter(UserData.service_id == service.id).delete()
+    db.query(Counter).filter(Counter.id == counter.id).delete()
+    db.query(Service).filter(Service.id == service.id).delete()
+    db.commit()
+
+async def register(db, service_id, mocker, name, eta):
+    mocker.patch("routes.user.provisional_ETA", return_value=(eta, True))
+    request = GenerateTokenRequest(name=name, password="x", service_id=service_id, location=Location(latitude=eta, longitude=0))
+    return (await generate_token(request, db=db)).data
+
+def stored(db, counter_id):
+    db.expire_all()
+    return [(user.name, user.pos, user.ETA) for user in db.query(UserData).filter(UserData.counter == counter_id).order_by(UserData.pos)]
+
+@pytest.mark.asyncio
+async def test_queue_changes_are_written_behind(write_behind, mocker):
+    db, service_id, counter_id = write_behind
+    await register(db, service_id, mocker, "store_a", 30)
+    second = await register(db, service_id, mocker, "store_b", 10)
+
+    assert second.pos == 1
+    # the rows exist, their positions are still waiting for the flush
+    assert stored(db, counter_id) == [("store_a", 0, 30), ("store_b", 0, 10)]
+    assert queue_store.flush() == 2
+    assert stored(db, counter_id) == [("store_b", 1, 10), ("store_a", 2, 30)]
+
+    get_eta = mocker.patch("routes.get_distance.get_ETA", return_value=0)
+    await update_eta(request=UpdateEtaReaquest(userid=db.query(UserData.id).filter(UserData.name == "store_a").scalar(),
+                                               location=Location(latitude=1, longitude=1)), db=db)
+    get_eta.assert_called_once()
+    await pop_next_user_from_queue(SelectQueue(service_id=service_id, counter=counter_id), db=db)
+    served = history_writer.add.call_args.kwargs
+    assert served["service_started_at"] is not None and "served_time" not in served
+
+    queue_store.flush()
+    assert stored(db, counter_id) == [("store_b", 1, 10)]
+    counter = db.get(Counter, counter_id)
+    assert (counter.in_queue, counter.users_processed) == (1, 1)
+    assert settings.counters[service_id][counter_id] == 1
+
+@pytest.mark.asyncio
+async def test_empty_queue_pop_is_not_found(write_behind):
+    db, service_id, counter_id = write_behind
+    with pytest.raises(Exception) as error:
+        await pop_next_user_from_queue(SelectQueue(service_id=service_id, counter=counter_id), db=db)
+    assert error.value.status_code == 404
+
+@pytest.mark.asyncio
+async def test_release_hands_counters_back_to_the_database(write_behind, mocker):
+    db, service_id, counter_id = write_behind
+    await register(db, service_id, mocker, "store_a", 5)
+    queue_store.release(counter_id)
+    assert queue_store.pending() == 0
+    assert stored(db, counter_id) == [("store_a", 1, 5)]
+
+    # changed directly in the database, the store reloads it on next use
+    db.query(UserData).filter(UserData.name == "store_a").update({"ETA": 7})
+    db.commit()
+    assert [user["ETA"] for user in queue_store.queue(db, counter_id)] == [7]
+
+@pytest.mark.asyncio
+async def test_log_durability_waits_for_the_event_log(write_behind, mocker):
+    db, service_id, _ = write_behind
+    mocker.patch.object(settings, 'write_behind_durability', "log")
+    sync = mocker.patch("utils.queue_store.event_log.sync")
+    await register(db, service_id, mocker, "store_a", 5)
+    sync.assert_awaited_once()
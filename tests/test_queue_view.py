@@ -0,0 +1,194 @@
+import pytest
+from sqlalchemy import event
+from database.db import get_db, engine
+from database.models import Service, Counter, UserData
+from routes.counter_operator import get_snapshot, get_changes
+from utils.queue_view import QueueView
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def branch():
+    db = next(get_test_db())
+    services = [Service(name="view_a", no_of_counters=2), Service(name="view_b", no_of_counters=1, queue_mode="shared")]
+    db.add_all(services)
+    db.flush()
+    counters = [Counter(service_id=services[0].id), Counter(service_id=services[0].id), Counter(service_id=services[1].id)]
+    db.add_all(counters)
+    db.flush()
+    db.add_all([
+        UserData(name="view_1", hashed_password="x", service_id=services[0].id, counter=counters[0].id, pos=2, ETA=9),
+        UserData(name="view_2", hashed_password="x", service_id=services[0].id, counter=counters[0].id, pos=1, ETA=3),
+        UserData(name="view_3", hashed_password="x", service_id=services[1].id, counter=None, pos=1, ETA=5),
+    ])
+    db.commit()
+
+    yield db, [service.id for service in services], [counter.id for counter in counters]
+
+    # Clean up
+    for service in services:
+        db.query(UserData).filter(UserData.service_id == service.id).delete()
+        db.query(Counter).filter(Counter.service_id == service.id).delete()
+        db.query(Service).filter(Service.id == service.id).delete()
+    db.commit()
+
+@pytest.fixture
+def statements():
+    executed = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            executed.append(statement)
+    event.listen(engine, "before_cursor_execute", count)
+    yield executed
+    event.remove(engine, "before_cursor_execute", count)
+
+def services_by_name(snapshot):
+    return {service["name"]: service for service in snapshot["services"]}
+
+def test_snapshot_lists_queues_and_heads(branch):
+    db, _, (counter_a, counter_b, _) = branch
+    snapshot = services_by_name(QueueView().snapshot(db))
+
+    counters = {counter["id"]: counter for counter in snapshot["view_a"]["counters"]}
+    assert counters[counter_a]["queue_length"] == 2
+    assert counters[counter_a]["head"]["name"] == "view_2"
+    assert counters[counter_b] == {"id": counter_b, "queue_length": 0, "avg_tat": 0, "users_processed": 0, "head": None}
+    assert (snapshot["view_b"]["waiting"], snapshot["view_b"]["head"]["name"]) == (1, "view_3")
+
+def test_only_touched_services_are_reloaded(branch, statements):
+    db, (service_a, service_b), (counter_a, _, _) = branch
+    view = QueueView()
+    view.snapshot(db)
+    statements.clear()
+
+    # nothing changed, no queries at all
+    view.snapshot(db)
+    assert statements == []
+
+    db.query(UserData).filter(UserData.name == "view_2").delete()
+    db.commit()
+    version = view.version
+    view.touch(service_a)
+    snapshot = services_by_name(view.snapshot(db))
+    assert len(statements) == 3
+    # the touch and the reload
+    assert view.version == version + 2
+    counter = next(counter for counter in snapshot["view_a"]["counters"] if counter["id"] == counter_a)
+    assert (counter["queue_length"], counter["head"]["name"]) == (1, "view_1")
+    assert snapshot["view_b"]["version"] < snapshot["view_a"]["version"]
+
+def test_deleted_service_leaves_the_view(branch):
+    db, (_, service_b), _ = branch
+    view = QueueView()
+    view.snapshot(db)
+    db.query(UserData).filter(UserData.service_id == service_b).delete()
+    db.query(Counter).filter(Counter.service_id == service_b).delete()
+    db.query(Service).filter(Service.id == service_b).delete()
+    db.commit()
+    view.touch(service_b)
+    assert "view_b" not in services_by_name(view.snapshot(db))
+
+@pytest.mark.asyncio
+async def test_snapshot_endpoint(branch, mocker):
+    db, _, _ = branch
+    mocker.patch("routes.counter_operator.queue_view", QueueView())
+    response = await get_snapshot(db=db)
+    assert response.status_code == 200
+    assert {"view_a", "view_b"} <= {service.name for service in response.data.services}
+
+def test_changes_since_a_version(branch):
+    db, (service_a, _), (counter_a, counter_b, _) = branch
+    view = QueueView()
+    since = view.snapshot(db)["version"]
+    assert view.changes(db, since) == []
+
+    user = db.query(UserData).filter(UserData.name == "view_1").one()
+    user.counter, user.pos = counter_b, 1
+    db.commit()
+    view.touch(service_a)
+    user.ETA = 1
+    db.commit()
+    view.touch(service_a)
+
+    changes = view.changes(db, since)
+    # both updates of the user collapse into its latest state
+    assert [(change["kind"], change["id"], change["counter"], change["ETA"]) for change in changes] == [("user", user.id, counter_b, 1)]
+    assert view.changes(db, view.version) == []
+
+    db.delete(user)
+    db.commit()
+    view.touch(service_a)
+    assert view.changes(db, since)[-1] == {"version": view.version, "kind": "user", "id": user.id, "service_id": service_a, "removed": True}
+
+def test_clients_behind_the_ring_buffer_need_a_snapshot(branch):
+    db, (service_a, _), _ = branch
+    view = QueueView(log_size=2)
+    since = view.snapshot(db)["version"]
+    users = db.query(UserData).filter(UserData.service_id == service_a).all()
+    for eta in (20, 30):
+        for user in users:
+            user.ETA = eta
+        db.commit()
+        view.touch(service_a)
+        view.sync(db)
+    assert view.changes(db, since) is None
+    assert len(view.changes(db, view.floor)) == 2
+    # a version from another process or before a restart
+    assert view.changes(db, view.version + 5) is None
+
+@pytest.mark.asyncio
+async def test_changes_endpoint_falls_back_to_a_snapshot(branch, mocker):
+    db, _, _ = branch
+    view = QueueView(log_size=1)
+    mocker.patch("routes.counter_operator.queue_view", view)
+    view.snapshot(db)
+    response = await get_changes(since=0, db=db)
+    assert response.data.snapshot is not None and response.data.changes == []
+    response = await get_changes(since=response.data.version, db=db)
+    assert response.data.snapshot is None
+
+def test_deltas_need_no_reload_and_match_one(branch, statements):
+    db, (service_a, service_b), (counter_a, counter_b, counter_c) = branch
+    view = QueueView()
+    since = view.snapshot(db)["version"]
+    first, second = (db.query(UserData).filter(UserData.name == name).one() for name in ("view_2", "view_1"))
+
+    # the rows are changed like the request paths do, the view only gets the deltas
+    new = UserData(name="view_4", hashed_password="x", service_id=service_a, counter=counter_a, pos=1, ETA=0)
+    first.pos, second.pos = 2, 3
+    db.add(new)
+    db.commit()
+    view.register(service_a, new.id, counter_a, "view_4", 1, 0)
+    second.counter, second.pos, second.ETA = counter_b, 1, 4
+    db.commit()
+    view.move(service_a, second.id, counter_b, 1, 4)
+    db.delete(new)
+    first.pos = 1
+    db.commit()
+    view.remove(service_a, new.id, served_time=60.0)
+    statements.clear()
+
+    snapshot = services_by_name(view.snapshot(db))
+    assert statements == []
+    counters = {counter["id"]: counter for counter in snapshot["view_a"]["counters"]}
+    assert (counters[counter_a]["queue_length"], counters[counter_a]["head"]["name"]) == (1, "view_2")
+    assert (counters[counter_b]["head"]["name"], counters[counter_b]["head"]["ETA"]) == ("view_1", 4)
+    assert (counters[counter_a]["avg_tat"], counters[counter_a]["users_processed"]) == (60.0, 1)
+    changes = view.changes(db, since)
+    assert {(change["id"], change.get("removed", False)) for change in changes if change["kind"] == "user"} >= {
+        (new.id, True), (first.id, False), (second.id, False)
+    }
+
+    # a stale service falls back to a reload
+    view.touch(service_b)
+    view.register(service_b, 10**6, None, "view_ghost", 1, 0)
+    statements.clear()
+    reloaded = services_by_name(view.snapshot(db))
+    assert reloaded["view_b"]["waiting"] == 1
+    assert len(statements) == 3
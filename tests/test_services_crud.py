@@ -5,6 +5,7 @@ from routes.services_crud import add_service, update_service, delete_service
 from schema.services_models import CreateServiceRequest, UpdateServiceRequest
 from fastapi import HTTPException
 from database.db import get_db
+from database.models import Counter
 from main import app
 
 client = TestClient(app)
@@ -209,3 +210,15 @@ async def test_delete_service_with_active_users(mocker, setup_db):
     except HTTPException as e:
         assert e.status_code == 400  # Bad Request
         assert 'Service has active users in its queues.' in e.detail
+
+@pytest.mark.asyncio
+async def test_add_service_allocates_unique_counter_ids(setup_db):
+    db = setup_db
+
+    # Request simulation
+    await add_service(CreateServiceRequest(name="service_a", no_of_counters=3), db)
+    await add_service(CreateServiceRequest(name="service_b", no_of_counters=2), db)
+
+    counter_ids = [counter_id for (counter_id,) in db.query(Counter.id).all()]
+    assert len(counter_ids) == 5
+    assert len(set(counter_ids)) == 5
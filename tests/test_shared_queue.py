@@ -0,0 +1,131 @@
+import pytest
+from database.db import get_db, SessionLocal
+from database.models import Service, Counter, UserData
+from routes.counter_operator import pop_next_user_from_queue
+from routes.get_distance import update_eta
+from routes.user import generate_token
+from schema.distance_models import Location, UpdateEtaReaquest
+from schema.operator_models import SelectQueue
+from schema.user_models import GenerateTokenRequest
+from utils.assignment import counter_assignment
+from utils.eta_refresher import EtaRefresher
+from utils.global_settings import settings
+from utils.history import history_writer
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def shared_service(mocker):
+    db = next(get_test_db())
+    service = Service(name="shared_service", no_of_counters=2, queue_mode="shared")
+    db.add(service)
+    db.flush()
+    counters = [Counter(service_id=service.id), Counter(service_id=service.id)]
+    db.add_all(counters)
+    db.commit()
+    counter_ids = [counter.id for counter in counters]
+    mocker.patch.object(settings, 'counters', {service.id: dict.fromkeys(counter_ids, 0)})
+    counter_assignment.set_queue_mode(service.id, "shared")
+    mocker.patch("routes.user.eta_refresher.resolve_soon")
+    mocker.patch.object(history_writer, 'add')
+
+    yield db, service.id, counter_ids
+
+    # Clean up
+    counter_assignment.queue_modes.pop(service.id, None)
+    db.query(UserData).filter(UserData.service_id == service.id).delete()
+    db.query(Counter).filter(Counter.service_id == service.id).delete()
+    db.query(Service).filter(Service.id == service.id).delete()
+    db.commit()
+
+async def register(db, service_id, mocker, name, eta):
+    mocker.patch("routes.user.provisional_ETA", return_value=(eta, True))
+    request = GenerateTokenRequest(name=name, password="x", service_id=service_id, location=Location(latitude=eta, longitude=0))
+    return (await generate_token(request, db=db)).data
+
+def queue_state(db, service_id):
+    users = db.query(UserData).filter(UserData.service_id == service_id).order_by(UserData.id).populate_existing().all()
+    return {user.name: (user.counter, user.pos) for user in users}
+
+@pytest.mark.asyncio
+async def test_users_join_one_eta_ordered_queue(shared_service, mocker):
+    db, service_id, _ = shared_service
+
+    first = await register(db, service_id, mocker, "shared_a", 30)
+    await register(db, service_id, mocker, "shared_b", 10)
+    await register(db, service_id, mocker, "shared_c", 20)
+
+    assert first.counter is None
+    assert queue_state(db, service_id) == {"shared_a": (None, 3), "shared_b": (None, 1), "shared_c": (None, 2)}
+
+@pytest.mark.asyncio
+async def test_free_counters_take_the_head_of_the_queue(shared_service, mocker):
+    db, service_id, (counter_a, counter_b) = shared_service
+    # arrived users, so the called ones are served right away
+    for name, eta in [("shared_a", 0), ("shared_b", 0), ("shared_c", 0)]:
+        await register(db, service_id, mocker, name, eta)
+    rebalance = mocker.patch("routes.counter_operator.rebalance_q")
+
+    await pop_next_user_from_queue(SelectQueue(service_id=service_id, counter=counter_a), db=db)
+    await pop_next_user_from_queue(SelectQueue(service_id=service_id, counter=counter_b), db=db)
+    assert queue_state(db, service_id) == {"shared_a": (counter_a, 1), "shared_b": (counter_b, 1), "shared_c": (None, 1)}
+
+    # counter b finishes first and calls the next user, counter a is still serving
+    await pop_next_user_from_queue(SelectQueue(service_id=service_id, counter=counter_b), db=db)
+    assert queue_state(db, service_id) == {"shared_a": (counter_a, 1), "shared_c": (counter_b, 1)}
+    served = history_writer.add.call_args.kwargs
+    assert (served["counter_id"], served["service_started_at"] is not None) == (counter_b, True)
+
+    db.expire_all()
+    assert db.get(Counter, counter_b).users_processed == 1
+    # measured from the service start, not from registration
+    assert 0 <= db.get(Counter, counter_b).avg_tat < 5
+    assert served["arrived_at"] <= served["service_started_at"] <= served["service_ended_at"]
+    assert settings.counters[service_id] == {counter_a: 1, counter_b: 1}
+    rebalance.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_called_user_is_served_once_it_arrives(shared_service, mocker):
+    db, service_id, (counter_a, _) = shared_service
+    user = await register(db, service_id, mocker, "shared_a", 20)
+
+    await pop_next_user_from_queue(SelectQueue(service_id=service_id, counter=counter_a), db=db)
+    called = db.get(UserData, user.id, populate_existing=True)
+    assert (called.counter, called.pos) == (counter_a, 1)
+    # still on the way, neither arrived nor served yet
+    assert (called.arrived_at, called.service_started_at) == (None, None)
+
+    mocker.patch("routes.get_distance.get_ETA", return_value=0)
+    await update_eta(UpdateEtaReaquest(userid=user.id, location=Location(latitude=1, longitude=1)), db=db)
+    arrived = db.get(UserData, user.id, populate_existing=True)
+    assert arrived.arrived_at is not None
+    assert arrived.service_started_at >= arrived.arrived_at
+
+@pytest.mark.asyncio
+async def test_idle_counter_with_empty_queue_is_not_found(shared_service):
+    db, service_id, (counter_a, _) = shared_service
+    with pytest.raises(Exception) as error:
+        await pop_next_user_from_queue(SelectQueue(service_id=service_id, counter=counter_a), db=db)
+    assert error.value.status_code == 404
+
+@pytest.mark.asyncio
+async def test_refresher_resorts_the_shared_queue(shared_service, mocker):
+    db, service_id, _ = shared_service
+    for name, eta in [("shared_a", 10), ("shared_b", 20)]:
+        await register(db, service_id, mocker, name, eta)
+
+    async def fake_eta(location):
+        # shared_a is now further away than shared_b
+        return 40 if location.latitude == 10 else 5
+
+    refresher = EtaRefresher(SessionLocal, fetch_eta=fake_eta)
+    for user in db.query(UserData).filter(UserData.service_id == service_id):
+        refresher.resolve_soon(user.id)
+    assert await refresher.resolve_pending() == 2
+    assert queue_state(db, service_id) == {"shared_a": (None, 2), "shared_b": (None, 1)}
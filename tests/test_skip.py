@@ -0,0 +1,74 @@
+import pytest
+from database.db import get_db
+from database.models import Service, Counter, UserData
+from routes.counter_operator import skip_head_of_queue
+from schema.operator_models import SkipRequest
+from utils.global_settings import settings
+from utils.helpers import resort_counter
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture
+def skip_counter(mocker):
+    db = next(get_test_db())
+    service = Service(name="skip_service", no_of_counters=1)
+    db.add(service)
+    db.flush()
+    counter = Counter(service_id=service.id, in_queue=4)
+    db.add(counter)
+    db.flush()
+    for pos, (name, eta) in enumerate((("skip_a", 0), ("skip_b", 5), ("skip_c", 10), ("skip_d", 20)), start=1):
+        db.add(UserData(name=name, hashed_password="x", counter=counter.id, service_id=service.id, pos=pos, ETA=eta))
+    db.commit()
+    mocker.patch.object(settings, 'counters', {service.id: {counter.id: 4}})
+    mocker.patch.object(settings, 'max_skip_count', 1)
+    mocker.patch("routes.counter_operator.rebalance_q")
+
+    yield db, service.id, counter.id
+
+    # Clean up
+    db.query(UserData).filter(UserData.service_id == service.id).delete()
+    db.query(Counter).filter(Counter.id == counter.id).delete()
+    db.query(Service).filter(Service.id == service.id).delete()
+    db.commit()
+    db.close()
+
+def queue(db, counter_id):
+    db.expire_all()
+    return [name for (name,) in db.query(UserData.name).filter(UserData.counter == counter_id).order_by(UserData.pos)]
+
+@pytest.mark.asyncio
+async def test_skip_moves_the_head_back_by_places(skip_counter):
+    db, service_id, counter_id = skip_counter
+    response = await skip_head_of_queue(SkipRequest(service_id=service_id, counter=counter_id, places=2), db=db)
+    assert (response.data.pos, response.data.skip_count, response.data.evicted) == (3, 1, False)
+    assert queue(db, counter_id) == ["skip_b", "skip_c", "skip_a", "skip_d"]
+    # held back to one minute behind skip_c, which registered later and would win the tie
+    skipped = db.query(UserData).filter(UserData.name == "skip_a").one()
+    assert (skipped.skip_offset, skipped.service_started_at) == (11, None)
+    # the hold-back is kept, so a full re-sort leaves the order alone
+    resort_counter(db, counter_id)
+    db.commit()
+    assert queue(db, counter_id) == ["skip_b", "skip_c", "skip_a", "skip_d"]
+
+@pytest.mark.asyncio
+async def test_skip_by_minutes_and_eviction(skip_counter):
+    db, service_id, counter_id = skip_counter
+    response = await skip_head_of_queue(SkipRequest(service_id=service_id, counter=counter_id, minutes=15), db=db)
+    assert response.data.pos == 3
+    assert queue(db, counter_id) == ["skip_b", "skip_c", "skip_a", "skip_d"]
+
+    db.query(UserData).filter(UserData.name == "skip_b").update({"skip_count": 1})
+    db.commit()
+    response = await skip_head_of_queue(SkipRequest(service_id=service_id, counter=counter_id), db=db)
+    assert (response.data.user_id is not None, response.data.evicted, response.data.pos) == (True, True, None)
+    assert queue(db, counter_id) == ["skip_c", "skip_a", "skip_d"]
+    assert [pos for (pos,) in db.query(UserData.pos).filter(UserData.counter == counter_id).order_by(UserData.pos)] == [1, 2, 3]
+    assert settings.counters[service_id][counter_id] == 3
+    assert db.get(Counter, counter_id).in_queue == 3
@@ -0,0 +1,116 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from database.db import get_db
+from database.models import Service, Counter, UserData, OperatorStation, StationCounter
+from routes.stations import create_station, call_next_at_station, delete_station
+from schema.operator_models import CreateStationRequest
+from utils.global_settings import settings
+from utils.helpers import resort_counter
+from utils.stations import merge_heads
+
+# Mock database dependency
+def get_test_db():
+    db = next(get_db())
+    try:
+        yield db
+    finally:
+        db.close()
+
+def test_merge_heads_orders_by_priority_eta_and_wait():
+    now = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+    heads = [
+        {"id": 1, "counter": 10, "ETA": 5, "priority": 0, "skip_offset": 0, "registered_at": now - timedelta(minutes=2)},
+        {"id": 2, "counter": 11, "ETA": 5, "priority": 0, "skip_offset": 0, "registered_at": now - timedelta(minutes=8)},
+        {"id": 3, "counter": 12, "ETA": 20, "priority": 2, "skip_offset": 0, "registered_at": now},
+        {"id": 4, "counter": 13, "ETA": 1, "priority": 0, "skip_offset": 0, "registered_at": now},
+    ]
+    merged = list(merge_heads(heads, now))
+    assert [head["id"] for head in merged] == [3, 4, 2, 1]
+    assert merged[2]["waited_s"] == 480
+
+@pytest.fixture
+def station_counters(mocker):
+    db = next(get_test_db())
+    services = [Service(name="station_service_a", no_of_counters=1), Service(name="station_service_b", no_of_counters=1)]
+    db.add_all(services)
+    db.flush()
+    counters = [Counter(service_id=service.id, in_queue=2) for service in services]
+    db.add_all(counters)
+    db.flush()
+    queues = ((("station_a1", 10), ("station_a2", 15)), (("station_b1", 4), ("station_b2", 30)))
+    for service, counter, users in zip(services, counters, queues):
+        for pos, (name, eta) in enumerate(users, start=1):
+            db.add(UserData(name=name, hashed_password="x", counter=counter.id, service_id=service.id, pos=pos, ETA=eta))
+    db.commit()
+    mocker.patch.object(settings, 'counters', {service.id: {counter.id: 2} for service, counter in zip(services, counters)})
+    mocker.patch("routes.counter_operator.rebalance_q")
+
+    yield db, services, counters
+
+    # Clean up
+    db.query(StationCounter).filter(StationCounter.counter_id.in_([counter.id for counter in counters])).delete()
+    db.query(OperatorStation).filter(OperatorStation.name.in_(["desk", "second_desk"])).delete()
+    db.query(UserData).filter(UserData.service_id.in_([service.id for service in services])).delete()
+    db.query(Counter).filter(Counter.id.in_([counter.id for counter in counters])).delete()
+    db.query(Service).filter(Service.id.in_([service.id for service in services])).delete()
+    db.commit()
+    db.close()
+
+@pytest.mark.asyncio
+async def test_station_next_serves_the_best_head_across_counters(station_counters):
+    db, services, counters = station_counters
+    created = await create_station(CreateStationRequest(name="desk", counters=[counter.id for counter in counters]), db=db)
+    station_id = created.data.id
+
+    response = await call_next_at_station(station_id, db=db)
+    assert (response.data.finished_counter, response.data.called.counter) == (None, counters[1].id)
+    # station_b1 is popped, which leaves station_a1 with the lowest ETA
+    response = await call_next_at_station(station_id, db=db)
+    assert (response.data.finished_counter, response.data.called.counter) == (counters[1].id, counters[0].id)
+    db.expire_all()
+    assert db.query(UserData).filter(UserData.name == "station_b1").first() is None
+    assert db.get(OperatorStation, station_id).current_counter == counters[0].id
+
+    await delete_station(station_id, db=db)
+    assert db.query(StationCounter).filter(StationCounter.station_id == station_id).count() == 0
+
+@pytest.mark.asyncio
+async def test_station_finishes_the_user_it_called_after_the_head_changed(station_counters):
+    db, services, counters = station_counters
+    created = await create_station(CreateStationRequest(name="desk", counters=[counters[0].id]), db=db)
+    station_id = created.data.id
+    called = (await call_next_at_station(station_id, db=db)).data.called.user_id
+
+    # a higher priority user joins and becomes the head while the called user is served
+    db.add(UserData(name="station_vip", hashed_password="x", counter=counters[0].id, service_id=services[0].id, pos=3, ETA=0, priority=2))
+    db.flush()
+    resort_counter(db, counters[0].id)
+    db.commit()
+
+    response = await call_next_at_station(station_id, db=db)
+    assert (response.data.finished_user, response.data.missing_user) == (called, None)
+    db.expire_all()
+    assert db.get(UserData, called) is None
+    assert [name for (name,) in db.query(UserData.name).filter(UserData.counter == counters[0].id).order_by(UserData.pos)] == ["station_vip", "station_a2"]
+    vip_id = db.query(UserData.id).filter(UserData.name == "station_vip").scalar()
+    assert response.data.called.user_id == vip_id
+
+    # the called user was served elsewhere: reported, and nobody else is popped for it
+    db.query(UserData).filter(UserData.name == "station_vip").delete()
+    db.query(UserData).filter(UserData.name == "station_a2").update({"pos": 1})
+    db.commit()
+    response = await call_next_at_station(station_id, db=db)
+    assert (response.data.finished_user, response.data.missing_user) == (None, vip_id)
+    assert db.query(UserData).filter(UserData.name == "station_a2").count() == 1
+
+@pytest.mark.asyncio
+async def test_counter_is_bound_to_one_station_only(station_counters):
+    db, services, counters = station_counters
+    await create_station(CreateStationRequest(name="desk", counters=[counters[0].id]), db=db)
+
+    with pytest.raises(Exception) as error:
+        await create_station(CreateStationRequest(name="second_desk", counters=[counters[0].id, counters[1].id]), db=db)
+    assert error.value.status_code == 409
+
+    created = await create_station(CreateStationRequest(name="second_desk", counters=[counters[1].id]), db=db)
+    assert created.data.counters == [counters[1].id]
@@ -0,0 +1,126 @@
+import asyncio, logging
+from datetime import datetime, timedelta
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from database.db import SessionLocal
+from database.models import UserData
+from utils.clock import clock
+from utils.event_log import event_log
+from utils.global_settings import settings
+from utils.helpers import move_to_rank, start_service
+from utils.locks import counter_locks, service_queue_lock
+from utils.priority import effective_level
+from utils.queue_store import queue_store
+from utils.queue_view import queue_view
+
+logger = logging.getLogger(__name__)
+
+
+class PriorityAger:
+    """
+    Background task that raises the stored rank level of users who have waited long enough.
+
+    Aging is applied as a write, so a queue's order never changes on its own: its stored
+    positions stay in utils.priority.rank_key order, which the ranked inserts and moves
+    of utils.helpers rely on to find a position by bisection.
+
+    Every settings.priority_aging_interval_s, a user whose utils.priority.effective_level
+    has grown past its rank_level gets the new level and moves forward to its rank with
+    helpers.move_to_rank, under its queue's lock. Promotions lag behind the waiting time
+    by at most one interval.
+    """
+
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self._task = None
+
+    def _candidates(self, db: Session, now: datetime):
+        top = max(settings.priority_levels.values(), default=0)
+        if not settings.priority_aging_s:
+            return {}
+        # nobody is raised before waiting one full aging step
+        rows = (
+            db.query(UserData.id, UserData.service_id, UserData.counter, UserData.priority, UserData.rank_level, UserData.registered_at)
+            .filter(UserData.rank_level < top, UserData.registered_at <= now - timedelta(seconds=settings.priority_aging_s))
+            .all()
+        )
+        queues = {}
+        for user_id, service_id, counter_id, priority, rank_level, registered_at in rows:
+            level = effective_level(priority, registered_at, now)
+            if level > rank_level:
+                queue = ("counter", counter_id) if counter_id is not None else ("service", service_id)
+                queues.setdefault(queue, (service_id, {}))[1][user_id] = level
+        return queues
+
+    def _age_queue(self, db: Session, kind: str, queue_id: int, levels: dict):
+        in_queue = UserData.counter == queue_id if kind == "counter" else (UserData.service_id == queue_id) & UserData.counter.is_(None)
+        users = db.query(UserData).filter(UserData.id.in_(levels), in_queue).order_by(UserData.pos).with_for_update().all()
+        promoted = []
+        # front to back, each user only passes users ranked below its new level
+        for user in users:
+            user.rank_level = levels[user.id]
+            pos = move_to_rank(db, user)
+            if pos == 1 and kind == "counter" and user.ETA == 0:
+                start_service(user)
+            promoted.append((user.id, user.rank_level, pos))
+        return promoted
+
+    async def age(self, now: datetime = None):
+        """
+        Raise the rank level of every user who has earned it and move them forward in their queues.
+
+        Returns:
+            int: The number of users promoted.
+        """
+        now = now or clock.now()
+        db = self.session_factory()
+        promoted_total = 0
+        try:
+            for (kind, queue_id), (service_id, levels) in self._candidates(db, now).items():
+                lock = counter_locks(queue_id) if kind == "counter" else service_queue_lock(queue_id)
+                async with lock:
+                    if kind == "counter":
+                        # the queue is changed in the database, a write-behind copy must not overwrite it
+                        queue_store.release(queue_id)
+                    try:
+                        promoted = self._age_queue(db, kind, queue_id, levels)
+                        db.commit()
+                    except SQLAlchemyError as e:
+                        db.rollback()
+                        logging.error(f"aging of {kind} {queue_id} failed: {str(e)}")
+                        continue
+                counter_id = queue_id if kind == "counter" else None
+                # in promotion order, each move as it was made in the database
+                for user_id, level, pos in promoted:
+                    event_log.promote(user_id, service_id, counter_id, level)
+                    queue_view.move(service_id, user_id, counter_id, pos)
+                promoted_total += len(promoted)
+        finally:
+            db.close()
+        if promoted_total:
+            logging.info(f"priority aging promoted {promoted_total} users")
+        return promoted_total
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.priority_aging_interval_s)
+            try:
+                await self.age()
+            except SQLAlchemyError as e:
+                logging.error(f"priority aging failed: {str(e)}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+priority_ager = PriorityAger()
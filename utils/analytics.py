@@ -0,0 +1,231 @@
+import logging
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import DateTime, select, type_coerce
+from sqlalchemy.orm import Session
+from database.models import ServedHistory
+from utils.clock import clock
+from utils.global_settings import settings
+
+logger = logging.getLogger(__name__)
+
+# rows fetched per round trip when loading served_history
+HISTORY_CHUNK_SIZE = 50_000
+DEFAULT_PERCENTILES = (50, 90, 99)
+EPOCH = datetime(1970, 1, 1)
+GROUP_KEYS = {"counter": "counter_id", "service": "service_id", "hour": "hour"}
+
+
+def to_epoch(values):
+    """
+    Convert datetimes (or None) to float seconds, with NaN for missing values.
+
+    Args:
+        values: A sequence of naive UTC datetimes, or a single naive UTC or aware datetime.
+
+    Returns:
+        np.ndarray: The timestamps as float64 seconds.
+    """
+    if isinstance(values, datetime) and values.tzinfo is not None:
+        values = values.astimezone(timezone.utc).replace(tzinfo=None)
+    stamps = np.asarray(values, dtype="datetime64[us]")
+    seconds = stamps.astype("int64") / 1e6
+    return np.where(np.isnat(stamps), np.nan, seconds)
+
+
+class HistoryArrays:
+    """
+    Columnar in-memory copy of served_history for vectorized analytics.
+
+    The copy is refreshed incrementally: each refresh only fetches rows with an
+    id above the last one loaded, in chunks of HISTORY_CHUNK_SIZE, so queries
+    over millions of served users only pay for NumPy masking and reductions.
+
+    Attributes:
+        counter_id, service_id (np.ndarray): int64 IDs per served user.
+        registered, started, ended (np.ndarray): float64 epoch seconds, NaN when unknown.
+    """
+
+    _columns = ("counter_id", "service_id", "registered", "started", "ended")
+
+    def __init__(self):
+        self.last_id = 0
+        self.counter_id = np.empty(0, dtype=np.int64)
+        self.service_id = np.empty(0, dtype=np.int64)
+        self.registered = np.empty(0, dtype=np.float64)
+        self.started = np.empty(0, dtype=np.float64)
+        self.ended = np.empty(0, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.ended)
+
+    def refresh(self, db: Session, chunk_size: int = HISTORY_CHUNK_SIZE):
+        """
+        Append rows written since the last refresh and drop rows past retention.
+
+        Returns:
+            int: The number of rows appended.
+        """
+        chunks = []
+        while True:
+            rows = db.execute(
+                select(
+                    ServedHistory.id,
+                    ServedHistory.counter_id,
+                    ServedHistory.service_id,
+                    # read as plain naive UTC DateTimes, NumPy has no aware datetimes
+                    type_coerce(ServedHistory.registered_at, DateTime),
+                    type_coerce(ServedHistory.service_started_at, DateTime),
+                    type_coerce(ServedHistory.service_ended_at, DateTime),
+                )
+                .where(ServedHistory.id > self.last_id)
+                .order_by(ServedHistory.id)
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                break
+            ids, counter_ids, service_ids, registered, started, ended = zip(*rows)
+            chunks.append((
+                np.fromiter(counter_ids, dtype=np.int64, count=len(rows)),
+                np.fromiter(service_ids, dtype=np.int64, count=len(rows)),
+                to_epoch(registered),
+                to_epoch(started),
+                to_epoch(ended),
+            ))
+            self.last_id = ids[-1]
+            if len(rows) < chunk_size:
+                break
+
+        appended = sum(len(chunk[0]) for chunk in chunks)
+        if chunks:
+            for index, name in enumerate(self._columns):
+                setattr(self, name, np.concatenate([getattr(self, name)] + [chunk[index] for chunk in chunks]))
+
+        # mirror the retention purge so the copy does not grow forever
+        cutoff = to_epoch(clock.now() - timedelta(days=settings.history_retention_days))
+        if len(self) and self.ended[0] < cutoff:
+            keep = self.ended >= cutoff
+            for name in self._columns:
+                setattr(self, name, getattr(self, name)[keep])
+        if appended:
+            logging.debug(f"loaded {appended} served history rows, {len(self)} in memory")
+        return appended
+
+    def select(self, start: datetime, end: datetime, counter_id: int = None, service_id: int = None):
+        """
+        Return a boolean mask of the users served in [start, end) matching the filters.
+        """
+        mask = (self.ended >= to_epoch(start)) & (self.ended < to_epoch(end))
+        if counter_id is not None:
+            mask &= self.counter_id == counter_id
+        if service_id is not None:
+            mask &= self.service_id == service_id
+        return mask
+
+
+def _group(keys):
+    """
+    Dense grouping of small non-negative-range integer keys without sorting.
+
+    Returns:
+        tuple: (groups, inverse, counts) like np.unique(..., return_inverse, return_counts).
+    """
+    offset = keys.min()
+    counts = np.bincount(keys - offset)
+    present = counts > 0
+    groups = np.flatnonzero(present) + offset
+    inverse = (np.cumsum(present) - 1)[keys - offset]
+    return groups, inverse, counts[present]
+
+
+def grouped_stats(keys, values, percentiles=DEFAULT_PERCENTILES):
+    """
+    Compute count, mean and percentiles of values per key, fully vectorized.
+
+    Each group is shifted into its own numeric band so that a single plain sort
+    orders all values by (group, value). Every group is then a contiguous slice
+    and each percentile is a linear interpolation between two gathered elements
+    per group, the same definition np.percentile uses.
+
+    Args:
+        keys (np.ndarray): Integer group key per value.
+        values (np.ndarray): Values to summarize, NaNs are ignored.
+        percentiles (tuple): Percentiles to compute, in [0, 100].
+
+    Returns:
+        dict: Maps each key to {"count", "mean", "p<q>"...}.
+    """
+    valid = ~np.isnan(values)
+    keys, values = keys[valid], values[valid]
+    if not len(values):
+        return {}
+
+    groups, inverse, counts = _group(keys)
+    means = np.bincount(inverse, weights=values) / counts
+
+    low = values.min()
+    band = values.max() - low + 1.0
+    bands = np.arange(len(groups)) * band
+    ordered = np.sort(bands[inverse] + (values - low)) - np.repeat(bands, counts) + low
+    starts = np.cumsum(counts) - counts
+
+    stats = {"count": counts, "mean": means}
+    for q in percentiles:
+        position = starts + (counts - 1) * (q / 100)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        stats[f"p{q:g}"] = ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+    return {
+        int(group): {name: (int(column[index]) if name == "count" else float(column[index])) for name, column in stats.items()}
+        for index, group in enumerate(groups)
+    }
+
+
+def service_report(history: HistoryArrays, mask, group_by: str, window_hours: float, percentiles=DEFAULT_PERCENTILES):
+    """
+    Summarize throughput, service times and wait times of the selected users.
+
+    Args:
+        history (HistoryArrays): The loaded history.
+        mask (np.ndarray): Selection from HistoryArrays.select().
+        group_by (str): "counter", "service" or "hour".
+        window_hours (float): Length of the selected time window, used for throughput.
+        percentiles (tuple): Percentiles to report.
+
+    Returns:
+        list[dict]: One entry per group, ordered by group key. Times are in seconds.
+    """
+    ended = history.ended[mask]
+    if group_by not in GROUP_KEYS:
+        raise ValueError(f"unknown grouping {group_by}")
+    if group_by == "counter":
+        keys = history.counter_id[mask]
+    elif group_by == "service":
+        keys = history.service_id[mask]
+    else:
+        keys = (ended // 3600).astype(np.int64)
+
+    served = {}
+    if len(keys):
+        groups, _, counts = _group(keys)
+        served = dict(zip(groups.tolist(), counts.tolist()))
+    service_times = grouped_stats(keys, ended - history.started[mask], percentiles)
+    wait_times = grouped_stats(keys, history.started[mask] - history.registered[mask], percentiles)
+
+    # an hour bucket always spans one hour, other groups span the whole window
+    span_hours = 1.0 if group_by == "hour" else max(window_hours, 1 / 3600)
+
+    return [
+        {
+            GROUP_KEYS[group_by]: EPOCH + timedelta(hours=key) if group_by == "hour" else key,
+            "served": served[key],
+            "throughput_per_hour": served[key] / span_hours,
+            "service_time": service_times.get(key),
+            "wait_time": wait_times.get(key),
+        }
+        for key in sorted(served)
+    ]
+
+
+served_history_arrays = HistoryArrays()
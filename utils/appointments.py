@@ -0,0 +1,289 @@
+import asyncio, logging, math
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from database.db import SessionLocal
+from database.models import Appointment, UserData
+from utils.assignment import counter_assignment
+from utils.clock import clock, as_utc
+from utils.event_log import event_log
+from utils.global_settings import settings
+from utils.helpers import insert_ranked, update_counter_stats, adjust_counter_load
+from utils.locks import counter_locks, service_queue_lock
+from utils.queue_store import queue_store
+from utils.queue_view import queue_view
+
+logger = logging.getLogger(__name__)
+
+# appointments merged per query by one merge pass
+MERGE_BATCH_SIZE = 100
+
+
+class SlotTree:
+    """
+    Max segment tree over the remaining capacity of consecutive slots.
+
+    Both add() and first_free() are O(log n) for n slots. Slots with no capacity
+    left hold 0 or less.
+    """
+
+    def __init__(self, capacities: list):
+        self.size = len(capacities)
+        self._leaves = 1
+        while self._leaves < self.size:
+            self._leaves *= 2
+        # padding leaves hold 0, so they are never free
+        self._tree = [0] * (2 * self._leaves)
+        self._tree[self._leaves:self._leaves + self.size] = capacities
+        for node in range(self._leaves - 1, 0, -1):
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+
+    def remaining(self, index: int):
+        return self._tree[self._leaves + index]
+
+    def add(self, index: int, delta: int):
+        node = self._leaves + index
+        self._tree[node] += delta
+        node //= 2
+        while node:
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+            node //= 2
+
+    def first_free(self, start: int = 0):
+        """
+        The first slot at or after `start` with capacity left, or None.
+        """
+        if start >= self.size:
+            return None
+        return self._first(1, 0, self._leaves, max(start, 0))
+
+    def _first(self, node: int, low: int, high: int, start: int):
+        # subtrees left of start or without a free slot are skipped whole
+        if high <= start or self._tree[node] <= 0:
+            return None
+        if high - low == 1:
+            return low
+        middle = (low + high) // 2
+        found = self._first(2 * node, low, middle, start)
+        return found if found is not None else self._first(2 * node + 1, middle, high, start)
+
+
+class AppointmentCalendar:
+    """
+    Per-service slot capacity over the booking horizon.
+
+    A service's slot capacity is the number of users its counters serve in one slot
+    at their average service time, times settings.appointment_capacity_share; the
+    rest is left to walk-ins. A SlotTree per service holds what is left of every slot
+    from the current one to settings.appointment_horizon_days ahead, built from the
+    booked appointments on first use and again once half the horizon has passed.
+
+    Like settings.counters, the calendar lives in the process: a booking is checked
+    and taken without awaiting in between, so requests on the event loop can not
+    overbook a slot.
+    """
+
+    def __init__(self):
+        self._calendars = {}
+
+    @property
+    def slot_s(self):
+        return settings.appointment_slot_minutes * 60
+
+    def slot_capacity(self, service_id: int):
+        counters = settings.counters.get(service_id, {})
+        known = [counter_assignment.service_times[counter_id] for counter_id in counters if counter_assignment.service_times.get(counter_id)]
+        average = sum(known) / len(known) if known else settings.appointment_default_service_s
+        return int(self.slot_s * len(counters) / average * settings.appointment_capacity_share)
+
+    def _index(self, origin: datetime, when: datetime, round_up: bool = False):
+        slots = (as_utc(when) - origin).total_seconds() / self.slot_s
+        return math.ceil(slots) if round_up else math.floor(slots)
+
+    def _calendar(self, db: Session, service_id: int, now: datetime):
+        calendar = self._calendars.get(service_id)
+        if calendar is None or self._index(calendar[0], now) > calendar[1].size // 2:
+            calendar = self._calendars[service_id] = self._load(db, service_id, now)
+        return calendar
+
+    def _load(self, db: Session, service_id: int, now: datetime):
+        origin = datetime.fromtimestamp(now.timestamp() // self.slot_s * self.slot_s, tz=timezone.utc)
+        capacities = [self.slot_capacity(service_id)] * (settings.appointment_horizon_days * 86400 // self.slot_s)
+        booked = (
+            db.query(Appointment.slot_start, func.count(Appointment.id))
+            .filter(Appointment.service_id == service_id, Appointment.slot_start >= origin)
+            .group_by(Appointment.slot_start)
+            .all()
+        )
+        for slot_start, count in booked:
+            index = self._index(origin, slot_start)
+            if index < len(capacities):
+                capacities[index] -= count
+        logging.debug(f"loaded the appointment calendar of service {service_id}, {len(booked)} booked slots")
+        return origin, SlotTree(capacities)
+
+    def next_free(self, db: Session, service_id: int, after: datetime = None):
+        """
+        The first slot starting after `after`, and after now, with capacity left.
+
+        Returns:
+            tuple: (slot start, bookings it still takes), or None if the horizon is full.
+        """
+        now = clock.now()
+        origin, tree = self._calendar(db, service_id, now)
+        start = max(self._index(origin, now) + 1, self._index(origin, after, round_up=True) if after else 0)
+        index = tree.first_free(start)
+        if index is None:
+            return None
+        return origin + timedelta(seconds=index * self.slot_s), tree.remaining(index)
+
+    def reserve(self, db: Session, service_id: int, after: datetime = None):
+        """
+        Take one booking of the first free slot, see next_free().
+
+        Returns:
+            datetime: The slot start, or None if the horizon is full.
+        """
+        free = self.next_free(db, service_id, after)
+        if free is None:
+            return None
+        origin, tree = self._calendars[service_id]
+        tree.add(self._index(origin, free[0]), -1)
+        return free[0]
+
+    def release(self, service_id: int, slot_start: datetime):
+        """
+        Give back a booking of a cancelled appointment, or one that was never stored.
+        """
+        calendar = self._calendars.get(service_id)
+        if calendar is None:
+            return
+        index = self._index(calendar[0], slot_start)
+        if 0 <= index < calendar[1].size:
+            calendar[1].add(index, 1)
+
+    def invalidate(self, service_id: int = None):
+        """
+        Rebuild a service's calendar, or every calendar, on next use, e.g. after its counters changed.
+        """
+        if service_id is None:
+            self._calendars.clear()
+        else:
+            self._calendars.pop(service_id, None)
+
+
+async def merge_appointment(db: Session, appointment: Appointment, now: datetime = None):
+    """
+    Move a booked user into the live queue of its service, at its rank.
+
+    The user joins the counter picked by the service's assignment strategy, or the
+    shared queue, with an ETA of the minutes left until its slot; insert_ranked places
+    it without re-sorting the queue.
+
+    Returns:
+        UserData: The queued user, or None if the merge failed and is retried later.
+    """
+    service_id = appointment.service_id
+    if service_id not in settings.counters:
+        logging.error(f"appointment {appointment.id} belongs to unknown service {service_id}")
+        return None
+    shared_queue = counter_assignment.is_shared(service_id)
+    counter_id = None if shared_queue else counter_assignment.select(service_id)
+    if not shared_queue and counter_id is None:
+        logging.error(f"appointment {appointment.id} can not be merged, service {service_id} has no counters")
+        return None
+    now = now or clock.now()
+    eta = max(0, math.ceil((as_utc(appointment.slot_start) - now).total_seconds() / 60))
+    user = UserData(name=appointment.name, hashed_password=appointment.hashed_password, counter=counter_id,
+                    service_id=service_id, ETA=eta, priority=appointment.priority)
+    async with (service_queue_lock(service_id) if shared_queue else counter_locks(counter_id)):
+        if not shared_queue:
+            # the queue is changed in the database, a write-behind copy must not overwrite it
+            queue_store.release(counter_id)
+        try:
+            insert_ranked(db, user)
+            if not shared_queue and not update_counter_stats(db, counter_id, in_queue_delta=1):
+                db.rollback()
+                return None
+            db.delete(appointment)
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            logging.error(f"merging appointment {appointment.id} failed: {str(e)}")
+            return None
+        if not shared_queue:
+            adjust_counter_load(service_id, counter_id, 1)
+    queue_view.register(service_id, user.id, counter_id, user.name, user.pos, eta)
+    event_log.register(user.id, service_id, counter_id, eta, user.priority)
+    logging.debug(f"merged appointment of {user.name} into counter {counter_id} of service {service_id} at position {user.pos}")
+    return user
+
+
+class AppointmentMerger:
+    """
+    Background task that merges appointments into the live queues as their slots approach.
+
+    Every settings.appointment_merge_interval_s the appointments starting within
+    settings.appointment_merge_lead_s are merged, earliest slot first.
+    """
+
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self._task = None
+
+    async def merge_due(self, now: datetime = None):
+        """
+        Merge every due appointment.
+
+        Returns:
+            int: The number of appointments merged.
+        """
+        now = now or clock.now()
+        due_before = now + timedelta(seconds=settings.appointment_merge_lead_s)
+        db = self.session_factory()
+        merged = 0
+        try:
+            while True:
+                due = (
+                    db.query(Appointment)
+                    .filter(Appointment.slot_start <= due_before)
+                    .order_by(Appointment.slot_start, Appointment.id)
+                    .limit(MERGE_BATCH_SIZE)
+                    .all()
+                )
+                results = [await merge_appointment(db, appointment, now) for appointment in due]
+                merged += sum(result is not None for result in results)
+                # failed ones stay booked and are retried on the next pass
+                if len(due) < MERGE_BATCH_SIZE or not any(result is not None for result in results):
+                    break
+        finally:
+            db.close()
+        if merged:
+            logging.info(f"merged {merged} appointments into the live queues")
+        return merged
+
+    async def _run(self):
+        while True:
+            try:
+                await self.merge_due()
+            except SQLAlchemyError as e:
+                logging.error(f"appointment merge failed: {str(e)}")
+            await asyncio.sleep(settings.appointment_merge_interval_s)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+appointment_calendar = AppointmentCalendar()
+appointment_merger = AppointmentMerger()
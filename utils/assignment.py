@@ -0,0 +1,222 @@
+import heapq, logging, random
+from typing import get_args
+from schema.services_models import AssignmentStrategy
+from utils.global_settings import settings
+
+logger = logging.getLogger(__name__)
+
+ASSIGNMENT_STRATEGIES = get_args(AssignmentStrategy)
+
+
+class CounterPool:
+    """
+    Picks the counter a new user of one service joins.
+
+    Strategies:
+        least_count: the counter with the fewest queued users.
+        least_expected_wait: the smallest avg_tat * in_queue, the time until the new user is called.
+        shortest_expected_workload: the smallest avg_tat * (in_queue + 1), the time until the new
+            user is done, so a slow counter is avoided even when its queue is empty.
+        power_of_two: the shorter queue of two counters chosen at random.
+
+    The score-based strategies keep a heap of (score, in_queue, counter_id, stamp) entries.
+    A change to a counter pushes a fresh entry and bumps its stamp, and entries with an
+    outdated stamp are discarded when they reach the top, so both touch() and select()
+    are O(log k) amortized for k counters. power_of_two is O(1).
+
+    Attributes:
+        loads (dict): The service's {counter_id: queued users} in settings.counters.
+        strategy (str): One of ASSIGNMENT_STRATEGIES.
+        closed (set): Counters of `loads` that take no new users, e.g. paused ones.
+    """
+
+    def __init__(self, loads: dict, strategy: str, service_times: dict, rng=random, closed=frozenset()):
+        if strategy not in ASSIGNMENT_STRATEGIES:
+            raise ValueError(f"unknown assignment strategy {strategy}")
+        self.loads = loads
+        self.strategy = strategy
+        self.service_times = service_times
+        self.closed = closed
+        self._rng = rng
+        self.rebuild()
+
+    def rebuild(self):
+        self._ids = tuple(counter_id for counter_id in self.loads if counter_id not in self.closed)
+        self._stamps = dict.fromkeys(self._ids, 0)
+        known = [self.service_times[counter_id] for counter_id in self._ids if self.service_times.get(counter_id)]
+        self._known_total, self._known_count = sum(known), len(known)
+        self._heap = []
+        if self.strategy != "power_of_two":
+            self._heap = [self._entry(counter_id) for counter_id in self._ids]
+            heapq.heapify(self._heap)
+
+    def expected_service_time(self, counter_id: int):
+        """
+        The counter's average service time, or the service's average for a counter without history.
+        """
+        average = self.service_times.get(counter_id)
+        if average:
+            return average
+        # 1.0 for a service without any history makes every expected-time strategy a least count
+        return self._known_total / self._known_count if self._known_count else 1.0
+
+    def score(self, counter_id: int):
+        load = self.loads.get(counter_id, 0)
+        if self.strategy == "least_expected_wait":
+            return load * self.expected_service_time(counter_id)
+        if self.strategy == "shortest_expected_workload":
+            return (load + 1) * self.expected_service_time(counter_id)
+        return load
+
+    def _entry(self, counter_id: int):
+        return (self.score(counter_id), self.loads.get(counter_id, 0), counter_id, self._stamps[counter_id])
+
+    def touch(self, counter_id: int, service_time: float = None):
+        """
+        Account for a change of the counter's queue length or, with `service_time`, its average.
+        """
+        if counter_id not in self._stamps:
+            return
+        if service_time is not None:
+            previous = self.service_times.get(counter_id)
+            self.service_times[counter_id] = service_time
+            if previous:
+                self._known_total += service_time - previous
+            elif service_time:
+                self._known_total += service_time
+                self._known_count += 1
+        if self.strategy == "power_of_two":
+            return
+        self._stamps[counter_id] += 1
+        heapq.heappush(self._heap, self._entry(counter_id))
+        # outdated entries are only dropped at the top, compact when they pile up
+        if len(self._heap) > 4 * len(self._ids) + 8:
+            self._heap = [self._entry(counter_id) for counter_id in self._ids]
+            heapq.heapify(self._heap)
+
+    def select(self):
+        """
+        Return the ID of the counter the next user should join, or None if every counter is closed.
+        """
+        if not self._ids:
+            return None
+        if self.strategy == "power_of_two":
+            if len(self._ids) < 2:
+                return self._ids[0]
+            first, second = self._rng.sample(self._ids, 2)
+            return min((self.loads.get(first, 0), first), (self.loads.get(second, 0), second))[1]
+        while self._heap[0][3] != self._stamps[self._heap[0][2]]:
+            heapq.heappop(self._heap)
+        return self._heap[0][2]
+
+
+class CounterAssignment:
+    """
+    Per-service counter pools, kept in step with settings.counters.
+
+    A pool is rebuilt when the service's counters dictionary is replaced (services
+    are created, resized or reloaded by assigning a new dictionary) or when the
+    service's strategy changes.
+
+    Services in the shared queue mode have no pool: their users wait in one queue
+    and are only given a counter when a counter calls them.
+
+    Counters that are not open (see database.models.Counter.status) are left out of the pools.
+    """
+
+    def __init__(self):
+        self.closed = set()
+        self.queue_modes = {}
+        self.strategies = {}
+        self.service_times = {}
+        self._served = {}
+        self._pools = {}
+
+    def reset(self):
+        self.closed.clear()
+        self.queue_modes.clear()
+        self.strategies.clear()
+        self.service_times.clear()
+        self._served.clear()
+        self._pools.clear()
+
+    def load_counter(self, counter_id: int, total_tat: int, users_processed: int):
+        """
+        Seed a counter's service time statistics, e.g. from the counters table.
+        """
+        self._served[counter_id] = (total_tat or 0, users_processed or 0)
+        self.service_times[counter_id] = (total_tat or 0) / users_processed if users_processed else 0
+
+    def set_strategy(self, service_id: int, strategy: str):
+        if strategy not in ASSIGNMENT_STRATEGIES:
+            raise ValueError(f"unknown assignment strategy {strategy}")
+        self.strategies[service_id] = strategy
+
+    def set_queue_mode(self, service_id: int, queue_mode: str):
+        self.queue_modes[service_id] = queue_mode
+
+    def is_shared(self, service_id: int):
+        return self.queue_modes.get(service_id) == "shared"
+
+    def set_counter_status(self, service_id: int, counter_id: int, status: str):
+        """
+        Open or close a counter for new users; the service's pool is rebuilt on its next use.
+        """
+        if status == "open":
+            self.closed.discard(counter_id)
+        else:
+            self.closed.add(counter_id)
+        self._pools.pop(service_id, None)
+
+    def forget_counters(self, *counter_ids: int):
+        """
+        Drop the state of deleted counters.
+        """
+        self.closed.difference_update(counter_ids)
+
+    def is_open(self, counter_id: int):
+        return counter_id not in self.closed
+
+    def open_loads(self, service_id: int):
+        """
+        The {counter_id: queued users} of the service's open counters.
+        """
+        return {counter_id: load for counter_id, load in settings.counters.get(service_id, {}).items() if counter_id not in self.closed}
+
+    def pool(self, service_id: int):
+        loads = settings.counters.get(service_id)
+        if not loads:
+            return None
+        strategy = self.strategies.get(service_id, settings.default_assignment_strategy)
+        pool = self._pools.get(service_id)
+        if pool is None or pool.loads is not loads or pool.strategy != strategy:
+            pool = self._pools[service_id] = CounterPool(loads, strategy, self.service_times, closed=self.closed)
+        return pool
+
+    def select(self, service_id: int):
+        """
+        Return the counter a new user of the service joins, or None if it has no counters.
+        """
+        pool = self.pool(service_id)
+        return pool.select() if pool else None
+
+    def touch(self, service_id: int, counter_id: int):
+        pool = self._pools.get(service_id)
+        if pool is not None and pool.loads is settings.counters.get(service_id):
+            pool.touch(counter_id)
+
+    def record_service(self, service_id: int, counter_id: int, served_time: float):
+        """
+        Fold a finished service into the counter's average, like update_counter_stats does in the database.
+        """
+        total, processed = self._served.get(counter_id, (0, 0))
+        total, processed = total + served_time, processed + 1
+        self._served[counter_id] = (total, processed)
+        pool = self._pools.get(service_id)
+        if pool is not None and pool.loads is settings.counters.get(service_id):
+            pool.touch(counter_id, service_time=total / processed)
+        else:
+            self.service_times[counter_id] = total / processed
+
+
+counter_assignment = CounterAssignment()
@@ -0,0 +1,88 @@
+import logging, time
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class Clock:
+    """
+    Wall clock that advances with the monotonic clock.
+
+    The wall time is read once as an anchor; every later reading adds the elapsed
+    monotonic time to it. A step of the system clock (NTP corrections, manual
+    changes) therefore can not make a service duration negative or jump, and all
+    readings are timezone-aware UTC with microsecond resolution.
+
+    Attributes:
+        max_skew_s (float): resync() re-anchors when the wall clock has drifted further than this.
+    """
+
+    def __init__(self, wall_ns=time.time_ns, monotonic_ns=time.monotonic_ns, max_skew_s: float = 1.0):
+        self._wall_ns = wall_ns
+        self._monotonic_ns = monotonic_ns
+        self.max_skew_s = max_skew_s
+        self._anchor()
+
+    def _anchor(self):
+        self._anchor_wall_ns = self._wall_ns()
+        self._anchor_monotonic_ns = self._monotonic_ns()
+
+    def time_ns(self):
+        """
+        Nanoseconds since the epoch, monotonic within the process.
+        """
+        return self._anchor_wall_ns + (self._monotonic_ns() - self._anchor_monotonic_ns)
+
+    def now(self):
+        """
+        The current time as an aware UTC datetime.
+        """
+        seconds, nanoseconds = divmod(self.time_ns(), 1_000_000_000)
+        return datetime.fromtimestamp(seconds, tz=timezone.utc) + timedelta(microseconds=nanoseconds // 1000)
+
+    def skew_s(self):
+        """
+        How far the wall clock is ahead of this clock, in seconds.
+        """
+        return (self._wall_ns() - self.time_ns()) / 1e9
+
+    def resync(self):
+        """
+        Re-anchor to the wall clock if it drifted by more than max_skew_s.
+
+        Returns:
+            bool: True if the clock was re-anchored.
+
+        Notes:
+            - Re-anchoring can make readings jump, so only call this between operations that
+              compare timestamps, e.g. on startup.
+        """
+        skew = self.skew_s()
+        if abs(skew) <= self.max_skew_s:
+            return False
+        logging.warning(f"wall clock drifted {skew:.3f}s from the monotonic clock, re-anchoring")
+        self._anchor()
+        return True
+
+
+def as_utc(value: datetime):
+    """
+    Return the datetime as aware UTC; naive values are taken to be UTC already.
+    """
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def duration_s(start: datetime, end: datetime):
+    """
+    Seconds between two timestamps, or None if either is unknown.
+    """
+    if start is None or end is None:
+        return None
+    return (end - start).total_seconds()
+
+
+clock = Clock()
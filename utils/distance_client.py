@@ -0,0 +1,299 @@
+import asyncio, logging, math, re, time
+from datetime import date
+import httpx
+from schema.distance_models import Location
+from utils.global_settings import settings, DISTANCEMATRIX_API_KEY, Q_SOLUTIONS_COORDS
+from utils.rate_limit import TokenBucket
+from utils.travel_grid import travel_grid
+
+logger = logging.getLogger(__name__)
+
+DISTANCEMATRIX_URL = "https://api.distancematrix.ai/maps/api/distancematrix/json"
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float):
+    """
+    Great-circle distance between two points in kilometres.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def distance_to_branch_km(location: Location):
+    return haversine_km(location.latitude, location.longitude, Q_SOLUTIONS_COORDS[0], Q_SOLUTIONS_COORDS[1])
+
+
+def is_within_geofence(location: Location, radius_m: float = None):
+    """
+    True if the location is within the branch's geofence, settings.geofence_radius_m by default.
+    """
+    radius_m = settings.geofence_radius_m if radius_m is None else radius_m
+    return distance_to_branch_km(location) * 1000 <= radius_m
+
+
+def parse_duration_minutes(data: dict):
+    """
+    Extract the travel time in minutes from a distancematrix.ai response.
+
+    Returns:
+        int: The duration in minutes, or None if the response has no usable duration.
+    """
+    try:
+        element = data["rows"][0]["elements"][0]
+        duration = element["duration"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    if isinstance(duration.get("value"), (int, float)):
+        return round(duration["value"] / 60)
+    duration_match = re.search(r'(?:(\d+)\s*hour[s]?)?\s*(?:(\d+)\s*min[s]?)?', duration.get("text", ""))
+    if duration_match and (duration_match.group(1) or duration_match.group(2)):
+        hours = int(duration_match.group(1)) if duration_match.group(1) else 0
+        minutes = int(duration_match.group(2)) if duration_match.group(2) else 0
+        return (hours*60) + minutes
+    return None
+
+
+class LocalEstimator:
+    """
+    Offline ETA estimate: straight-line distance scaled by a road factor and an
+    average speed.
+
+    The road factor is calibrated from real API answers with an exponentially
+    weighted moving average, so the estimate tracks the branch's surroundings.
+
+    Attributes:
+        road_factor (float): Road distance per straight-line kilometre.
+        speed_kmh (float): Average travel speed.
+    """
+
+    MIN_CALIBRATION_KM = 0.3  # shorter trips are dominated by parking and walking
+    ALPHA = 0.1
+
+    def __init__(self, road_factor: float = None, speed_kmh: float = None):
+        self.road_factor = road_factor or settings.estimator_road_factor
+        self.speed_kmh = speed_kmh or settings.estimator_speed_kmh
+        self.samples = 0
+
+    def estimate(self, location: Location):
+        km = distance_to_branch_km(location)
+        return round(km * self.road_factor / self.speed_kmh * 60)
+
+    def observe(self, location: Location, minutes: int):
+        """
+        Calibrate the road factor from a real travel time.
+        """
+        km = distance_to_branch_km(location)
+        if km < self.MIN_CALIBRATION_KM or minutes is None:
+            return
+        observed_factor = min(max(minutes / 60 * self.speed_kmh / km, 1.0), 5.0)
+        self.road_factor += self.ALPHA * (observed_factor - self.road_factor)
+        self.samples += 1
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing dependency for a while.
+
+    closed: calls flow; `failure_threshold` consecutive failures open the breaker.
+    open: calls are refused until `reset_timeout_s` has passed.
+    half_open: a single trial call decides between closed and open again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = None, reset_timeout_s: float = None, clock=time.monotonic):
+        self.failure_threshold = failure_threshold or settings.breaker_failure_threshold
+        self.reset_timeout_s = reset_timeout_s or settings.breaker_reset_s
+        self._clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    def allow(self):
+        """
+        Return True if a call may be attempted now.
+        """
+        if self.state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout_s:
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def release(self):
+        """
+        Give back a permission from allow() that was not used for a call.
+        """
+        self._trial_in_flight = False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logging.warning(f"distance API circuit opened after {self.failures} failures")
+            self.state = self.OPEN
+            self._opened_at = self._clock()
+
+
+class QuotaTracker:
+    """
+    Counts API calls per day against the provider's quota; 0 means unlimited.
+    """
+
+    def __init__(self, daily_limit: int = None, today=date.today):
+        self.daily_limit = settings.distance_api_daily_quota if daily_limit is None else daily_limit
+        self._today = today
+        self.day = today()
+        self.used = 0
+
+    def try_use(self):
+        if self._today() != self.day:
+            self.day, self.used = self._today(), 0
+        if self.daily_limit and self.used >= self.daily_limit:
+            return False
+        self.used += 1
+        return True
+
+
+class DistanceClient:
+    """
+    distancematrix.ai client that never lets an outage reach the caller.
+
+    Every lookup is bounded by a timeout and goes through a rate limiter, the daily
+    quota and a circuit breaker. When any of them refuses the call, or the call
+    fails, the ETA comes from the travel grid or, where the grid knows nothing
+    nearby, from the calibrated LocalEstimator. Every API answer is also folded
+    into the grid.
+
+    Concurrent lookups whose origins round to the same coordinates (to
+    `distance_coalesce_decimals` places) share a single in-flight request.
+    """
+
+    def __init__(self, api_key: str = DISTANCEMATRIX_API_KEY, timeout_s: float = None, grid=None):
+        self.api_key = api_key
+        self.timeout_s = timeout_s or settings.distance_api_timeout_s
+        self.breaker = CircuitBreaker()
+        self.rate_limiter = TokenBucket(settings.distance_api_calls_per_second)
+        self.quota = QuotaTracker()
+        self.estimator = LocalEstimator()
+        self.grid = grid or travel_grid
+        self._client = None
+        self._client_loop = None
+        self._in_flight = {}
+
+    def _http(self):
+        # httpx pools are bound to the event loop that created them
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(timeout=self.timeout_s)
+            self._client_loop = loop
+        return self._client
+
+    async def fetch(self, location: Location):
+        """
+        Ask the distance API for the travel time, without any fallback.
+
+        Returns:
+            int: The travel time in minutes.
+
+        Raises:
+            httpx.HTTPError, ValueError: If the request fails or the answer is unusable.
+        """
+        response = await self._http().get(
+            DISTANCEMATRIX_URL,
+            params={
+                "origins": f"{location.latitude},{location.longitude}",
+                "destinations": f"{Q_SOLUTIONS_COORDS[0]},{Q_SOLUTIONS_COORDS[1]}",
+                "key": self.api_key
+            }
+        )
+        response.raise_for_status()
+        minutes = parse_duration_minutes(response.json())
+        if minutes is None:
+            raise ValueError("distance API answer has no duration")
+        return minutes
+
+    def coalesce_key(self, location: Location):
+        decimals = settings.distance_coalesce_decimals
+        return (round(location.latitude, decimals), round(location.longitude, decimals))
+
+    def local_estimate(self, location: Location):
+        """
+        Travel time without calling the API: the travel grid, else the estimator.
+        """
+        minutes = self.grid.lookup(location)
+        return self.estimator.estimate(location) if minutes is None else minutes
+
+    async def eta(self, location: Location, prefer_local: bool = False):
+        """
+        Travel time from a location to the branch in minutes.
+
+        Args:
+            location (Location): The origin.
+            prefer_local (bool, optional): Answer from the travel grid when it knows the
+                location's surroundings, and only call the API otherwise.
+
+        Returns:
+            int: The API answer when it is available, the local estimate otherwise.
+
+        Notes:
+            - A caller that joins a lookup already in flight for the same rounded
+              origin gets that lookup's answer. Cancelling one caller does not
+              cancel the shared lookup.
+        """
+        if prefer_local:
+            minutes = self.grid.lookup(location)
+            if minutes is not None:
+                return minutes
+        # tasks are bound to their event loop, so are the keys
+        key = (asyncio.get_running_loop(), self.coalesce_key(location))
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._lookup(location))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            logging.debug(f"joining in-flight distance lookup for {key[1]}")
+        return await asyncio.shield(task)
+
+    async def _lookup(self, location: Location):
+        if not self.breaker.allow():
+            return self.local_estimate(location)
+        if not self.rate_limiter.try_acquire() or not self.quota.try_use():
+            logging.debug("distance API rate limit or daily quota reached, using local estimate")
+            self.breaker.release()
+            return self.local_estimate(location)
+        try:
+            minutes = await asyncio.wait_for(self.fetch(location), timeout=self.timeout_s)
+        except (httpx.HTTPError, ValueError, asyncio.TimeoutError) as e:
+            self.breaker.record_failure()
+            logging.debug(f"distance API call failed ({e!r}), using local estimate")
+            return self.local_estimate(location)
+        self.breaker.record_success()
+        self.estimator.observe(location, minutes)
+        self.grid.observe(location, minutes)
+        return minutes
+
+    async def aclose(self):
+        self.grid.flush()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._client_loop = None
+
+
+distance_client = DistanceClient()
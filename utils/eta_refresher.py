@@ -0,0 +1,254 @@
+import asyncio, heapq, logging, math
+from datetime import datetime
+from sqlalchemy import select, update, bindparam
+from sqlalchemy.exc import SQLAlchemyError
+from database.db import SessionLocal
+from database.models import UserData
+from schema.distance_models import Location
+from utils.clock import clock
+from utils.global_settings import settings
+from utils.helpers import get_ETA, resort_counter, resort_service_queue, start_service
+from utils.locks import counter_locks, service_queue_lock
+from utils.queue_view import queue_view
+from utils.event_log import event_log
+from utils.queue_store import queue_store
+from utils.rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_interval(pos: int):
+    """
+    Seconds between ETA refreshes for the user at a queue position.
+
+    The first eta_refresh_front_size users of a counter are refreshed every cycle,
+    the next block every second cycle, and so on, since an ETA drifting far back
+    in the queue cannot change who is served next.
+    """
+    front = max(settings.eta_refresh_front_size, 1)
+    return settings.eta_refresh_cycle_s * math.ceil(max(pos or 1, 1) / front)
+
+
+def select_due(users, now: datetime, budget: int):
+    """
+    Pick at most `budget` users whose ETA is due for a refresh, most overdue first.
+
+    Args:
+        users: Rows with pos and eta_updated_at attributes.
+        now (datetime): The current time.
+        budget (int): The number of refreshes allowed this cycle.
+
+    Returns:
+        list: The selected users.
+    """
+    if budget <= 0:
+        return []
+    scored = []
+    for user in users:
+        age = (now - user.eta_updated_at).total_seconds() if user.eta_updated_at else math.inf
+        overdue = age / refresh_interval(user.pos)
+        if overdue >= 1:
+            scored.append((overdue, -(user.pos or 0), user))
+    return [user for _, _, user in heapq.nlargest(budget, scored, key=lambda item: item[:2])]
+
+
+class EtaRefresher:
+    """
+    Background task that keeps queued users' ETAs fresh.
+
+    Each cycle picks the users whose ETA is due (front of each counter first),
+    bounded by a global token-bucket budget of distance API calls, fetches the
+    new ETAs concurrently and writes them per counter with one executemany,
+    re-sorting each touched counter once.
+
+    Users registered with a provisional ETA are handed over with resolve_soon()
+    and resolved right away, outside the refresh budget, instead of waiting for
+    the next cycle.
+    """
+
+    def __init__(self, session_factory=SessionLocal, fetch_eta=None):
+        self.session_factory = session_factory
+        self._fetch_eta = fetch_eta or get_ETA
+        self.budget = TokenBucket(settings.eta_api_calls_per_minute / 60, capacity=settings.eta_api_calls_per_minute)
+        self._pending = set()
+        self._wakeup = None
+        self._task = None
+
+    def resolve_soon(self, user_id: int):
+        """
+        Queue a user whose ETA is provisional for resolution by the background task.
+        """
+        self._pending.add(user_id)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending(self):
+        return len(self._pending)
+
+    async def refresh_once(self):
+        """
+        Run one refresh cycle.
+
+        Returns:
+            int: The number of users whose ETA was updated.
+        """
+        db = self.session_factory()
+        try:
+            users = (
+                db.query(UserData.id, UserData.counter, UserData.service_id, UserData.pos, UserData.ETA, UserData.latitude, UserData.longitude,
+                         UserData.eta_updated_at)
+                .filter(UserData.latitude.isnot(None), UserData.longitude.isnot(None), UserData.ETA > 0)
+                .all()
+            )
+            db.rollback()  # do not hold the read transaction open during the API calls
+
+            due = select_due(users, clock.now(), min(settings.eta_refresh_batch_size, self.budget.available()))
+            if not due:
+                return 0
+            self.budget.try_acquire(len(due))
+            return await self._refresh(db, due)
+        finally:
+            db.close()
+
+    async def resolve_pending(self):
+        """
+        Resolve the real ETA of every user queued with resolve_soon().
+
+        Returns:
+            int: The number of users whose ETA was updated.
+        """
+        user_ids, self._pending = self._pending, set()
+        if not user_ids:
+            return 0
+        db = self.session_factory()
+        try:
+            users = (
+                db.query(UserData.id, UserData.counter, UserData.service_id, UserData.ETA, UserData.latitude, UserData.longitude)
+                .filter(UserData.id.in_(user_ids), UserData.latitude.isnot(None), UserData.longitude.isnot(None))
+                .all()
+            )
+            db.rollback()
+            return await self._refresh(db, users)
+        finally:
+            db.close()
+
+    async def _refresh(self, db, users):
+        """
+        Fetch new ETAs for the users and write them, one executemany and re-sort per queue.
+
+        A queue is a counter, or the shared queue of a service for users without a counter.
+        The API calls are awaited without any lock, so a user whose ETA or location was
+        changed meanwhile, e.g. by PUT /distance, is skipped instead of overwritten with an
+        ETA computed from its old location. A user refreshed to ETA 0 has arrived, like in
+        routes.get_distance.update_eta, and an arrived head of a counter starts being served.
+        """
+        results = await asyncio.gather(
+            *(self._fetch_eta(Location(latitude=user.latitude, longitude=user.longitude)) for user in users),
+            return_exceptions=True
+        )
+        refreshed_at = clock.now()
+        by_queue = {}
+        service_of = {}
+        for user, eta in zip(users, results):
+            if isinstance(eta, BaseException) or eta is None:
+                logging.debug(f"ETA refresh for user {user.id} failed: {eta}")
+                continue
+            queue = ("counter", user.counter) if user.counter is not None else ("service", user.service_id)
+            service_of[queue] = user.service_id
+            by_queue.setdefault(queue, []).append(
+                {"user_id": user.id, "counter_id": user.counter, "new_eta": eta, "refreshed_at": refreshed_at,
+                 "read_eta": user.ETA, "read_latitude": user.latitude, "read_longitude": user.longitude}
+            )
+
+        table = UserData.__table__
+        values = dict(ETA=bindparam("new_eta"), eta_updated_at=bindparam("refreshed_at"))
+        # users updated since they were read are skipped, and so are users moved to another
+        # counter meanwhile, their new counter owns them
+        unchanged = (
+            table.c.id == bindparam("user_id"),
+            table.c.ETA == bindparam("read_eta"),
+            table.c.latitude == bindparam("read_latitude"),
+            table.c.longitude == bindparam("read_longitude"),
+        )
+        counter_statement = update(table).where(*unchanged, table.c.counter == bindparam("counter_id")).values(**values)
+        shared_statement = update(table).where(*unchanged, table.c.counter.is_(None)).values(**values)
+        refreshed = 0
+        for (kind, queue_id), rows in by_queue.items():
+            if kind == "counter":
+                lock, statement, resort = counter_locks(queue_id), counter_statement, resort_counter
+            else:
+                lock, statement, resort = service_queue_lock(queue_id), shared_statement, resort_service_queue
+            async with lock:
+                if kind == "counter":
+                    # the counter is re-sorted in the database, a write-behind copy must not overwrite it
+                    queue_store.release(queue_id)
+                fetched = len(rows)
+                try:
+                    db.execute(statement, rows)
+                    # the rows the UPDATE skipped keep their own eta_updated_at
+                    written = {
+                        user_id
+                        for user_id, updated_at in db.execute(
+                            select(table.c.id, table.c.eta_updated_at).where(table.c.id.in_([row["user_id"] for row in rows]))
+                        )
+                        if updated_at == refreshed_at
+                    }
+                    rows = [row for row in rows if row["user_id"] in written]
+                    arrived = [row["user_id"] for row in rows if row["new_eta"] == 0]
+                    if arrived:
+                        db.execute(update(table).where(table.c.id.in_(arrived), table.c.arrived_at.is_(None)).values(arrived_at=refreshed_at))
+                    queue = resort(db, queue_id)
+                    # a shared queue's head is only served once a counter calls it
+                    if kind == "counter" and queue and queue[0].ETA == 0:
+                        start_service(queue[0])
+                    db.commit()
+                except SQLAlchemyError as e:
+                    db.rollback()
+                    logging.error(f"ETA refresh of {kind} {queue_id} failed: {str(e)}")
+                    continue
+            if fetched > len(rows):
+                logging.debug(f"ETA refresh of {kind} {queue_id} skipped {fetched - len(rows)} users updated meanwhile")
+            queue_view.touch(service_of[(kind, queue_id)])
+            for row in rows:
+                event_log.eta(row["user_id"], service_of[(kind, queue_id)], row["counter_id"], row["new_eta"])
+            refreshed += len(rows)
+        logging.debug(f"refreshed {refreshed} ETAs across {len(by_queue)} queues")
+        return refreshed
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_cycle = loop.time()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(next_cycle - loop.time(), 0))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                if self._pending:
+                    await self.resolve_pending()
+                if loop.time() >= next_cycle:
+                    next_cycle = loop.time() + settings.eta_refresh_cycle_s
+                    await self.refresh_once()
+            except Exception as e:
+                logging.error(f"ETA refresh cycle failed: {str(e)}")
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            if self._pending:
+                self._wakeup.set()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+
+
+eta_refresher = EtaRefresher()
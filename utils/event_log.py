@@ -0,0 +1,429 @@
+import argparse, asyncio, glob, logging, os, time, zlib
+import numpy as np
+from utils.clock import clock
+from utils.global_settings import settings
+
+logger = logging.getLogger(__name__)
+
+# one fixed-size 48 byte record per queue operation; unused fields are 0
+EVENT_DTYPE = np.dtype([
+    ("seq", "<u8"),         # 1, 2, ... across all segments, 0 marks unwritten space
+    ("time_ns", "<i8"),     # utils.clock nanoseconds since the epoch
+    ("user_id", "<i8"),
+    ("service_id", "<i4"),
+    ("counter_id", "<i4"),  # NO_COUNTER while waiting in a shared queue
+    ("value", "<i4"),       # the ETA of register/eta events, the counter count of service events
+    ("kind", "u1"),
+    ("priority", "u1"),     # the priority level of register events, the rank level of promote events
+    ("_pad", "u1", (2,)),
+    ("skip_offset", "<i4"), # the hold-back of move events, minutes added to the ETA for ranking
+    ("crc", "<u4"),         # crc32 of the bytes before it
+])
+CRC_OFFSET = EVENT_DTYPE.fields["crc"][1]
+
+REGISTER, POP, ETA, MOVE, SERVICE_CREATE, SERVICE_UPDATE, SERVICE_DELETE, RESET, PROMOTE = range(1, 10)
+KIND_NAMES = {REGISTER: "register", POP: "pop", ETA: "eta", MOVE: "move",
+              SERVICE_CREATE: "service_create", SERVICE_UPDATE: "service_update", SERVICE_DELETE: "service_delete",
+              RESET: "reset", PROMOTE: "promote"}
+NO_COUNTER = -1
+SEGMENT_PATTERN = "events-*.log"
+
+
+def _crc(record: np.ndarray):
+    return zlib.crc32(record.tobytes()[:CRC_OFFSET])
+
+
+def _segment_paths(directory: str):
+    # named after their first sequence number, zero padded, so names sort in log order
+    return sorted(glob.glob(os.path.join(directory, SEGMENT_PATTERN)))
+
+
+def _valid_length(records: np.ndarray):
+    """
+    The number of records at the start of a segment that were written completely.
+    """
+    unwritten = np.flatnonzero(records["seq"] == 0)
+    end = unwritten[0] if len(unwritten) else len(records)
+    # a crash can leave the last group commit half written
+    while end and _crc(records[end - 1]) != records["crc"][end - 1]:
+        end -= 1
+    return end
+
+
+class EventLog:
+    """
+    Append-only log of queue operations in segmented, memory-mapped files.
+
+    Every operation is a fixed-size binary record. Records are buffered in memory and
+    written by a group commit: every `flush_ms`, or as soon as `batch_size` records are
+    waiting, the whole buffer is copied into the current segment and synced to disk
+    with one msync. A full segment is closed and a new one is preallocated.
+
+    The log is only written while open; start() opens it from main.lifespan.
+
+    Attributes:
+        directory (str): Where the segment files live.
+        segment_records (int): Records per segment file.
+    """
+
+    def __init__(self, directory: str = None, segment_mb: int = None, flush_ms: int = None, batch_size: int = None):
+        self.directory = directory or settings.event_log_dir
+        self.segment_records = (segment_mb or settings.event_log_segment_mb) * 1024 * 1024 // EVENT_DTYPE.itemsize
+        self.flush_ms = flush_ms or settings.event_log_flush_ms
+        self.batch_size = batch_size or settings.event_log_batch_size
+        self.next_seq = None
+        self._buffer = []
+        self._waiters = []
+        self._segment = None
+        self._position = 0
+        self._wakeup = None
+        self._task = None
+
+    def _open_segment(self, path: str, create: bool):
+        if create:
+            with open(path, "wb") as segment:
+                segment.truncate(self.segment_records * EVENT_DTYPE.itemsize)
+        self._segment = np.memmap(path, dtype=EVENT_DTYPE, mode="r+")
+
+    def open(self):
+        """
+        Open the newest segment, or create the first one, and find where appending resumes.
+        """
+        if self._segment is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        paths = _segment_paths(self.directory)
+        if not paths:
+            self.next_seq = 1
+            self._open_segment(os.path.join(self.directory, f"events-{1:020d}.log"), create=True)
+            self._position = 0
+            return
+        self._open_segment(paths[-1], create=False)
+        self._position = _valid_length(self._segment)
+        # records after a torn write are cleared, so readers stop at the same place
+        torn = self._position + np.flatnonzero(self._segment["seq"][self._position:])
+        if len(torn):
+            logging.warning(f"event log dropping {len(torn)} incompletely written events")
+            self._segment["seq"][torn] = 0
+            self._segment.flush()
+        first_seq = int(os.path.basename(paths[-1])[len("events-"):-len(".log")])
+        self.next_seq = int(self._segment["seq"][self._position - 1]) + 1 if self._position else first_seq
+        logging.info(f"event log opened at sequence {self.next_seq} in {paths[-1]}")
+
+    def close(self):
+        if self._segment is not None:
+            self.flush()
+            self._segment.flush()
+            self._segment = None
+
+    def append(self, kind: int, user_id: int = 0, service_id: int = 0, counter_id: int = None, value: int = 0, priority: int = 0,
+               skip_offset: int = 0):
+        """
+        Buffer one event. Never touches the disk; does nothing while the log is closed.
+        """
+        if self._segment is None:
+            return
+        counter_id = NO_COUNTER if counter_id is None else counter_id
+        self._buffer.append((self.next_seq, clock.time_ns(), user_id, service_id, counter_id, value or 0, kind, priority or 0,
+                             skip_offset or 0))
+        self.next_seq += 1
+        if len(self._buffer) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def register(self, user_id: int, service_id: int, counter_id: int, eta: int, priority: int = 0):
+        self.append(REGISTER, user_id, service_id, counter_id, eta, priority)
+
+    def pop(self, user_id: int, service_id: int, counter_id: int):
+        self.append(POP, user_id, service_id, counter_id)
+
+    def eta(self, user_id: int, service_id: int, counter_id: int, eta: int):
+        self.append(ETA, user_id, service_id, counter_id, eta)
+
+    def move(self, user_id: int, service_id: int, counter_id: int, skip_offset: int = 0):
+        """
+        A user changed queue, or its place in the queue: a skip or a no-show demotion is a move to the same counter.
+        """
+        self.append(MOVE, user_id, service_id, counter_id, skip_offset=skip_offset)
+
+    def promote(self, user_id: int, service_id: int, counter_id: int, level: int):
+        """
+        A user was aged into a higher rank level, see utils.aging.
+        """
+        self.append(PROMOTE, user_id, service_id, counter_id, priority=level)
+
+    def service(self, kind: int, service_id: int, no_of_counters: int = 0):
+        self.append(kind, service_id=service_id, value=no_of_counters)
+
+    def reset(self):
+        """
+        Mark that every queue was emptied, e.g. by clear_queue at startup.
+
+        User IDs can be handed out again afterwards, so replay ignores every user event before it.
+        """
+        self.append(RESET)
+
+    def pending(self):
+        return len(self._buffer)
+
+    def flush(self):
+        """
+        Write every buffered event and sync the segment once.
+
+        Returns:
+            int: The number of events written.
+        """
+        if not self._buffer or self._segment is None:
+            return 0
+        events, self._buffer = self._buffer, []
+        records = np.zeros(len(events), dtype=EVENT_DTYPE)
+        for name, column in zip(("seq", "time_ns", "user_id", "service_id", "counter_id", "value", "kind", "priority", "skip_offset"), zip(*events)):
+            records[name] = column
+        records["crc"] = [_crc(record) for record in records]
+
+        written = 0
+        while written < len(records):
+            if self._position == len(self._segment):
+                self._segment.flush()
+                first_seq = int(records["seq"][written])
+                self._open_segment(os.path.join(self.directory, f"events-{first_seq:020d}.log"), create=True)
+                self._position = 0
+            count = min(len(records) - written, len(self._segment) - self._position)
+            self._segment[self._position:self._position + count] = records[written:written + count]
+            self._position += count
+            written += count
+        self._segment.flush()
+        self._release_waiters(int(records["seq"][-1]))
+        return written
+
+    def _release_waiters(self, durable_seq: int, error: Exception = None):
+        waiting = []
+        for seq, future in self._waiters:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            elif seq <= durable_seq:
+                future.set_result(None)
+            else:
+                waiting.append((seq, future))
+        self._waiters = waiting
+
+    async def sync(self):
+        """
+        Wait until every event appended so far is on disk.
+
+        Joins the next group commit instead of forcing one per caller, unless no
+        flusher task is running.
+
+        Raises:
+            OSError: If the group commit fails.
+        """
+        if self._segment is None or not self._buffer:
+            return
+        if self._task is None:
+            self.flush()
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((self.next_seq - 1, future))
+        await future
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                logging.error(f"event log flush failed: {str(e)}")
+                self._release_waiters(0, error=e)
+
+    def start(self):
+        self.open()
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+        self.close()
+
+
+def read_events(directory: str = None, verify: bool = False):
+    """
+    Load every written event of a log, oldest first.
+
+    Args:
+        directory (str, optional): The log directory. Defaults to settings.event_log_dir.
+        verify (bool, optional): Check every record's crc, not only the tail of each segment.
+
+    Returns:
+        np.ndarray: The events as EVENT_DTYPE records.
+
+    Raises:
+        ValueError: If `verify` finds a corrupted record.
+    """
+    segments = []
+    for path in _segment_paths(directory or settings.event_log_dir):
+        records = np.memmap(path, dtype=EVENT_DTYPE, mode="r")
+        records = np.array(records[:_valid_length(records)])
+        if verify:
+            bad = [int(record["seq"]) for record in records if _crc(record) != record["crc"]]
+            if bad:
+                raise ValueError(f"{len(bad)} corrupted events in {path}, first at sequence {bad[0]}")
+        segments.append(records)
+    return np.concatenate(segments) if segments else np.zeros(0, dtype=EVENT_DTYPE)
+
+
+def _last(keys: np.ndarray, mask: np.ndarray):
+    """
+    For every key among the masked events, the index of its latest masked event.
+    """
+    indices = np.flatnonzero(mask)[::-1]
+    unique, first = np.unique(keys[indices], return_index=True)
+    return unique, indices[first]
+
+
+def replay(events: np.ndarray):
+    """
+    Rebuild the queues from a sequence of events, fully vectorized.
+
+    Only the user events after the latest reset count: the queues were emptied there and
+    user IDs may have been reused since. Services outlive resets.
+
+    A user's counter and skip_offset come from its latest register or move event, its
+    ETA from its latest register or eta event, its rank level from its latest register
+    or promote event, and it is gone if its latest event is a pop or its service was
+    deleted. Positions follow utils.priority.rank_key within each queue, the order the
+    routes keep in user_data: rank level, then ETA plus skip_offset.
+
+    Returns:
+        dict: Arrays "user_id", "service_id", "counter_id" (NO_COUNTER in a shared queue),
+            "eta", "skip_offset", "priority" and "pos", sorted by service, counter and position, and
+            "services", the IDs of the services that exist.
+    """
+    kind = events["kind"]
+    services, last_service = _last(events["service_id"], (kind >= SERVICE_CREATE) & (kind <= SERVICE_DELETE))
+    services = services[kind[last_service] != SERVICE_DELETE]
+
+    resets = np.flatnonzero(kind == RESET)
+    if len(resets):
+        events = events[resets[-1] + 1:]
+        kind = events["kind"]
+
+    users, last_event = _last(events["user_id"], (kind >= REGISTER) & (kind <= MOVE))
+    # users registered before the log was started can not be rebuilt
+    known = np.isin(users, events["user_id"][kind == REGISTER])
+    alive = known & (kind[last_event] != POP)
+    users = users[alive]
+
+    def latest(field: str, kinds):
+        keys, indices = _last(events["user_id"], np.isin(kind, kinds))
+        return events[field][indices[np.searchsorted(keys, users)]]
+
+    service_id = latest("service_id", [REGISTER])
+    counter_id = latest("counter_id", [REGISTER, MOVE])
+    eta = latest("value", [REGISTER, ETA])
+    skip_offset = latest("skip_offset", [REGISTER, MOVE]).astype(np.int64)
+    registered = latest("seq", [REGISTER])
+    priority = latest("priority", [REGISTER]).astype(np.int64)
+    level = latest("priority", [REGISTER, PROMOTE]).astype(np.int64)
+
+    keep = np.isin(service_id, services)
+    users, service_id, counter_id, eta, registered = users[keep], service_id[keep], counter_id[keep], eta[keep], registered[keep]
+    skip_offset = skip_offset[keep]
+    priority, level = priority[keep], level[keep]
+    order = np.lexsort((registered, eta + skip_offset, -level, counter_id, service_id))
+    users, service_id, counter_id, eta, priority = users[order], service_id[order], counter_id[order], eta[order], priority[order]
+    skip_offset = skip_offset[order]
+
+    # position = rank within the (service, counter) queue
+    starts = np.ones(len(users), dtype=bool)
+    starts[1:] = (service_id[1:] != service_id[:-1]) | (counter_id[1:] != counter_id[:-1])
+    index = np.arange(len(users))
+    pos = index - np.maximum.accumulate(np.where(starts, index, 0)) + 1
+    return {"user_id": users, "service_id": service_id, "counter_id": counter_id, "eta": eta, "skip_offset": skip_offset,
+            "priority": priority, "pos": pos, "services": services}
+
+
+def check_against_db(state: dict, db):
+    """
+    Compare replayed queues with user_data, e.g. after a crash or for an audit.
+
+    Returns:
+        dict: {user_id: (replayed (service, counter, ETA) or None, stored one or None)} for every difference.
+    """
+    from database.models import UserData
+
+    stored = {
+        user_id: (service_id, NO_COUNTER if counter_id is None else counter_id, eta)
+        for user_id, service_id, counter_id, eta in db.query(UserData.id, UserData.service_id, UserData.counter, UserData.ETA)
+    }
+    replayed = {
+        int(user_id): (int(service_id), int(counter_id), int(eta))
+        for user_id, service_id, counter_id, eta in zip(state["user_id"], state["service_id"], state["counter_id"], state["eta"])
+    }
+    return {
+        user_id: (replayed.get(user_id), stored.get(user_id))
+        for user_id in replayed.keys() | stored.keys()
+        if replayed.get(user_id) != stored.get(user_id)
+    }
+
+
+event_log = EventLog()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect the queue event log.")
+    parser.add_argument("--dir", default=settings.event_log_dir)
+    commands = parser.add_subparsers(dest="command", required=True)
+    replay_parser = commands.add_parser("replay", help="rebuild the queues from the log")
+    replay_parser.add_argument("--check-db", action="store_true", help="compare the result with user_data")
+    commands.add_parser("verify", help="check the crc of every event")
+    dump_parser = commands.add_parser("dump", help="print events, for audits")
+    dump_parser.add_argument("--user", type=int)
+    dump_parser.add_argument("--service", type=int)
+    dump_parser.add_argument("--since", type=int, default=0, help="first sequence number")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    events = read_events(args.dir, verify=args.command == "verify")
+    loaded = time.perf_counter()
+    if args.command == "verify":
+        print(f"{len(events)} events verified in {loaded - started:.3f}s")
+    elif args.command == "dump":
+        mask = events["seq"] >= args.since
+        if args.user is not None:
+            mask &= events["user_id"] == args.user
+        if args.service is not None:
+            mask &= events["service_id"] == args.service
+        for event in events[mask]:
+            print(f"{event['seq']:>10} {event['time_ns'] / 1e9:.6f} {KIND_NAMES.get(int(event['kind']), event['kind']):<15}"
+                  f" user={event['user_id']} service={event['service_id']} counter={event['counter_id']} value={event['value']}"
+                  f" priority={event['priority']} skip_offset={event['skip_offset']}")
+    else:
+        state = replay(events)
+        replayed = time.perf_counter()
+        print(f"{len(events)} events read in {loaded - started:.3f}s, replayed in {replayed - loaded:.3f}s: "
+              f"{len(state['user_id'])} queued users in {len(state['services'])} services")
+        if args.check_db:
+            from database.db import SessionLocal
+
+            db = SessionLocal()
+            try:
+                started = time.perf_counter()
+                differences = check_against_db(state, db)
+                print(f"compared with user_data in {time.perf_counter() - started:.3f}s, {len(differences)} differences")
+                for user_id, (replayed_user, stored_user) in sorted(differences.items())[:50]:
+                    print(f"  user {user_id}: log {replayed_user}, database {stored_user}")
+            finally:
+                db.close()
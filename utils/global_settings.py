@@ -12,7 +12,78 @@ class Settings(BaseSettings):
     uid: int = 0
 
     is_empty: bool = True
-    global_counter: int = 1
+
+    # served-user history writer
+    history_batch_size: int = 200
+    history_flush_ms: int = 500
+    history_retention_days: int = 90
+    history_purge_interval_s: int = 3600
+
+    # background ETA refresher
+    eta_refresh_cycle_s: float = 15.0
+    eta_refresh_front_size: int = 3  # users per counter refreshed every cycle
+    eta_refresh_batch_size: int = 25
+    eta_api_calls_per_minute: int = 60  # global budget for refresher calls to the distance API
+
+    # distance API client
+    distance_api_timeout_s: float = 2.0
+    distance_api_calls_per_second: float = 10.0
+    distance_api_daily_quota: int = 0  # 0 means unlimited
+    breaker_failure_threshold: int = 5
+    breaker_reset_s: float = 30.0
+    distance_coalesce_decimals: int = 3  # identical in-flight lookups share one call, ~110 m cells
+    # local fallback estimator, calibrated from live answers at runtime
+    estimator_road_factor: float = 1.4
+    estimator_speed_kmh: float = 25.0
+    # precomputed travel-time grid around the branch, see utils/travel_grid.py
+    travel_grid_path: str = os.path.join("data", "travel_grid.npy")
+    travel_grid_cell_m: float = 250.0
+    travel_grid_radius_km: float = 20.0
+    travel_grid_search_cells: int = 2  # how far a lookup looks for a learned neighbour
+
+    # counter assignment for services created without an explicit strategy
+    default_assignment_strategy: str = "least_count"
+
+    # priority classes: queues are ordered by level, highest first, then by ETA
+    priority_levels: dict = {"regular": 0, "vip": 1, "elderly": 2, "disabled": 2}
+    priority_aging_s: float = 600.0  # waiting this long raises a user one level, 0 disables aging
+    priority_aging_interval_s: float = 60.0  # how often utils/aging.py applies it, promotions lag by up to this long
+
+    # appointment booking, see utils/appointments.py
+    appointment_slot_minutes: int = 15
+    appointment_horizon_days: int = 14
+    appointment_capacity_share: float = 0.5  # part of a slot's service capacity that can be booked, the rest is for walk-ins
+    appointment_default_service_s: float = 300.0  # assumed service time of counters without history
+    appointment_merge_lead_s: float = 600.0  # booked users join the live queue this long before their slot
+    appointment_merge_interval_s: float = 30.0
+
+    # no-show sweeper, see utils/no_show.py
+    no_show_sweep_interval_s: float = 60.0
+    no_show_grace_s: float = 900.0  # how long past their predicted arrival users may be without arriving
+    no_show_demote_minutes: int = 10  # a demoted no-show is queued as if arriving this long from now
+    max_skip_count: int = 3  # skips and demotions a user may collect, one more evicts it
+    skip_default_places: int = 3  # how far back an operator skip moves the head when not told
+
+    # users reporting a location this close to the branch are treated as arrived
+    geofence_radius_m: float = 100.0
+
+    # in-memory queue view behind the snapshot endpoint, reloaded fully at least this often
+    queue_view_max_age_s: float = 30.0
+    queue_change_log_size: int = 10000  # changes kept for delta sync, older clients get a snapshot
+
+    # append-only log of queue operations, see utils/event_log.py
+    event_log_enabled: bool = True
+    event_log_dir: str = os.path.join("data", "event_log")
+    event_log_segment_mb: int = 64
+    event_log_flush_ms: int = 20  # group commit interval
+    event_log_batch_size: int = 1000  # events that trigger an immediate group commit
+
+    # "direct" commits every queue change in its request, "write_behind" keeps per-counter
+    # queues in memory and writes them every write_behind_flush_ms, see utils/queue_store.py
+    persistence_mode: str = "direct"
+    write_behind_flush_ms: int = 50
+    # "memory" acknowledges write-behind changes at once, "log" after the event log's group commit
+    write_behind_durability: str = "memory"
 
     
 settings = Settings()
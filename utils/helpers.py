@@ -1,18 +1,28 @@
-import requests, re
 from schema.distance_models import *
 from fastapi import HTTPException
+from sqlalchemy import insert, update, func, case, and_
 from sqlalchemy.orm import Session
-from database.models import UserData, Counter#, Service
+from sqlalchemy.exc import SQLAlchemyError
+from database.models import UserData, Counter, Service
 import time
 from status import StatusCode
-from utils.global_settings import (
-    settings,
-    DISTANCEMATRIX_API_KEY,
-    Q_SOLUTIONS_COORDS
-)
+from utils.clock import clock
+from utils.priority import rank_order, rank_key
+from utils.locks import counter_locks
+from utils.assignment import counter_assignment, CounterPool
+from utils.queue_view import queue_view
+from utils.event_log import event_log
+from utils.queue_store import queue_store
+from utils.distance_client import distance_client
 import logging
 from utils.global_settings import settings, setup_logging
 
+# the user_data columns utils.priority.rank_key reads
+RANK_COLUMNS = (UserData.id, UserData.priority, UserData.rank_level, UserData.ETA, UserData.skip_offset)
+
+# how many times an optimistic counter update is re-read and retried after a version conflict
+COUNTER_UPDATE_RETRIES = 3
+
 setup_logging()
 logger = logging.getLogger(__name__)
 
@@ -37,60 +47,464 @@ def clear_queue(db):
     Notes:
         - This function is used to reset the database.
         - It permanently deletes all user data, so use with caution.
+        - Services, counters, stations, appointments and the served history are kept;
+          the counters' queue lengths and the stations' current users are reset with the queues.
         - Mostly used for testing purposes.
     """
     # imported here to avoid circular imports
     logging.info("clearing database")
-    from database.models import UserData
+    from database.models import UserData, OperatorStation
     db.query(UserData).delete()
+    db.query(Counter).update({Counter.in_queue: 0, Counter.version: Counter.version + 1}, synchronize_session=False)
+    db.query(OperatorStation).update({OperatorStation.current_counter: None, OperatorStation.current_user: None}, synchronize_session=False)
     db.commit()
 
-def get_ETA(location: Location):
+def load_counters(db: Session):
+    """
+    Rebuild the in-memory counters dictionary from the database.
+
+    Args:
+        db (Session): A database session.
+
+    Returns:
+        None
+
+    Notes:
+        - settings.counters is process-local, so every worker rebuilds it on startup
+          from the counters table instead of trusting a local ID sequence.
+        - The per-service assignment strategies, queue modes, counter service times and statuses are reloaded too.
+    """
+    queued = dict(
+        db.query(UserData.counter, func.count(UserData.id))
+        .group_by(UserData.counter)
+        .all()
+    )
+    counter_assignment.reset()
+    counters = {}
+    for counter_id, service_id, total_tat, users_processed, status in (
+        db.query(Counter.id, Counter.service_id, Counter.total_tat, Counter.users_processed, Counter.status).order_by(Counter.id).all()
+    ):
+        counters.setdefault(service_id, {})[counter_id] = queued.get(counter_id, 0)
+        counter_assignment.load_counter(counter_id, total_tat, users_processed)
+        counter_assignment.set_counter_status(service_id, counter_id, status)
+    for service_id, strategy, queue_mode in db.query(Service.id, Service.assignment_strategy, Service.queue_mode).all():
+        counter_assignment.set_strategy(service_id, strategy)
+        counter_assignment.set_queue_mode(service_id, queue_mode)
+    settings.counters = counters
+    logging.info(f"loaded counters from database: {settings.counters}")
+
+def allocate_counters(db: Session, service_id: int, count: int):
+    """
+    Create counters for a service and return their database-assigned IDs.
+
+    The IDs come from the counters table's autoincrement, so they are unique across
+    workers and restarts. On backends that support it the rows are written with a
+    single bulk INSERT ... RETURNING, otherwise the ORM flush fetches each new ID.
+
+    Args:
+        db (Session): A database session.
+        service_id (int): The ID of the service the counters belong to.
+        count (int): The number of counters to create.
+
+    Returns:
+        list[int]: The IDs of the new counters in ascending order.
+
+    Notes:
+        - The caller owns the transaction; nothing is committed here.
+    """
+    if count <= 0:
+        return []
+    if db.get_bind().dialect.insert_executemany_returning:
+        counter_ids = db.scalars(
+            insert(Counter).returning(Counter.id),
+            [{"service_id": service_id} for _ in range(count)]
+        ).all()
+    else:
+        new_counters = [Counter(service_id=service_id) for _ in range(count)]
+        db.add_all(new_counters)
+        db.flush()
+        counter_ids = [counter.id for counter in new_counters]
+    logging.info(f"Allocated counters {counter_ids} to service {service_id}")
+    return sorted(counter_ids)
+
+def adjust_counter_load(service_id: int, counter_id: int, delta: int):
+    """
+    Apply a change in queue length to the in-memory counters dictionary.
+
+    Args:
+        service_id (int): The ID of the service the counter belongs to.
+        counter_id (int): The ID of the counter.
+        delta (int): The number of users added (positive) or removed (negative).
+
+    Returns:
+        None
+
+    Notes:
+        - Callers must hold the counter's lock from utils.locks.
+    """
+    service_counters = settings.counters.setdefault(service_id, {})
+    service_counters[counter_id] = max(service_counters.get(counter_id, 0) + delta, 0)
+    counter_assignment.touch(service_id, counter_id)
+
+def update_counter_stats(db: Session, counter_id: int, in_queue_delta: int = 0, served_time: float = None, expected_version: int = None):
+    """
+    Atomically update a counter's statistics with a single UPDATE statement.
+
+    The new values are computed by the database from the current row
+    (e.g. in_queue = in_queue + 1), so no SELECT is needed beforehand and
+    concurrent updates cannot overwrite each other. Every update bumps the
+    counter's version.
+
+    Args:
+        db (Session): A database session.
+        counter_id (int): The ID of the counter to update.
+        in_queue_delta (int, optional): Change in the number of queued users. Defaults to 0.
+        served_time (float, optional): Processing time of a user that was just served.
+                                       When given, users_processed, total_tat and avg_tat are updated.
+        expected_version (int, optional): Only update the row if it still has this version.
+
+    Returns:
+        bool: True if the counter was updated, False if it does not exist or its version changed.
+
+    Notes:
+        - The caller owns the transaction; nothing is committed here.
+    """
+    assignments = []
+    if served_time is not None:
+        # avg_tat is assigned first: MySQL evaluates SET clauses left to right,
+        # so it must still see the old total_tat and users_processed
+        assignments.append((Counter.avg_tat, (Counter.total_tat + served_time) / (Counter.users_processed + 1)))
+        assignments.append((Counter.total_tat, Counter.total_tat + served_time))
+        assignments.append((Counter.users_processed, Counter.users_processed + 1))
+    if in_queue_delta:
+        assignments.append((Counter.in_queue, case((Counter.in_queue + in_queue_delta > 0, Counter.in_queue + in_queue_delta), else_=0)))
+    assignments.append((Counter.version, Counter.version + 1))
+
+    statement = update(Counter).where(Counter.id == counter_id)
+    if expected_version is not None:
+        statement = statement.where(Counter.version == expected_version)
+    result = db.execute(
+        statement.ordered_values(*assignments),
+        execution_options={"synchronize_session": False}
+    )
+    return result.rowcount == 1
+
+async def get_ETA(location: Location, prefer_local: bool = False):
     """
     Calculate the estimated time of arrival (ETA) for a user at a given location.
 
-    This function uses the Distance Matrix API to calculate the travel time from the user's location to the Q Solutions coordinates.
+    This function asks the Distance Matrix API for the travel time from the user's location to the Q Solutions coordinates.
 
     Args:
         location (Location): The user's location.
+        prefer_local (bool, optional): Answer from the precomputed travel grid when it covers the location.
 
     Returns:
         int: The estimated time of arrival in minutes.
 
+    Notes:
+        - The call is bounded by a timeout, a rate limit, the daily quota and a circuit breaker.
+          When the API can not be used the ETA comes from the local estimator instead, so
+          this never fails because of the external service.
+    """
+    return await distance_client.eta(location, prefer_local=prefer_local)
+    
+
+def provisional_ETA(location: Location):
+    """
+    Estimate the ETA for a user at a given location without any external call.
+
+    Args:
+        location (Location): The user's location.
+
+    Returns:
+        tuple[int, bool]: The ETA in minutes, and whether it is final. An ETA learned by the travel
+            grid is final; a straight-line estimate should be resolved with get_ETA later.
+    """
+    minutes = distance_client.grid.lookup(location)
+    if minutes is not None:
+        return minutes, True
+    return distance_client.estimator.estimate(location), False
+
+def resort_counter(db: Session, counter_id: int):
+    """
+    Reassign the queue positions of a counter in priority and ETA order, see utils.priority.rank_key.
+
+    Args:
+        db (Session): A database session.
+        counter_id (int): The ID of the counter to re-sort.
+
+    Returns:
+        list[UserData]: The users of the counter in their new order.
+
+    Notes:
+        - Callers must hold the counter's lock from utils.locks and own the transaction.
+        - Reads and sorts the whole queue, so it is for bulk changes like migrate_users and the
+          ETA refresher's batches; single changes use insert_ranked, move_to_rank and remove_ranked.
+    """
+    users_in_counter = (
+        db.query(UserData)
+        .filter(UserData.counter == counter_id)
+        .order_by(UserData.ETA)
+        .with_for_update()
+        .all()
+    )
+    rank_order(users_in_counter)
+    for index, user in enumerate(users_in_counter, start=1):
+        if user.pos != index:
+            user.pos = index
+    return users_in_counter
+
+def resort_service_queue(db: Session, service_id: int):
+    """
+    Reassign queue positions of a service's shared queue in priority and ETA order.
+
+    Args:
+        db (Session): A database session.
+        service_id (int): The ID of the service in the shared queue mode.
+
+    Returns:
+        list[UserData]: The waiting users of the service in their new order.
+
+    Notes:
+        - Callers must hold the service's lock from utils.locks.service_queue_lock and own the transaction.
+        - Users already called to a counter are not part of the shared queue.
+    """
+    waiting = (
+        db.query(UserData)
+        .filter(UserData.service_id == service_id, UserData.counter.is_(None))
+        .order_by(UserData.ETA)
+        .with_for_update()
+        .all()
+    )
+    rank_order(waiting)
+    for index, user in enumerate(waiting, start=1):
+        if user.pos != index:
+            user.pos = index
+    return waiting
+
+def _queue_of(user: UserData):
+    """
+    The filter for the queue a user is in: its counter's, or its service's shared queue.
+    """
+    if user.counter is not None:
+        return UserData.counter == user.counter
+    return and_(UserData.service_id == user.service_id, UserData.counter.is_(None))
+
+def _ranked_pos(db: Session, in_queue, key: tuple, low: int, high: int):
+    """
+    The first position in low .. high - 1 whose user ranks after key, or high if none does.
+
+    The stored positions of a queue are in rank_key order, so this is a bisection with
+    O(log n) point reads through the queue's (..., pos) index.
+    """
+    while low < high:
+        middle = (low + high) // 2
+        row = db.query(*RANK_COLUMNS).filter(in_queue, UserData.pos == middle).first()
+        if row is None or rank_key(row) > key:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+def _last_pos(db: Session, in_queue):
+    return db.query(func.max(UserData.pos)).filter(in_queue).scalar() or 0
+
+def _place_ranked(db: Session, user: UserData):
+    """
+    Give a user that is in a queue without a position (pos 0) its position by rank.
+
+    Only the users behind it move back by one, with a single UPDATE.
+    """
+    in_queue = _queue_of(user)
+    pos = _ranked_pos(db, in_queue, rank_key(user), 1, _last_pos(db, in_queue) + 1)
+    db.query(UserData).filter(in_queue, UserData.pos >= pos).update({UserData.pos: UserData.pos + 1})
+    user.pos = pos
+    db.flush()
+    return pos
+
+def insert_ranked(db: Session, user: UserData):
+    """
+    Add a new user at its rank in its counter's queue, or its service's shared queue, without re-sorting it.
+
+    The position is found by bisection with O(log n) point reads, see _ranked_pos; the
+    users behind it move back by one with a single UPDATE instead of being renumbered
+    one by one.
+
+    Args:
+        db (Session): A database session.
+        user (UserData): The new user, with its counter (None in a shared queue), ETA and priority set.
+
+    Returns:
+        int: The user's position.
+
+    Notes:
+        - Callers must hold the queue's lock and own the transaction.
+    """
+    user.pos = 0
+    db.add(user)
+    db.flush()  # for its ID, the rank tie-breaker
+    pos = _place_ranked(db, user)
+    # a shared queue's head is served only once a counter calls it
+    if pos == 1 and user.ETA == 0 and user.counter is not None:
+        start_service(user)
+        db.flush()
+    return pos
+
+def move_to_rank(db: Session, user: UserData):
+    """
+    Move a queued user whose rank key changed, e.g. after a skip, an ETA update or aging, to its rank without re-sorting the queue.
+
+    The rest of the queue is in rank order, so the new position is found by bisection
+    with O(log n) point reads, forward among the users before it or back among the users
+    behind it; only the users it passes move by one, with a single UPDATE.
+
+    Args:
+        db (Session): A database session.
+        user (UserData): The user, in a counter's queue or its service's shared queue.
+
+    Returns:
+        int: The user's new position.
+
+    Notes:
+        - Callers must hold the queue's lock and own the transaction.
+    """
+    in_queue = _queue_of(user)
+    key = rank_key(user)
+    new_pos = _ranked_pos(db, in_queue, key, 1, user.pos)
+    if new_pos < user.pos:
+        db.query(UserData).filter(in_queue, UserData.pos >= new_pos, UserData.pos < user.pos).update(
+            {UserData.pos: UserData.pos + 1}
+        )
+        user.pos = new_pos
+    else:
+        # the first position behind the user whose key is greater, in user.pos + 1 .. last + 1
+        new_pos = _ranked_pos(db, in_queue, key, user.pos + 1, _last_pos(db, in_queue) + 1) - 1
+        if new_pos > user.pos:
+            db.query(UserData).filter(in_queue, UserData.pos > user.pos, UserData.pos <= new_pos).update(
+                {UserData.pos: UserData.pos - 1}
+            )
+            user.pos = new_pos
+    db.flush()
+    return user.pos
+
+def move_to_counter(db: Session, user: UserData, counter_id: int):
+    """
+    Move a queued user to another counter's queue, at its rank there.
+
+    The users behind it in its old queue move up by one and those behind its new place
+    move back by one, a single UPDATE each.
+
+    Returns:
+        int: The user's position in the new queue.
+
+    Notes:
+        - Callers must hold both counters' locks and own the transaction.
+    """
+    old_queue, old_pos = _queue_of(user), user.pos
+    user.counter = counter_id
+    user.pos = 0
+    db.flush()
+    db.query(UserData).filter(old_queue, UserData.pos > old_pos).update({UserData.pos: UserData.pos - 1})
+    return _place_ranked(db, user)
+
+def remove_ranked(db: Session, user: UserData):
+    """
+    Delete a queued user; the users behind it move up by one with a single UPDATE, the queue stays in rank order.
+
+    Notes:
+        - Callers must hold the queue's lock and own the transaction.
+    """
+    in_queue, pos = _queue_of(user), user.pos
+    db.delete(user)
+    db.flush()
+    db.query(UserData).filter(in_queue, UserData.pos > pos).update({UserData.pos: UserData.pos - 1})
+
+def migrate_users(db: Session, service_id: int, source_ids: list, target_ids: list, keep_started: bool = False):
+    """
+    Move the users of closed or removed counters to other counters of the service in one bulk assignment pass.
+
+    The users are read with one query and handed out best rank first by a CounterPool over
+    the targets' loads and the service's assignment strategy, so every placement sees the
+    loads left by the previous ones at O(log k) each. Each counter that received users is
+    then re-sorted once to merge them in by rank, and each counter's in_queue is changed
+    with one update, instead of one rebalance move per user.
+
+    Args:
+        db (Session): A database session.
+        service_id (int): The ID of the service.
+        source_ids (list[int]): The counters to empty.
+        target_ids (list[int]): The counters that take the users.
+        keep_started (bool, optional): Leave a user whose service has started at its counter. Defaults to False.
+
+    Returns:
+        list[tuple[int, int, int, int]]: The (user_id, from_counter, to_counter, skip_offset) of every moved user.
+
     Raises:
         HTTPException:
-            - If there's an error during the API request (500).
-    """    
-    try:
-        response = requests.get(
-            f"https://api.distancematrix.ai/maps/api/distancematrix/json",
-            params={
-                "origins": f"{location.latitude},{location.longitude}",
-                "destinations": f"{Q_SOLUTIONS_COORDS[0]},{Q_SOLUTIONS_COORDS[1]}",
-                "key": DISTANCEMATRIX_API_KEY
-            }
-        )
+            - If there are users to move but no target counter (400).
+            - If a counter's statistics can not be updated (404).
 
-        data = response.json()
-
-        if "rows" in data and data["rows"]:
-            # distance = data["rows"][0]["elements"][0]["distance"]["text"]
-            duration_str = data["rows"][0]["elements"][0]["duration"]["text"]
-            logging.debug(f"duration string: {duration_str}")
-            
-            duration_match = re.search(r'(?:(\d+)\s*hour[s]?)?\s*(?:(\d+)\s*min[s]?)?', duration_str)
-            if duration_match:
-                hours = int(duration_match.group(1)) if duration_match.group(1) else 0  
-                minutes = int(duration_match.group(2)) if duration_match.group(2) else 0
-
-                duration_in_minutes = (hours*60) + minutes
-                return duration_in_minutes
-        # else:
-            # raise HTTPException(status_code=500, detail="Failed to calculate ETA")
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail="Failed to calculate ETA "+str(e))
-    
+    Notes:
+        - Callers must hold the locks of the source and target counters, release their
+          write-behind copies and own the transaction. Once it is committed, apply_migration
+          updates the in-memory state.
+        - A moved user's service restarts at its new counter: service_started_at is cleared,
+          and set again if the user becomes the head of the queue having arrived.
+    """
+    users = db.query(UserData).filter(UserData.counter.in_(source_ids))
+    if keep_started:
+        users = users.filter(UserData.service_started_at.is_(None))
+    users = users.with_for_update().all()
+    if not users:
+        return []
+    if not target_ids:
+        raise HTTPException(status_code=StatusCode.BAD_REQUEST.value, detail=StatusCode.BAD_REQUEST.message)
+
+    service_counters = settings.counters.get(service_id, {})
+    loads = {counter_id: service_counters.get(counter_id, 0) for counter_id in target_ids}
+    strategy = counter_assignment.strategies.get(service_id, settings.default_assignment_strategy)
+    pool = CounterPool(loads, strategy, counter_assignment.service_times)
+    moves = []
+    for user in sorted(users, key=rank_key):
+        counter_id = pool.select()
+        moves.append((user.id, user.counter, counter_id, user.skip_offset))
+        user.counter = counter_id
+        user.service_started_at = None
+        loads[counter_id] += 1
+        pool.touch(counter_id)
+    db.flush()
+
+    deltas = {}
+    for _, from_counter, to_counter, _ in moves:
+        deltas[from_counter] = deltas.get(from_counter, 0) - 1
+        deltas[to_counter] = deltas.get(to_counter, 0) + 1
+    for counter_id, delta in deltas.items():
+        queue = resort_counter(db, counter_id)
+        if queue and queue[0].ETA == 0:
+            start_service(queue[0])
+        if not update_counter_stats(db, counter_id, in_queue_delta=delta):
+            raise HTTPException(status_code=StatusCode.NOT_FOUND.value, detail=StatusCode.NOT_FOUND.message)
+    db.flush()
+    logging.info(f"migrating {len(moves)} users of service {service_id} from counters {source_ids} to {target_ids}")
+    return moves
+
+def apply_migration(service_id: int, moves: list):
+    """
+    Apply a committed migrate_users to the in-memory counter loads, the queue view and the event log.
+
+    Notes:
+        - Callers must still hold the counters' locks.
+        - Counters no longer in settings.counters, i.e. removed ones, are left out.
+    """
+    service_counters = settings.counters.get(service_id, {})
+    for user_id, from_counter, to_counter, skip_offset in moves:
+        if from_counter in service_counters:
+            adjust_counter_load(service_id, from_counter, -1)
+        adjust_counter_load(service_id, to_counter, 1)
+        event_log.move(user_id, service_id, to_counter, skip_offset)
+    if moves:
+        queue_view.touch(service_id)
 
 async def check_if_serving(counter_id: int, db:Session):
     """
@@ -115,7 +529,7 @@ async def check_if_serving(counter_id: int, db:Session):
     if users:
         first_user = users[0]
         if first_user.ETA == 0:
-            first_user.processing_time = time.time()
+            start_service(first_user)
             if users.count() > 1:
                 settings.is_empty = False
             else: 
@@ -123,6 +537,20 @@ async def check_if_serving(counter_id: int, db:Session):
     else:
         raise HTTPException(status_code=400, detail=f"No users in counter {counter_id}")
 
+def start_service(user: UserData):
+    """
+    Record that a counter started serving the user, once.
+
+    A user who is being served has arrived, so arrived_at is filled in too if it is missing.
+    Both timestamps come from utils.clock, so durations computed from them never go
+    backwards when the system clock is adjusted.
+    """
+    now = clock.now()
+    if user.arrived_at is None:
+        user.arrived_at = now
+    if user.service_started_at is None:
+        user.service_started_at = now
+
 async def is_here(counter_id:int, db: Session):
     """
     Check if the first user in the queue for a specific counter has arrived.
@@ -142,7 +570,7 @@ async def is_here(counter_id:int, db: Session):
             - If the counter is empty (404).
             - If the counter ID is invalid (400).
     """
-    if Counter.id == counter_id:
+    if db.get(Counter, counter_id) is not None:
         first_user= (
             db.query(UserData)
             .filter(UserData.counter == counter_id)
@@ -180,56 +608,81 @@ async def rebalance_q(service_id:int, db:Session):
     Notes:
         - This function assumes that the service has at least two counters.
         - It moves users from the counter with the longest queue to the counter with the shortest queue until the queues are balanced.
+        - Only the two counters involved are locked, in ascending ID order, so rebalancing
+          never blocks pops or registrations on the other counters of the service.
+        - The counter rows are not locked in the database; the move is applied with
+          version-checked updates and retried if another worker changed either counter.
     """
-    service_counters = settings.counters[service_id]
-    if len(service_counters) > 1:
+    service_counters = settings.counters.get(service_id, {})
+    # paused and draining counters give users away but never receive any
+    open_counters = counter_assignment.open_loads(service_id)
+    if len(service_counters) > 1 and open_counters:
         
-        min_queue = min(service_counters.values())
-        shortest_queues = [counter for counter, users in service_counters.items() if users == min_queue]
+        min_queue = min(open_counters.values())
+        shortest_queues = [counter for counter, users in open_counters.items() if users == min_queue]
         _minQ = shortest_queues[0]  # Select the first counter with the least number of users
-        min_counter = (
-            db.query(Counter)
-            .filter(Counter.id == _minQ)
-            .first()
-        )
 
         max_queue = max(service_counters.values())
         longest_queues = [counter for counter, users in service_counters.items() if users==max_queue]
         _maxQ = longest_queues[0]
-        max_counter = (
-            db.query(Counter)
-            .filter(Counter.id == _maxQ)
-            .first()
-        )
-
-        if (min_counter and max_counter) and max_counter.in_queue > min_counter.in_queue + 1:
-            min_est = min_counter.avg_tat * min_counter.in_queue
-            # this will give us the position of the user to move
-            position_to_move = round(min_est / max_counter.avg_tat) + 1
-
-            user_rebalance= (
-                db.query(UserData)
-                .filter(UserData.counter == max_counter.id, UserData.pos == position_to_move)
-                .first()
-            )
-            user_rebalance.counter = min_counter.id
-            max_counter.in_queue -= 1
-            min_counter.in_queue += 1
-
-            reorder_max= (
-                db.query(UserData)
-                .filter(UserData.counter == max_counter.id)
-                .order_by(UserData.pos)
-                .all()
-            )
-            for index, user in enumerate(reorder_max, start=1):
-                user.pos = index
-
-            reorder_min= (
-                db.query(UserData)
-                .filter(UserData.counter == min_counter.id)
-                .order_by(UserData.pos)
-                .all()      
-            )
-            for index, user in enumerate(reorder_min, start=1):
-                user.pos = index
\ No newline at end of file
+        if _minQ == _maxQ:
+            return
+
+        async with counter_locks(_minQ, _maxQ):
+            # the move is made in the database, so write-behind copies of both counters are written and dropped
+            queue_store.release(_minQ, _maxQ)
+            for attempt in range(COUNTER_UPDATE_RETRIES):
+                counters = (
+                    db.query(Counter)
+                    .filter(Counter.id.in_([_minQ, _maxQ]))
+                    .all()
+                )
+                min_counter = next((counter for counter in counters if counter.id == _minQ), None)
+                max_counter = next((counter for counter in counters if counter.id == _maxQ), None)
+
+                # the loads may have changed since settings.counters was read
+                if not (min_counter and max_counter) or max_counter.in_queue <= min_counter.in_queue + 1:
+                    db.rollback()
+                    return
+
+                min_est = min_counter.avg_tat * min_counter.in_queue
+                # this will give us the position of the user to move
+                if max_counter.avg_tat:
+                    position_to_move = round(min_est / max_counter.avg_tat) + 1
+                else:
+                    position_to_move = min_counter.in_queue + 1
+
+                user_rebalance= (
+                    db.query(UserData)
+                    .filter(UserData.counter == max_counter.id, UserData.pos == position_to_move)
+                    .first()
+                )
+                if user_rebalance is None:
+                    db.rollback()
+                    return
+                # the moved user takes its rank among the users already there, the users behind it move up
+                pos = move_to_counter(db, user_rebalance, min_counter.id)
+
+                # both counters must still be at the versions the decision was based on
+                moved = (
+                    update_counter_stats(db, max_counter.id, in_queue_delta=-1, expected_version=max_counter.version)
+                    and update_counter_stats(db, min_counter.id, in_queue_delta=1, expected_version=min_counter.version)
+                )
+                if not moved:
+                    db.rollback()
+                    logging.debug(f"rebalance_q version conflict on service {service_id}, attempt {attempt + 1}")
+                    continue
+
+                try:
+                    db.commit()
+                except SQLAlchemyError as e:
+                    db.rollback()
+                    logging.error(f"rebalance_q failed for service {service_id}: {str(e)}")
+                    return
+                adjust_counter_load(service_id, max_counter.id, -1)
+                adjust_counter_load(service_id, min_counter.id, 1)
+                queue_view.move(service_id, user_rebalance.id, min_counter.id, pos)
+                event_log.move(user_rebalance.id, service_id, min_counter.id, user_rebalance.skip_offset)
+                logging.debug(f"moved user {user_rebalance.id} from counter {max_counter.id} to counter {min_counter.id}")
+                return
+            logging.warning(f"rebalance_q gave up on service {service_id} after {COUNTER_UPDATE_RETRIES} version conflicts")
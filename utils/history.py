@@ -0,0 +1,157 @@
+import asyncio, logging, time
+from datetime import datetime, timedelta
+from sqlalchemy import insert, delete, select
+from sqlalchemy.exc import SQLAlchemyError
+from database.db import SessionLocal
+from database.models import ServedHistory
+from utils.clock import clock
+from utils.global_settings import settings
+
+logger = logging.getLogger(__name__)
+
+# rows deleted per statement by the retention purge, keeps each delete short
+PURGE_CHUNK_SIZE = 5000
+
+
+class HistoryWriter:
+    """
+    Batches served-user rows in memory and appends them to served_history.
+
+    A batch is written when it reaches `batch_size` rows or when the oldest
+    buffered row is `flush_ms` old, whichever comes first. Rows still in the
+    buffer are written by stop(), which main.lifespan calls on shutdown.
+
+    Attributes:
+        batch_size (int): Rows that trigger an immediate flush.
+        flush_ms (int): Longest time a row waits in the buffer.
+    """
+
+    def __init__(self, session_factory=SessionLocal, batch_size: int = None, flush_ms: int = None):
+        self.session_factory = session_factory
+        self.batch_size = batch_size or settings.history_batch_size
+        self.flush_ms = flush_ms or settings.history_flush_ms
+        self._buffer = []
+        self._wakeup = None
+        self._task = None
+        self._last_purge = 0.0
+
+    def add(self, user_id: int, service_id: int, counter_id: int, service_ended_at: datetime,
+            registered_at: datetime = None, arrived_at: datetime = None, service_started_at: datetime = None):
+        """
+        Buffer one served user. Never touches the database.
+        """
+        self._buffer.append({
+            "user_id": user_id,
+            "service_id": service_id,
+            "counter_id": counter_id,
+            "registered_at": registered_at,
+            "arrived_at": arrived_at,
+            "service_started_at": service_started_at,
+            "service_ended_at": service_ended_at,
+        })
+        if len(self._buffer) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending(self):
+        return len(self._buffer)
+
+    def flush(self):
+        """
+        Write every buffered row with a single bulk INSERT.
+
+        Returns:
+            int: The number of rows written.
+
+        Notes:
+            - On failure the rows are put back at the front of the buffer and retried
+              on the next flush.
+        """
+        rows, self._buffer = self._buffer, []
+        if not rows:
+            return 0
+        db = self.session_factory()
+        try:
+            db.execute(insert(ServedHistory), rows)
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            self._buffer[:0] = rows
+            logging.error(f"served history flush of {len(rows)} rows failed: {str(e)}")
+            return 0
+        finally:
+            db.close()
+        logging.debug(f"flushed {len(rows)} served history rows")
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self.flush()
+            if time.monotonic() - self._last_purge >= settings.history_purge_interval_s:
+                self._last_purge = time.monotonic()
+                db = self.session_factory()
+                try:
+                    purge_history(db)
+                except SQLAlchemyError as e:
+                    db.rollback()
+                    logging.error(f"served history purge failed: {str(e)}")
+                finally:
+                    db.close()
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+        self.flush()
+
+
+def purge_history(db, retention_days: int = None):
+    """
+    Delete served_history rows older than the retention period.
+
+    Args:
+        db (Session): A database session.
+        retention_days (int, optional): Days of history to keep. Defaults to settings.history_retention_days.
+
+    Returns:
+        int: The number of rows deleted.
+
+    Notes:
+        - Rows are deleted in chunks of PURGE_CHUNK_SIZE, each in its own transaction,
+          so the purge never holds long locks on the table.
+    """
+    retention_days = settings.history_retention_days if retention_days is None else retention_days
+    cutoff = clock.now() - timedelta(days=retention_days)
+    deleted = 0
+    while True:
+        ids = db.scalars(
+            select(ServedHistory.id)
+            .where(ServedHistory.service_ended_at < cutoff)
+            .order_by(ServedHistory.service_ended_at)
+            .limit(PURGE_CHUNK_SIZE)
+        ).all()
+        if not ids:
+            break
+        db.execute(delete(ServedHistory).where(ServedHistory.id.in_(ids)))
+        db.commit()
+        deleted += len(ids)
+    if deleted:
+        logging.info(f"purged {deleted} served history rows older than {cutoff}")
+    return deleted
+
+
+history_writer = HistoryWriter()
@@ -0,0 +1,104 @@
+import asyncio, weakref
+from contextlib import asynccontextmanager
+
+# one lock per counter so work on independent counters can interleave freely,
+# kept per event loop since asyncio locks cannot be shared between loops
+_counter_locks = weakref.WeakKeyDictionary()
+
+
+def get_counter_lock(counter_id: int):
+    """
+    Return the asyncio lock guarding a counter, creating it on first use.
+
+    Args:
+        counter_id (int): The ID of the counter.
+
+    Returns:
+        asyncio.Lock: The lock for the counter.
+    """
+    loop_locks = _counter_locks.setdefault(asyncio.get_running_loop(), {})
+    lock = loop_locks.get(counter_id)
+    if lock is None:
+        lock = loop_locks.setdefault(counter_id, asyncio.Lock())
+    return lock
+
+
+def drop_counter_lock(counter_id: int):
+    """
+    Forget the lock of a counter that no longer exists.
+
+    Args:
+        counter_id (int): The ID of the deleted counter.
+
+    Returns:
+        None
+    """
+    for loop_locks in _counter_locks.values():
+        loop_locks.pop(counter_id, None)
+
+
+def service_queue_lock(service_id: int):
+    """
+    Return the asyncio lock guarding the shared queue of a service.
+
+    Args:
+        service_id (int): The ID of the service.
+
+    Returns:
+        asyncio.Lock: The lock for the service's shared queue, used with `async with`.
+
+    Notes:
+        - Never acquire it while holding a counter lock of the same service; the shared
+          queue lock is always taken first.
+    """
+    return get_counter_lock(("service", service_id))
+
+
+def drop_service_queue_lock(service_id: int):
+    drop_counter_lock(("service", service_id))
+
+
+def station_lock(station_id: int):
+    """
+    Return the asyncio lock serializing the calls of an operator station.
+
+    Args:
+        station_id (int): The ID of the station.
+
+    Returns:
+        asyncio.Lock: The lock for the station, used with `async with`.
+
+    Notes:
+        - Taken before any counter lock, which the station's calls take to pop users.
+    """
+    return get_counter_lock(("station", station_id))
+
+
+def drop_station_lock(station_id: int):
+    drop_counter_lock(("station", station_id))
+
+
+@asynccontextmanager
+async def counter_locks(*counter_ids: int):
+    """
+    Hold the locks of one or more counters for the duration of the block.
+
+    Locks are always taken in ascending counter ID order so that two operations
+    touching the same pair of counters (e.g. a rebalance) can never deadlock.
+
+    Args:
+        *counter_ids (int): The IDs of the counters to lock. Duplicates are ignored.
+
+    Notes:
+        - The locks are not reentrant, do not nest blocks on the same counter.
+    """
+    locks = [get_counter_lock(counter_id) for counter_id in sorted(set(counter_ids))]
+    acquired = []
+    try:
+        for lock in locks:
+            await lock.acquire()
+            acquired.append(lock)
+        yield
+    finally:
+        for lock in reversed(acquired):
+            lock.release()
@@ -0,0 +1,191 @@
+import asyncio, logging
+from datetime import datetime, timedelta
+from sqlalchemy import update, delete, bindparam
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from database.db import SessionLocal
+from database.models import UserData
+from utils.clock import clock, as_utc
+from utils.event_log import event_log
+from utils.global_settings import settings
+from utils.helpers import update_counter_stats, adjust_counter_load, start_service
+from utils.locks import counter_locks, service_queue_lock
+from utils.priority import rank_order
+from utils.queue_store import queue_store
+from utils.queue_view import queue_view
+
+logger = logging.getLogger(__name__)
+
+# user_data columns the sweeper reads for each queued user
+SWEPT_FIELDS = ("id", "service_id", "priority", "rank_level", "ETA", "skip_count", "skip_offset", "pos", "registered_at",
+                "eta_updated_at", "arrived_at", "service_started_at")
+
+
+def predicted_arrival(user: dict):
+    """
+    When a user is expected at the branch: its last ETA, plus the minutes skips hold it back.
+
+    Returns:
+        datetime: Aware UTC, or None without any timestamp to start from.
+    """
+    base = as_utc(user["eta_updated_at"] or user["registered_at"])
+    if base is None:
+        return None
+    return base + timedelta(minutes=(user["ETA"] or 0) + (user["skip_offset"] or 0))
+
+
+def is_no_show(user: dict, now: datetime):
+    """
+    Whether a waiting user is more than settings.no_show_grace_s past its predicted arrival.
+    """
+    if user["arrived_at"] is not None or user["service_started_at"] is not None:
+        return False
+    arrival = predicted_arrival(user)
+    return arrival is not None and now > arrival + timedelta(seconds=settings.no_show_grace_s)
+
+
+class NoShowSweeper:
+    """
+    Background task that demotes or evicts users who do not turn up.
+
+    Every settings.no_show_sweep_interval_s, a waiting user past its predicted arrival
+    by more than settings.no_show_grace_s is demoted: its skip count goes up and it is
+    held back as if it arrived settings.no_show_demote_minutes from now, which is also
+    its new predicted arrival.
+    A user whose skip count would exceed settings.max_skip_count, after demotions or
+    operator skips, is evicted instead.
+
+    Each affected queue is changed under its lock with one batched UPDATE of the
+    positions and skips that changed and one DELETE of the evicted users, and the
+    counter's in_queue and settings.counters entry are adjusted once.
+    """
+
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self._task = None
+
+    def _candidates(self, db: Session, now: datetime):
+        rows = (
+            db.query(*(getattr(UserData, field) for field in SWEPT_FIELDS), UserData.counter)
+            .filter(UserData.arrived_at.is_(None), UserData.service_started_at.is_(None))
+            .all()
+        )
+        queues = {}
+        for row in rows:
+            user = dict(zip(SWEPT_FIELDS, row))
+            if user["skip_count"] > settings.max_skip_count or is_no_show(user, now):
+                counter_id = row[-1]
+                queue = ("counter", counter_id) if counter_id is not None else ("service", user["service_id"])
+                queues[queue] = user["service_id"]
+        return queues
+
+    def _sweep_queue(self, db: Session, kind: str, queue_id: int, now: datetime):
+        in_queue = UserData.counter == queue_id if kind == "counter" else (UserData.service_id == queue_id) & UserData.counter.is_(None)
+        users = [
+            dict(zip(SWEPT_FIELDS, row))
+            for row in db.query(*(getattr(UserData, field) for field in SWEPT_FIELDS)).filter(in_queue).order_by(UserData.pos)
+        ]
+        evicted, remaining, changed = [], [], {}
+        for user in users:
+            over_limit = user["skip_count"] > settings.max_skip_count
+            if not over_limit and is_no_show(user, now):
+                # held back until no_show_demote_minutes from now
+                late_s = (now - predicted_arrival(user)).total_seconds()
+                user["skip_count"] += 1
+                user["skip_offset"] += int(late_s // 60) + settings.no_show_demote_minutes
+                over_limit = user["skip_count"] > settings.max_skip_count
+                changed[user["id"]] = user
+            if over_limit:
+                evicted.append(user)
+            else:
+                remaining.append(user)
+        demoted = [user for user in remaining if user["id"] in changed]
+
+        for index, user in enumerate(rank_order(remaining), start=1):
+            if user["pos"] != index:
+                user["pos"] = index
+                changed[user["id"]] = user
+        rows = [
+            {"user_id": user["id"], "new_pos": user["pos"], "new_skip_count": user["skip_count"], "new_skip_offset": user["skip_offset"]}
+            for user in remaining if user["id"] in changed
+        ]
+        table = UserData.__table__
+        if rows:
+            db.execute(
+                update(table).where(table.c.id == bindparam("user_id")).values(
+                    pos=bindparam("new_pos"), skip_count=bindparam("new_skip_count"), skip_offset=bindparam("new_skip_offset")
+                ),
+                rows,
+            )
+        if evicted:
+            db.execute(delete(table).where(table.c.id.in_([user["id"] for user in evicted])))
+            if kind == "counter":
+                update_counter_stats(db, queue_id, in_queue_delta=-len(evicted))
+        # the new head may be at the counter already
+        if remaining and remaining[0]["ETA"] == 0 and remaining[0]["service_started_at"] is None:
+            start_service(db.get(UserData, remaining[0]["id"]))
+        return demoted, evicted
+
+    async def sweep(self, now: datetime = None):
+        """
+        Demote and evict the no-shows of every queue.
+
+        Returns:
+            tuple: The number of users demoted and the number evicted.
+        """
+        now = now or clock.now()
+        db = self.session_factory()
+        demoted_total = evicted_total = 0
+        try:
+            for (kind, queue_id), service_id in self._candidates(db, now).items():
+                lock = counter_locks(queue_id) if kind == "counter" else service_queue_lock(queue_id)
+                async with lock:
+                    if kind == "counter":
+                        # the queue is changed in the database, a write-behind copy must not overwrite it
+                        queue_store.release(queue_id)
+                    try:
+                        demoted, evicted = self._sweep_queue(db, kind, queue_id, now)
+                        db.commit()
+                    except SQLAlchemyError as e:
+                        db.rollback()
+                        logging.error(f"no-show sweep of {kind} {queue_id} failed: {str(e)}")
+                        continue
+                    if kind == "counter" and evicted:
+                        adjust_counter_load(service_id, queue_id, -len(evicted))
+                queue_view.touch(service_id)
+                for user in evicted:
+                    event_log.pop(user["id"], service_id, queue_id if kind == "counter" else None)
+                # the demoted stay in their queue with a larger hold-back
+                for user in demoted:
+                    event_log.move(user["id"], service_id, queue_id if kind == "counter" else None, user["skip_offset"])
+                demoted_total += len(demoted)
+                evicted_total += len(evicted)
+        finally:
+            db.close()
+        if demoted_total or evicted_total:
+            logging.info(f"no-show sweep demoted {demoted_total} and evicted {evicted_total} users")
+        return demoted_total, evicted_total
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.no_show_sweep_interval_s)
+            try:
+                await self.sweep()
+            except SQLAlchemyError as e:
+                logging.error(f"no-show sweep failed: {str(e)}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+no_show_sweeper = NoShowSweeper()
@@ -0,0 +1,62 @@
+import logging
+from typing import get_args
+from schema.user_models import PriorityClass
+from utils.clock import clock, as_utc
+from utils.global_settings import settings
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_CLASSES = get_args(PriorityClass)
+
+
+def priority_level(priority_class: str):
+    """
+    The stored level of a priority class, 0 for regular users and higher for earlier service.
+    """
+    return settings.priority_levels.get(priority_class, 0)
+
+
+def effective_level(level: int, registered_at, now=None):
+    """
+    The level a user has earned by waiting: its priority raised by one for every settings.priority_aging_s waited.
+
+    Aging stops lower classes from starving behind a steady stream of higher ones: a
+    user who has waited long enough is ranked with the highest class. 0 disables aging.
+    utils.aging stores it in rank_level, which is what queues are ranked by.
+    """
+    top = max(settings.priority_levels.values(), default=0)
+    level = level or 0
+    if level >= top or not settings.priority_aging_s or registered_at is None:
+        return level
+    waited = ((now or clock.now()) - as_utc(registered_at)).total_seconds()
+    return min(top, level + max(0, int(waited // settings.priority_aging_s)))
+
+
+def _field(user, name: str):
+    return user.get(name) if isinstance(user, dict) else getattr(user, name, None)
+
+
+def rank_key(user):
+    """
+    The queue order of a user: (level, ETA), ties broken by ID.
+
+    The level is the stored rank_level, or the priority without one, so a key only
+    changes with a write and the stored positions of a queue stay in rank_key order.
+    Minutes a user is held back by skips (skip_offset) count as ETA. Works on UserData
+    rows and on the dicts held by utils.queue_store.
+    """
+    level = _field(user, "rank_level")
+    if level is None:
+        level = _field(user, "priority") or 0
+    return (-level, (_field(user, "ETA") or 0) + (_field(user, "skip_offset") or 0), _field(user, "id"))
+
+
+def rank_order(users: list):
+    """
+    Sort a queue in place by rank_key.
+
+    Returns:
+        list: The same users, in queue order.
+    """
+    users.sort(key=rank_key)
+    return users
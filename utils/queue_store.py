@@ -0,0 +1,288 @@
+import asyncio, logging
+from sqlalchemy import update, delete, bindparam
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from database.db import SessionLocal
+from database.models import UserData
+from utils.clock import clock, duration_s
+from utils.event_log import event_log
+from utils.global_settings import settings
+from utils.priority import rank_order
+from utils.queue_view import queue_view
+
+logger = logging.getLogger(__name__)
+
+# user_data columns the store keeps for each queued user
+QUEUED_FIELDS = ("id", "service_id", "ETA", "priority", "rank_level", "skip_count", "skip_offset", "pos", "registered_at", "arrived_at", "service_started_at")
+
+
+class QueueStore:
+    """
+    Per-counter queues held in memory and written to the database behind the requests.
+
+    Used when settings.persistence_mode is "write_behind". Registration, pops and ETA
+    updates of per-counter services change the in-memory queue under the counter's lock
+    and only record what changed; every `flush_ms` the flusher writes all changes in one
+    transaction: an executemany UPDATE per set of changed columns, one DELETE of the
+    served users and one statistics update per served user.
+
+    A new user is still inserted, and committed, by the registration itself, since it
+    needs its ID and a unique name. Shared service queues are not kept here.
+
+    Code that changes queues directly in the database (rebalancing, the ETA refresher,
+    service resizes) calls release() first, under the counters' locks: it writes the
+    pending changes and drops the counters, which are reloaded from the database on
+    their next use.
+
+    Attributes:
+        flush_ms (int): Longest time a change waits in memory.
+    """
+
+    def __init__(self, session_factory=SessionLocal, flush_ms: int = None):
+        self.session_factory = session_factory
+        self.flush_ms = flush_ms or settings.write_behind_flush_ms
+        self._queues = {}
+        self._changed = {}
+        self._deleted = set()
+        self._stats = {}
+        self._services = set()
+        self._wakeup = None
+        self._task = None
+
+    @property
+    def enabled(self):
+        return settings.persistence_mode == "write_behind"
+
+    def queue(self, db: Session, counter_id: int):
+        """
+        The counter's users in queue order, loaded from the database on first use.
+        """
+        users = self._queues.get(counter_id)
+        if users is None:
+            rows = (
+                db.query(*(getattr(UserData, field) for field in QUEUED_FIELDS))
+                .filter(UserData.counter == counter_id)
+                .order_by(UserData.pos)
+                .all()
+            )
+            users = self._queues[counter_id] = [dict(zip(QUEUED_FIELDS, row)) for row in rows]
+        return users
+
+    def _change(self, user: dict, **fields):
+        for field, value in fields.items():
+            user[field] = value
+        self._changed.setdefault(user["id"], {}).update(fields)
+        self._services.add(user["service_id"])
+
+    def _resort(self, counter_id: int):
+        """
+        Reorder the queue by priority and ETA like resort_counter, and start serving an arrived head.
+        """
+        users = rank_order(self._queues[counter_id])
+        for index, user in enumerate(users, start=1):
+            if user["pos"] != index:
+                self._change(user, pos=index)
+        if users and users[0]["ETA"] == 0 and users[0]["service_started_at"] is None:
+            now = clock.now()
+            self._change(users[0], arrived_at=users[0]["arrived_at"] or now, service_started_at=now)
+
+    def _count(self, counter_id: int, in_queue_delta: int, served_time: float = None):
+        stats = self._stats.setdefault(counter_id, {"in_queue": 0, "served": []})
+        stats["in_queue"] += in_queue_delta
+        if served_time is not None:
+            stats["served"].append(served_time)
+
+    @staticmethod
+    def entry(user: UserData):
+        """
+        The queued form of a user, taken after its INSERT is flushed and before the commit expires it.
+        """
+        return {field: getattr(user, field) for field in QUEUED_FIELDS}
+
+    def register(self, counter_id: int, queued: dict):
+        """
+        Add a just committed user, from entry(), to the counter's queue, which must be loaded already.
+
+        Returns:
+            dict: The queued user, with its position.
+        """
+        self._queues[counter_id].append(queued)
+        self._services.add(queued["service_id"])
+        self._resort(counter_id)
+        self._count(counter_id, 1)
+        self._wake()
+        return queued
+
+    def pop(self, db: Session, counter_id: int):
+        """
+        Remove the head of the counter's queue.
+
+        Returns:
+            dict: The served user's history row (as taken by history_writer.add) and its
+                "served_time", None if its service never started, or None if the queue is empty.
+        """
+        users = self.queue(db, counter_id)
+        if not users:
+            return None
+        user = users.pop(0)
+        self._changed.pop(user["id"], None)
+        self._deleted.add(user["id"])
+        ended = clock.now()
+        served_time = duration_s(user["service_started_at"], ended)
+        self._count(counter_id, -1, served_time)
+        self._services.add(user["service_id"])
+        self._resort(counter_id)
+        self._wake()
+        return {
+            "user_id": user["id"],
+            "service_id": user["service_id"],
+            "counter_id": counter_id,
+            "registered_at": user["registered_at"],
+            "arrived_at": user["arrived_at"],
+            "service_started_at": user["service_started_at"],
+            "service_ended_at": ended,
+            "served_time": served_time,
+        }
+
+    def update_eta(self, db: Session, counter_id: int, user_id: int, eta: int, latitude: float, longitude: float):
+        """
+        Set a queued user's ETA and location and re-sort the counter.
+
+        Returns:
+            dict: The queued user, or None if it is not in the counter's queue.
+        """
+        user = next((user for user in self.queue(db, counter_id) if user["id"] == user_id), None)
+        if user is None:
+            return None
+        fields = dict(ETA=eta, eta_updated_at=clock.now(), latitude=latitude, longitude=longitude)
+        if eta == 0 and user["arrived_at"] is None:
+            fields["arrived_at"] = clock.now()
+        self._change(user, **fields)
+        self._resort(counter_id)
+        self._wake()
+        return user
+
+    def pending(self):
+        return len(self._changed) + len(self._deleted) + len(self._stats)
+
+    def flush(self):
+        """
+        Write every pending change in one transaction.
+
+        Returns:
+            int: The number of users updated or deleted.
+
+        Notes:
+            - On failure the changes are kept and retried on the next flush; changes made
+              meanwhile take precedence over the retried ones.
+        """
+        # imported here to avoid circular imports
+        from utils.helpers import update_counter_stats
+
+        if not self.pending():
+            return 0
+        changed, deleted, stats, services = self._changed, self._deleted, self._stats, self._services
+        self._changed, self._deleted, self._stats, self._services = {}, set(), {}, set()
+
+        # one executemany per set of changed columns
+        groups = {}
+        for user_id, fields in changed.items():
+            groups.setdefault(tuple(sorted(fields)), []).append(
+                {"user_id": user_id, **{f"new_{column}": value for column, value in fields.items()}}
+            )
+        table = UserData.__table__
+        db = self.session_factory()
+        try:
+            for columns, rows in groups.items():
+                statement = (
+                    update(table)
+                    .where(table.c.id == bindparam("user_id"))
+                    .values({column: bindparam(f"new_{column}") for column in columns})
+                )
+                db.execute(statement, rows)
+            if deleted:
+                db.execute(delete(table).where(table.c.id.in_(deleted)))
+            for counter_id, counter_stats in stats.items():
+                served = counter_stats["served"]
+                update_counter_stats(db, counter_id, in_queue_delta=counter_stats["in_queue"],
+                                     served_time=served[0] if served else None)
+                for served_time in served[1:]:
+                    update_counter_stats(db, counter_id, served_time=served_time)
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            for user_id, fields in changed.items():
+                if user_id not in self._deleted:
+                    self._changed[user_id] = {**fields, **self._changed.get(user_id, {})}
+            self._deleted |= deleted
+            for counter_id, counter_stats in stats.items():
+                current = self._stats.setdefault(counter_id, {"in_queue": 0, "served": []})
+                current["in_queue"] += counter_stats["in_queue"]
+                current["served"][:0] = counter_stats["served"]
+            self._services |= services
+            logging.error(f"write-behind flush failed, {len(changed) + len(deleted)} users kept for retry: {str(e)}")
+            return 0
+        finally:
+            db.close()
+        # the view reads the database, it only sees these changes now
+        for service_id in services:
+            queue_view.touch(service_id)
+        logging.debug(f"write-behind flushed {len(changed)} updated and {len(deleted)} served users")
+        return len(changed) + len(deleted)
+
+    def release(self, *counter_ids: int):
+        """
+        Write pending changes and forget the counters, before they are changed in the database directly.
+
+        Without counter IDs every counter is forgotten. Callers hold the counters' locks.
+        """
+        if not self.enabled and not self._queues:
+            return
+        self.flush()
+        if counter_ids:
+            for counter_id in counter_ids:
+                self._queues.pop(counter_id, None)
+        else:
+            self._queues.clear()
+
+    async def acknowledge(self):
+        """
+        Return once a change is as durable as settings.write_behind_durability asks.
+
+        "memory" acknowledges right away; a crash loses up to flush_ms of changes.
+        "log" waits for the event log's group commit, from which the queues can be replayed.
+        """
+        if settings.write_behind_durability == "log":
+            await event_log.sync()
+
+    def _wake(self):
+        if self._wakeup is not None and not self._wakeup.is_set():
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # collect everything changed within one interval into a single flush
+            await asyncio.sleep(self.flush_ms / 1000)
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+        self.flush()
+        self._queues.clear()
+
+
+queue_store = QueueStore()
@@ -0,0 +1,313 @@
+import logging, time
+from collections import deque
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from database.models import Service, Counter, UserData
+from utils.global_settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class QueueView:
+    """
+    Versioned in-memory view of every service, counter and queue.
+
+    The request paths apply their change after their commit: register(), remove() and
+    move() update the loaded service in memory and log the users whose counter, position
+    or ETA changed, without any query. A delta for a service that is stale or not loaded,
+    or for a user the view does not know, falls back to touch().
+
+    Bulk changes, like service updates, counter migrations or no-show sweeps, call
+    touch(service_id), which marks the service stale; the next reader reloads all stale
+    services at once, with one query per table, so a whole-system snapshot costs at most
+    three queries however many services and counters there are. Everything is reloaded
+    after max_age_s as a safety net.
+
+    Every reload is diffed against the previous state, and the changed users, counters
+    and services are appended to a ring buffer of (version, change) entries, like the
+    changes of the deltas; changes() answers delta requests from it.
+
+    Attributes:
+        version (int): Bumped by every delta and touch(), never goes backwards.
+        max_age_s (float): Reload everything after this long, so changes committed by
+            other workers, which never reach this process' view, show up eventually.
+        floor (int): Changes after this version are all still in the ring buffer.
+    """
+
+    def __init__(self, max_age_s: float = None, log_size: int = None):
+        self.version = 0
+        self.max_age_s = settings.queue_view_max_age_s if max_age_s is None else max_age_s
+        self.floor = None
+        self._log = deque(maxlen=settings.queue_change_log_size if log_size is None else log_size)
+        self._services = {}
+        self._stale = set()
+        self._stale_all = True
+        self._loaded_at = 0.0
+
+    def touch(self, service_id: int):
+        """
+        Mark a service's state as changed. Never touches the database.
+        """
+        self.version += 1
+        self._stale.add(service_id)
+
+    def _loaded(self, service_id: int, user_id: int = None):
+        """
+        The loaded state of a service that a delta can be applied to, or None after falling back to touch().
+        """
+        state = self._services.get(service_id)
+        if state is None or self._stale_all or service_id in self._stale or (user_id is not None and user_id not in state["users"]):
+            self.touch(service_id)
+            return None
+        self.version += 1
+        return state
+
+    @staticmethod
+    def _shift(state: dict, counter_id: int, from_pos: int, delta: int, changed: set):
+        # the users at or behind from_pos in the queue of counter_id (None for the shared queue)
+        for user_id, user in state["users"].items():
+            if user["counter"] == counter_id and user["pos"] >= from_pos:
+                user["pos"] += delta
+                changed.add(user_id)
+
+    def _changed(self, service_id: int, state: dict, changed: set):
+        for user_id in changed:
+            user = state["users"].get(user_id)
+            if user is None:
+                self._append({"kind": "user", "id": user_id, "service_id": service_id, "removed": True})
+            else:
+                self._append({"kind": "user", "id": user_id, "service_id": service_id, **user})
+        state["version"] = self.version
+        state["snapshot"] = None
+
+    def register(self, service_id: int, user_id: int, counter_id: int, name: str, pos: int, eta: int):
+        """
+        Add a committed new user at its position; the users behind it move back by one.
+        """
+        state = self._loaded(service_id)
+        if state is None:
+            return
+        changed = {user_id}
+        self._shift(state, counter_id, pos, 1, changed)
+        state["users"][user_id] = {"counter": counter_id, "name": name, "pos": pos, "ETA": eta}
+        self._changed(service_id, state, changed)
+
+    def remove(self, service_id: int, user_id: int, served_time: float = None):
+        """
+        Drop a committed popped or evicted user; the users behind it move up by one.
+
+        A served_time is added to the statistics of the user's counter the way
+        helpers.update_counter_stats adds it to the row.
+        """
+        state = self._loaded(service_id, user_id)
+        if state is None:
+            return
+        user = state["users"].pop(user_id)
+        changed = {user_id}
+        self._shift(state, user["counter"], user["pos"] + 1, -1, changed)
+        counter = state["counters"].get(user["counter"])
+        if served_time is not None and counter is not None:
+            processed = counter["users_processed"]
+            counter["avg_tat"] = (counter["avg_tat"] * processed + served_time) / (processed + 1)
+            counter["users_processed"] = processed + 1
+            self._append({"kind": "counter", "id": user["counter"], "service_id": service_id, **counter})
+        self._changed(service_id, state, changed)
+
+    def move(self, service_id: int, user_id: int, counter_id: int, pos: int, eta: int = None):
+        """
+        Move a committed user to a position in a queue, its own or another one of the service, with its new ETA if given.
+
+        The users behind its old place move up by one and those from its new place back by one.
+        """
+        state = self._loaded(service_id, user_id)
+        if state is None:
+            return
+        user = state["users"][user_id]
+        changed = {user_id}
+        self._shift(state, user["counter"], user["pos"] + 1, -1, changed)
+        user["counter"], user["pos"] = None, 0
+        self._shift(state, counter_id, pos, 1, changed)
+        user["counter"], user["pos"] = counter_id, pos
+        if eta is not None:
+            user["ETA"] = eta
+        self._changed(service_id, state, changed)
+
+    def invalidate(self):
+        """
+        Mark every service as changed, e.g. after bulk changes outside the request paths.
+        """
+        self.version += 1
+        self._stale_all = True
+
+    def sync(self, db: Session):
+        """
+        Reload the stale services.
+
+        Returns:
+            int: The number of services reloaded.
+        """
+        full = self._stale_all or time.monotonic() - self._loaded_at > self.max_age_s
+        if full or self._stale:
+            # a reload may pick up commits nobody touched for (other workers), so its changes
+            # get a version no reader can have seen yet
+            self.version += 1
+        if full:
+            reloaded = self._load(db, None)
+            if self.floor is None:
+                # nothing to diff against, earlier versions are only available as a snapshot
+                self.floor = self.version
+            else:
+                for service_id in set(self._services) | set(reloaded):
+                    self._record(service_id, self._services.get(service_id), reloaded.get(service_id))
+            self._services = reloaded
+            self._stale_all = False
+            self._stale.clear()
+            self._loaded_at = time.monotonic()
+            return len(reloaded)
+        if not self._stale:
+            return 0
+        service_ids = set(self._stale)
+        reloaded = self._load(db, service_ids)
+        for service_id in service_ids:
+            self._record(service_id, self._services.get(service_id), reloaded.get(service_id))
+            if service_id in reloaded:
+                self._services[service_id] = reloaded[service_id]
+            else:
+                # deleted
+                self._services.pop(service_id, None)
+        self._stale -= service_ids
+        return len(service_ids)
+
+    def _load(self, db: Session, service_ids: set):
+        services = select(Service.id, Service.name, Service.queue_mode).order_by(Service.id)
+        counters = select(Counter.id, Counter.service_id, Counter.avg_tat, Counter.users_processed).order_by(Counter.id)
+        users = (
+            select(UserData.id, UserData.service_id, UserData.counter, UserData.name, UserData.pos, UserData.ETA)
+            .order_by(UserData.service_id, UserData.counter, UserData.pos)
+        )
+        if service_ids is not None:
+            services = services.where(Service.id.in_(service_ids))
+            counters = counters.where(Counter.service_id.in_(service_ids))
+            users = users.where(UserData.service_id.in_(service_ids))
+
+        loaded = {}
+        for service_id, name, queue_mode in db.execute(services):
+            loaded[service_id] = {
+                "version": self.version,
+                "name": name,
+                "queue_mode": queue_mode,
+                "counters": {},
+                "users": {},
+            }
+        for counter_id, service_id, avg_tat, users_processed in db.execute(counters):
+            if service_id in loaded:
+                loaded[service_id]["counters"][counter_id] = {"avg_tat": avg_tat or 0, "users_processed": users_processed or 0}
+        for user_id, service_id, counter_id, name, pos, eta in db.execute(users):
+            if service_id in loaded:
+                loaded[service_id]["users"][user_id] = {"counter": counter_id, "name": name, "pos": pos, "ETA": eta}
+        for state in loaded.values():
+            state["snapshot"] = None
+        logging.debug(f"queue view reloaded {len(loaded)} services at version {self.version}")
+        return loaded
+
+    def _append(self, change: dict):
+        if len(self._log) == self._log.maxlen:
+            self.floor = max(self.floor, self._log[0][0])
+        self._log.append((self.version, change))
+
+    def _record(self, service_id: int, old: dict, new: dict):
+        """
+        Log what differs between two loaded states of a service, either may be None.
+        """
+        if new is None:
+            if old is not None:
+                self._append({"kind": "service", "id": service_id, "service_id": service_id, "removed": True})
+            return
+        old = old or {"name": None, "queue_mode": None, "counters": {}, "users": {}}
+        if (old["name"], old["queue_mode"]) != (new["name"], new["queue_mode"]):
+            self._append({"kind": "service", "id": service_id, "service_id": service_id,
+                          "name": new["name"], "queue_mode": new["queue_mode"]})
+        for kind, key in (("counter", "counters"), ("user", "users")):
+            before, after = old[key], new[key]
+            for item_id in before.keys() - after.keys():
+                self._append({"kind": kind, "id": item_id, "service_id": service_id, "removed": True})
+            for item_id, item in after.items():
+                if before.get(item_id) != item:
+                    self._append({"kind": kind, "id": item_id, "service_id": service_id, **item})
+
+    def changes(self, db: Session, since: int):
+        """
+        Return the changes after version `since`, or None if they are no longer all retained.
+
+        Only the latest change of each user, counter and service is returned, in version order.
+
+        Returns:
+            list[dict]: The changes, each with its version, or None when the caller needs a snapshot.
+        """
+        self.sync(db)
+        if since < self.floor or since > self.version:
+            return None
+        latest = {}
+        # newest first, stopping at the first change the caller has seen already
+        for version, change in reversed(self._log):
+            if version <= since:
+                break
+            latest.setdefault((change["kind"], change["id"]), {"version": version, **change})
+        return sorted(latest.values(), key=lambda change: change["version"])
+
+    def _service_snapshot(self, service_id: int, state: dict):
+        queues = {counter_id: [] for counter_id in state["counters"]}
+        waiting = []
+        for user_id, user in state["users"].items():
+            if user["counter"] is None:
+                waiting.append((user["pos"], user_id))
+            elif user["counter"] in queues:
+                queues[user["counter"]].append((user["pos"], user_id))
+
+        def head(entries):
+            if not entries:
+                return None
+            user_id = min(entries)[1]
+            user = state["users"][user_id]
+            return {"id": user_id, "name": user["name"], "pos": user["pos"], "ETA": user["ETA"]}
+
+        return {
+            "id": service_id,
+            "name": state["name"],
+            "queue_mode": state["queue_mode"],
+            "version": state["version"],
+            "waiting": len(waiting),
+            "head": head(waiting),
+            "counters": [
+                {
+                    "id": counter_id,
+                    "queue_length": len(queues[counter_id]),
+                    "avg_tat": counter["avg_tat"],
+                    "users_processed": counter["users_processed"],
+                    "head": head(queues[counter_id]),
+                }
+                for counter_id, counter in state["counters"].items()
+            ],
+        }
+
+    def _built(self, service_id: int, state: dict):
+        # built once per change, snapshots between changes only collect them
+        if state["snapshot"] is None:
+            state["snapshot"] = self._service_snapshot(service_id, state)
+        return state["snapshot"]
+
+    def snapshot(self, db: Session):
+        """
+        Return every service with its counters, queue lengths and heads of queue.
+
+        Returns:
+            dict: {"version": int, "services": [...]}, see schema.operator_models.SnapshotResponse.
+        """
+        self.sync(db)
+        return {
+            "version": self.version,
+            "services": [self._built(service_id, state) for service_id, state in sorted(self._services.items())],
+        }
+
+
+queue_view = QueueView()
@@ -0,0 +1,46 @@
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    Tokens refill continuously at `rate` per second up to `capacity`; every
+    permitted call spends one token.
+
+    Attributes:
+        rate (float): Tokens added per second.
+        capacity (float): Largest burst allowed.
+    """
+
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def available(self):
+        """
+        Return the number of whole tokens that can be spent right now.
+        """
+        self._refill()
+        return int(self._tokens)
+
+    def try_acquire(self, tokens: int = 1):
+        """
+        Spend tokens if they are available.
+
+        Returns:
+            bool: True if the tokens were spent, False if the caller is over budget.
+        """
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
@@ -0,0 +1,71 @@
+import heapq, logging
+from datetime import datetime
+from sqlalchemy.orm import Session
+from database.models import UserData, OperatorStation, StationCounter
+from utils.clock import clock, as_utc, duration_s
+from utils.priority import rank_key
+from utils.queue_store import queue_store
+
+logger = logging.getLogger(__name__)
+
+# user_data columns read for the head of each counter
+HEAD_FIELDS = ("id", "service_id", "counter", "ETA", "priority", "rank_level", "skip_offset", "registered_at")
+
+
+def queue_heads(db: Session, counter_ids: list):
+    """
+    The head user of each of the counters, as dicts of HEAD_FIELDS.
+
+    One point read per counter through the (counter, pos) index, or the in-memory
+    queues in the write-behind mode; the rest of the queues is never read.
+    """
+    if queue_store.enabled:
+        heads = []
+        for counter_id in counter_ids:
+            users = queue_store.queue(db, counter_id)
+            if users:
+                heads.append({**{field: users[0].get(field) for field in HEAD_FIELDS}, "counter": counter_id})
+        return heads
+    rows = (
+        db.query(*(getattr(UserData, field) for field in HEAD_FIELDS))
+        .filter(UserData.counter.in_(counter_ids), UserData.pos == 1)
+        .all()
+    )
+    return [dict(zip(HEAD_FIELDS, row)) for row in rows]
+
+
+def head_key(head: dict, now: datetime):
+    """
+    The order heads of different counters are served in: priority and ETA as in a queue, then the longest wait.
+    """
+    level, eta, user_id = rank_key(head)
+    registered_at = as_utc(head["registered_at"]) or now
+    return (level, eta, registered_at, user_id)
+
+
+def merge_heads(heads: list, now: datetime = None):
+    """
+    Yield the heads best first, by a k-way merge over a heap of their keys.
+
+    Building the heap is O(k) for k counters and every head taken is O(log k).
+    """
+    now = now or clock.now()
+    heap = [(head_key(head, now), index) for index, head in enumerate(heads)]
+    heapq.heapify(heap)
+    while heap:
+        _, index = heapq.heappop(heap)
+        yield {**heads[index], "waited_s": duration_s(heads[index]["registered_at"], now)}
+
+
+def unbind_counters(db: Session, counter_ids: list):
+    """
+    Detach removed counters from every station, in the caller's transaction.
+
+    A station serving a user of a removed counter keeps the user's ID, so its next call
+    reports that the user is no longer at the counter it was called to.
+    """
+    if not counter_ids:
+        return
+    db.query(StationCounter).filter(StationCounter.counter_id.in_(counter_ids)).delete(synchronize_session=False)
+    db.query(OperatorStation).filter(OperatorStation.current_counter.in_(counter_ids)).update(
+        {"current_counter": None}, synchronize_session=False)
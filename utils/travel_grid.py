@@ -0,0 +1,209 @@
+import argparse, asyncio, json, logging, math, os
+import numpy as np
+from schema.distance_models import Location
+from utils.global_settings import settings, Q_SOLUTIONS_COORDS
+
+logger = logging.getLogger(__name__)
+
+METRES_PER_DEGREE = 111_320.0
+# one cell record: learned travel time and how many answers it was learned from
+CELL_DTYPE = np.dtype([("minutes", np.float32), ("samples", np.uint32)])
+# answers after which a cell becomes a moving average instead of a plain mean
+MAX_SAMPLE_WEIGHT = 20
+
+
+class TravelGrid:
+    """
+    Travel times to the branch on a square grid centred on Q_SOLUTIONS_COORDS.
+
+    The grid lives in a memory-mapped .npy file, so it survives restarts and is
+    shared by every worker process on the host. A location maps to its cell with
+    plain arithmetic, and a lookup reads a single record from the map.
+
+    Attributes:
+        path (str): The grid file. Its geometry is kept in a .json file next to it.
+        cell_m (float): Cell edge length in metres.
+        radius_km (float): Distance from the branch covered in each direction.
+    """
+
+    def __init__(self, path: str = None, cell_m: float = None, radius_km: float = None,
+                 center=Q_SOLUTIONS_COORDS):
+        self.path = path or settings.travel_grid_path
+        self.cell_m = cell_m or settings.travel_grid_cell_m
+        self.radius_km = radius_km or settings.travel_grid_radius_km
+        self.center = tuple(center)
+        self.half = math.ceil(self.radius_km * 1000 / self.cell_m)
+        self.size = 2 * self.half + 1
+        self.lat_step = self.cell_m / METRES_PER_DEGREE
+        self.lon_step = self.cell_m / (METRES_PER_DEGREE * math.cos(math.radians(self.center[0])))
+        self._cells = None
+
+    def _geometry(self):
+        return {"center": list(self.center), "cell_m": self.cell_m, "size": self.size}
+
+    @property
+    def cells(self):
+        """
+        The memory-mapped records, opened on first use and created when missing.
+        """
+        if self._cells is None:
+            meta_path = self.path + ".json"
+            geometry = None
+            if os.path.exists(self.path) and os.path.exists(meta_path):
+                with open(meta_path) as meta:
+                    geometry = json.load(meta)
+            if geometry == self._geometry():
+                self._cells = np.lib.format.open_memmap(self.path, mode="r+")
+            else:
+                if geometry is not None:
+                    logging.warning(f"travel grid {self.path} was built for another geometry, starting a new one")
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._cells = np.lib.format.open_memmap(self.path, mode="w+", dtype=CELL_DTYPE, shape=(self.size, self.size))
+                with open(meta_path, "w") as meta:
+                    json.dump(self._geometry(), meta)
+        return self._cells
+
+    def cell_of(self, location: Location):
+        """
+        Return the (row, column) of the cell containing a location, or None outside the grid.
+        """
+        row = round((location.latitude - self.center[0]) / self.lat_step) + self.half
+        column = round((location.longitude - self.center[1]) / self.lon_step) + self.half
+        if 0 <= row < self.size and 0 <= column < self.size:
+            return row, column
+        return None
+
+    def cell_center(self, row: int, column: int):
+        return Location(
+            latitude=self.center[0] + (row - self.half) * self.lat_step,
+            longitude=self.center[1] + (column - self.half) * self.lon_step,
+        )
+
+    def lookup(self, location: Location, search_cells: int = None):
+        """
+        Travel time learned for the location's cell or the nearest learned cell around it.
+
+        Args:
+            location (Location): The origin.
+            search_cells (int, optional): How many cells away to look when the location's own
+                cell is empty. Defaults to settings.travel_grid_search_cells.
+
+        Returns:
+            int: The travel time in minutes, or None if nothing close enough is known.
+        """
+        cell = self.cell_of(location)
+        if cell is None:
+            return None
+        row, column = cell
+        record = self.cells[row, column]
+        if record["samples"]:
+            return round(float(record["minutes"]))
+
+        reach = settings.travel_grid_search_cells if search_cells is None else search_cells
+        if reach <= 0:
+            return None
+        rows = slice(max(row - reach, 0), row + reach + 1)
+        columns = slice(max(column - reach, 0), column + reach + 1)
+        window = self.cells[rows, columns]
+        known = np.argwhere(window["samples"] > 0)
+        if not len(known):
+            return None
+        offsets = known + (rows.start - row, columns.start - column)
+        nearest = known[np.argmin((offsets ** 2).sum(axis=1))]
+        return round(float(window["minutes"][nearest[0], nearest[1]]))
+
+    def observe(self, location: Location, minutes: float):
+        """
+        Fold a real travel time into the location's cell.
+        """
+        cell = self.cell_of(location)
+        if cell is None or minutes is None:
+            return
+        minutes_column, samples_column = self.cells["minutes"], self.cells["samples"]
+        samples = int(samples_column[cell])
+        if samples:
+            weight = min(samples + 1, MAX_SAMPLE_WEIGHT)
+            minutes_column[cell] += (minutes - minutes_column[cell]) / weight
+        else:
+            minutes_column[cell] = minutes
+        samples_column[cell] = min(samples + 1, np.iinfo(np.uint32).max)
+
+    def known_cells(self):
+        return int(np.count_nonzero(self.cells["samples"]))
+
+    def flush(self):
+        if self._cells is not None:
+            self._cells.flush()
+
+    def close(self):
+        self.flush()
+        self._cells = None
+
+
+async def build_grid(grid: TravelGrid, fetch, step: int = 4, concurrency: int = 4):
+    """
+    Offline batch job: ask the distance API for every `step`-th cell within the radius.
+
+    Cells in between are answered by TravelGrid.lookup from the nearest learned cell,
+    so `step` should not exceed twice settings.travel_grid_search_cells.
+
+    Args:
+        grid (TravelGrid): The grid to fill.
+        fetch: Coroutine function returning the travel time in minutes for a Location.
+        step (int): Sample every `step` cells in both directions.
+        concurrency (int): Requests in flight at once.
+
+    Returns:
+        int: The number of cells filled.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    radius_cells = grid.radius_km * 1000 / grid.cell_m
+    targets = [
+        (row, column)
+        # aligned so that the branch's own cell is sampled
+        for row in range(grid.half % step, grid.size, step)
+        for column in range(grid.half % step, grid.size, step)
+        if math.hypot(row - grid.half, column - grid.half) <= radius_cells
+    ]
+
+    async def fill(row, column):
+        location = grid.cell_center(row, column)
+        async with semaphore:
+            try:
+                minutes = await fetch(location)
+            except Exception as e:
+                logging.warning(f"travel grid cell ({row}, {column}) failed: {str(e)}")
+                return 0
+        grid.observe(location, minutes)
+        return 1
+
+    filled = sum(await asyncio.gather(*(fill(row, column) for row, column in targets)))
+    grid.flush()
+    logging.info(f"travel grid build filled {filled} of {len(targets)} sampled cells")
+    return filled
+
+
+travel_grid = TravelGrid()
+
+
+if __name__ == "__main__":
+    from utils.distance_client import distance_client
+
+    parser = argparse.ArgumentParser(description="Precompute travel times to the branch into the travel grid.")
+    parser.add_argument("--step", type=int, default=4, help="sample every STEP cells")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    async def paced_fetch(location):
+        while not distance_client.rate_limiter.try_acquire():
+            await asyncio.sleep(1 / settings.distance_api_calls_per_second)
+        # fetch() bypasses the fallbacks, a failed cell is simply left empty
+        return await distance_client.fetch(location)
+
+    async def main():
+        try:
+            return await build_grid(travel_grid, paced_fetch, args.step, args.concurrency)
+        finally:
+            await distance_client.aclose()
+
+    print(f"filled {asyncio.run(main())} cells, {travel_grid.known_cells()} known")